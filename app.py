@@ -2,12 +2,45 @@ import os
 import json
 import uuid
 import hashlib
-from flask import Flask, jsonify, request
+import hmac
+import secrets
+import time
+import threading
+import functools
+import itertools
+import weakref
+import select
+import queue
+import bisect
+import contextvars
+import base64
+import re
+import unicodedata
+import io
+import csv
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+import click
+from flask import Flask, jsonify, request, Response, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 import psycopg2
 import psycopg2.extras
+import requests
 import traceback
+try:
+    import orjson  # serializador rápido (opcional: sem ele cai no json da stdlib)
+except ImportError:
+    orjson = None
+try:
+    from PIL import Image, ImageOps  # versões reduzidas das imagens (opcional: sem ele fica só o imagem_url)
+except ImportError:
+    Image = ImageOps = None
 # --- NOVO IMPORT PARA O CHATBOT ---
 import google.generativeai as genai
 
@@ -18,11 +51,10 @@ import google.generativeai as genai
 
 load_dotenv()
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}}) 
+CORS(app, resources={r"/api/*": {"origins": "*", "expose_headers": ["ETag", "Retry-After"]}}) 
 
 # 💡 ATENÇÃO: Verifique se sua variável de ambiente DATABASE_URL está configurada
 DATABASE_URL = os.environ.get("DATABASE_URL") 
-ADMIN_SESSIONS = {}
 
 # --- CONFIGURAÇÃO GEMINI (CHATBOT) ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
@@ -33,22 +65,1010 @@ else:
     print("✅ [IA] Gemini configurado com sucesso.")
 
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
+# ======================================================================
+# 0. POOL DE CONEXÕES (POR WORKER)
+# ======================================================================
+# Cada worker do gunicorn mantém o seu próprio pool. O pool é recriado
+# automaticamente quando o PID muda (fork), então nenhuma conexão é
+# compartilhada entre processos.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+# Conexões ociosas há mais tempo que isso recebem um "SELECT 1" antes de voltar ao uso
+DB_POOL_VALIDATE_AFTER = float(os.environ.get("DB_POOL_VALIDATE_AFTER", 30))
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+
+# NUMERIC (preços, totais) chega do banco direto como float: nada de Decimal
+# nas rotas nem de laços "p['preco'] = float(p['preco'])" antes do JSON.
+NUMERIC_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_FLOAT',
+    lambda valor, cur: float(valor) if valor is not None else None)
+
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexão ficou livre dentro do timeout de checkout."""
+
+
+class DBPool:
+    """Pool de conexões psycopg2 com limite, timeout de checkout e validação."""
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, validate_after=DB_POOL_VALIDATE_AFTER):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, ultimo_uso)
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+        for _ in range(min(self.minconn, self.maxconn)):
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                print(f"🔴 ERRO AO CONECTAR NO DB: {e}")
+                break
+            self._size += 1
+            self._stats["connections_created"] += 1
+            self._idle.append((conn, time.monotonic()))
+
+    # Os contadores de _stats só mudam com self._cond seguro; _connect/_discard
+    # rodam fora do lock, então quem os chama conta dentro do próximo bloco travado.
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connect_timeout=DB_CONNECT_TIMEOUT,
+                                connection_factory=ConexaoInstrumentada)
+        psycopg2.extensions.register_type(NUMERIC_FLOAT, conn)
         return conn
-    except Exception as e:
-        print(f"🔴 ERRO AO CONECTAR NO DB: {e}")
-        return None
+
+    def _is_alive(self, conn, ultimo_uso):
+        if conn.closed:
+            return False
+        if time.monotonic() - ultimo_uso < self.validate_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        inicio = time.monotonic()
+        deadline = inicio + self.timeout
+        esperou = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolEsgotado("Pool de conexões fechado.")
+                if self._idle:
+                    conn, ultimo_uso = self._idle.pop()
+                    self._in_use += 1
+                    acao = "validar"
+                elif self._size < self.maxconn:
+                    self._size += 1
+                    self._in_use += 1
+                    acao = "criar"
+                else:
+                    restante = deadline - time.monotonic()
+                    if restante <= 0:
+                        self._stats["checkout_timeouts"] += 1
+                        raise PoolEsgotado(f"Nenhuma conexão livre em {self.timeout:.1f}s (max={self.maxconn}).")
+                    esperou = True
+                    self._cond.wait(restante)
+                    continue
+
+            # Validação/criação fora do lock para não travar os outros threads
+            if acao == "validar" and not self._is_alive(conn, ultimo_uso):
+                self._discard(conn)
+                with self._cond:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._stats["connections_discarded"] += 1
+                continue
+            if acao == "criar":
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+
+            espera = time.monotonic() - inicio
+            with self._cond:
+                if acao == "criar":
+                    self._stats["connections_created"] += 1
+                self._stats["checkouts"] += 1
+                if esperou:
+                    self._stats["waits"] += 1
+                self._stats["wait_time_total"] += espera
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], espera)
+            return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                # Nunca devolve ao pool uma transação aberta (ex.: rota que só fez SELECT)
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._cond:
+            self._in_use -= 1
+            if close or conn.closed or self._closed:
+                self._size -= 1
+                self._stats["connections_discarded"] += 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._stats["connections_discarded"] += 1
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            dados = dict(self._stats)
+            dados.update({
+                "pid": self.pid,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+            })
+        dados["wait_time_avg"] = dados["wait_time_total"] / dados["checkouts"] if dados["checkouts"] else 0.0
+        return dados
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """Retorna o pool do processo atual, criando (ou recriando após fork) quando preciso."""
+    global _db_pool
+    pool = _db_pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.pid != os.getpid():
+            # Após o fork as conexões herdadas pertencem ao pai: apenas descarta a referência
+            _db_pool = DBPool(DATABASE_URL)
+        return _db_pool
+
+
+def reset_db_pool():
+    """Fecha o pool do processo atual (usado em shutdown/testes)."""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None and _db_pool.pid == os.getpid():
+            _db_pool.closeall()
+        _db_pool = None
+
+
+@contextmanager
+def db_connection():
+    """Empresta uma conexão do pool e a devolve (com rollback se preciso) ao final."""
+    pool = get_db_pool()
+    inicio = time.perf_counter()
+    conn = pool.getconn()
+    espera = time.perf_counter() - inicio
+    metricas.observar("suagrafica_db_checkout_segundos", espera)
+    medidas = _medidas_requisicao.get()
+    if medidas is not None:
+        medidas.checkout += espera
+    quebrada = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        quebrada = True
+        raise
+    finally:
+        pool.putconn(conn, close=quebrada or bool(conn.closed))
+
+
+@app.errorhandler(PoolEsgotado)
+@app.errorhandler(psycopg2.OperationalError)
+def db_indisponivel(e):
+    print(f"🔴 ERRO AO CONECTAR NO DB: {e}")
+    return jsonify({"erro": "Banco de dados indisponível no momento. Tente novamente."}), 503
+
+
+# --- INSTRUMENTAÇÃO (MÉTRICAS POR REQUISIÇÃO, /metrics E LOG DE LENTAS) ---
+# Cada requisição acumula, num ContextVar, o tempo total, o tempo e a
+# contagem de consultas SQL (via cursor instrumentado em todas as conexões
+# do pool), as linhas retornadas/afetadas, a espera pela conexão e o tempo
+# das chamadas ao Gemini. No fim da resposta (inclusive streaming) os totais
+# vão para histogramas/contadores por rota, expostos em /metrics no formato
+# do Prometheus. Os números são do processo: com vários workers cada um
+# responde pelos seus (o scrape deve ir a cada worker ou somar por pid).
+LENTO_LIMITE_MS = float(os.environ.get("LENTO_LIMITE_MS", 1000))
+LENTO_DB_LIMITE_MS = float(os.environ.get("LENTO_DB_LIMITE_MS", 500))
+LENTO_CONSULTAS_LIMITE = int(os.environ.get("LENTO_CONSULTAS_LIMITE", 50))
+# Limites por rota (JSON), ex.: {"/api/chat_vendas": {"ms": 8000}}. 0 desliga o critério.
+# Os streams de eventos ficam abertos por minutos de propósito: sem limite de tempo por padrão.
+LENTO_LIMITES_ROTA = {
+    "/api/admin/pedidos/eventos": {"ms": 0},
+    "/api/cliente/pedidos/eventos": {"ms": 0},
+    **json.loads(os.environ.get("LENTO_LIMITES_ROTA") or "{}"),
+}
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+LIMITES_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LIMITES_DB = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+LIMITES_GEMINI = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30)
+
+
+class Metricas:
+    """Contadores e histogramas com rótulos, renderizados no formato texto do Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._familias = {}  # nome -> {"tipo", "ajuda", "limites", "series": {rotulos: valor | [baldes, soma, n]}}
+        self._medidores = []  # (prefixo, ajuda, func): estado atual de pools/caches
+
+    def definir(self, nome, tipo, ajuda, limites=None):
+        self._familias[nome] = {"tipo": tipo, "ajuda": ajuda, "limites": limites, "series": {}}
+
+    def somar(self, nome, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        series = self._familias[nome]["series"]
+        with self._lock:
+            series[chave] = series.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        familia = self._familias[nome]
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            serie = familia["series"].get(chave)
+            if serie is None:
+                serie = familia["series"][chave] = [[0] * (len(familia["limites"]) + 1), 0.0, 0]
+            serie[0][bisect.bisect_left(familia["limites"], valor)] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def medidor(self, prefixo, ajuda, func):
+        """func() devolve um dict; cada valor numérico vira o gauge suagrafica_<prefixo>_<chave>."""
+        self._medidores.append((prefixo, ajuda, func))
+
+    @staticmethod
+    def _rotulos(pares):
+        if not pares: return ""
+        escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in pares) + "}"
+
+    def renderizar(self):
+        linhas = []
+        with self._lock:
+            familias = [(nome, f, {k: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v
+                                   for k, v in f["series"].items()})
+                        for nome, f in sorted(self._familias.items())]
+        for nome, familia, series in familias:
+            linhas.append(f"# HELP {nome} {familia['ajuda']}")
+            linhas.append(f"# TYPE {nome} {familia['tipo']}")
+            for chave, valor in sorted(series.items()):
+                if familia["tipo"] != "histogram":
+                    linhas.append(f"{nome}{self._rotulos(chave)} {valor}")
+                    continue
+                baldes, soma, n = valor
+                acumulado = 0
+                for limite, contagem in zip(familia["limites"] + (float('inf'),), baldes):
+                    acumulado += contagem
+                    le = "+Inf" if limite == float('inf') else repr(float(limite))
+                    linhas.append(f"{nome}_bucket{self._rotulos(chave + (('le', le),))} {acumulado}")
+                linhas.append(f"{nome}_sum{self._rotulos(chave)} {soma}")
+                linhas.append(f"{nome}_count{self._rotulos(chave)} {n}")
+        for prefixo, ajuda, func in self._medidores:
+            try:
+                dados = func()
+            except Exception as e:
+                print(f"⚠️ [MÉTRICAS] Medidor '{prefixo}' falhou: {e}")
+                continue
+            for chave, valor in sorted((dados or {}).items()):
+                if chave == "pid" or not isinstance(valor, (int, float)):
+                    continue  # bool é int: vira 0/1 (ex.: listener_online)
+                nome = "suagrafica_" + re.sub(r'[^a-zA-Z0-9_]', '_', f"{prefixo}_{chave}")
+                linhas.append(f"# HELP {nome} {ajuda} ({chave})")
+                linhas.append(f"# TYPE {nome} gauge")
+                linhas.append(f"{nome} {int(valor) if isinstance(valor, bool) else valor}")
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas()
+metricas.definir("suagrafica_http_requisicoes_total", "counter", "Requisições atendidas por rota, método e status.")
+metricas.definir("suagrafica_http_requisicao_segundos", "histogram",
+                 "Duração da requisição até o fim do corpo (inclui streaming).", LIMITES_HTTP)
+metricas.definir("suagrafica_http_db_segundos", "histogram", "Tempo em consultas SQL por requisição.", LIMITES_HTTP)
+metricas.definir("suagrafica_http_consultas_total", "counter", "Consultas SQL executadas, por rota e método.")
+metricas.definir("suagrafica_http_linhas_total", "counter", "Linhas retornadas/afetadas (rowcount) pelas consultas, por rota e método.")
+metricas.definir("suagrafica_db_consulta_segundos", "histogram", "Duração de cada consulta SQL (execute).", LIMITES_DB)
+metricas.definir("suagrafica_db_checkout_segundos", "histogram", "Espera para obter uma conexão do pool.", LIMITES_DB)
+metricas.definir("suagrafica_gemini_segundos", "histogram",
+                 "Chamadas ao Gemini (inclui fila do pool), por etapa (decisao/resposta), modo e resultado.", LIMITES_GEMINI)
+metricas.definir("suagrafica_gemini_primeiro_pedaco_segundos", "histogram",
+                 "Tempo até o primeiro pedaço nas chamadas em stream, por etapa.", LIMITES_GEMINI)
+
+
+class MedidasRequisicao:
+    """Acumulador da requisição atual (um por requisição, via ContextVar)."""
+
+    __slots__ = ("inicio", "db", "consultas", "linhas", "checkout", "gemini", "mais_lenta", "mais_lenta_s", "finalizada")
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.finalizada = False
+        self.db = self.checkout = self.gemini = self.mais_lenta_s = 0.0
+        self.consultas = self.linhas = 0
+        self.mais_lenta = None
+
+
+_medidas_requisicao = contextvars.ContextVar("medidas_requisicao", default=None)
+
+
+class CursorInstrumentado:
+    """Mixin de cursor: mede execute/executemany/copy_expert e soma na requisição atual."""
+
+    def _medir(self, metodo, sql, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return metodo(sql, *args, **kwargs)
+        finally:
+            duracao = time.perf_counter() - inicio
+            metricas.observar("suagrafica_db_consulta_segundos", duracao)
+            medidas = _medidas_requisicao.get()
+            if medidas is not None:
+                medidas.db += duracao
+                medidas.consultas += 1
+                if self.rowcount > 0: medidas.linhas += self.rowcount
+                if duracao > medidas.mais_lenta_s:
+                    medidas.mais_lenta_s, medidas.mais_lenta = duracao, sql
+
+    def execute(self, sql, vars=None):
+        return self._medir(super().execute, sql, vars)
+
+    def executemany(self, sql, vars_list):
+        return self._medir(super().executemany, sql, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._medir(super().copy_expert, sql, file, size)
+
+
+_cursores_instrumentados = {}
+
+
+def cursor_instrumentado(fabrica):
+    """Subclasse instrumentada (em cache) de uma cursor_factory qualquer."""
+    classe = _cursores_instrumentados.get(fabrica)
+    if classe is None:
+        classe = _cursores_instrumentados[fabrica] = type(
+            f"{fabrica.__name__}Instrumentado", (CursorInstrumentado, fabrica), {})
+    return classe
+
+
+class ConexaoInstrumentada(psycopg2.extensions.connection):
+    """Conexão do pool: todo cursor aberto nela sai instrumentado (RealDictCursor, nomeado etc.)."""
+
+    def cursor(self, *args, **kwargs):
+        fabrica = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = cursor_instrumentado(fabrica)
+        return super().cursor(*args, **kwargs)
+
+
+def registrar_gemini(etapa, modo, resultado, segundos):
+    metricas.observar("suagrafica_gemini_segundos", segundos, etapa=etapa, modo=modo, resultado=resultado)
+    medidas = _medidas_requisicao.get()
+    if medidas is not None:
+        medidas.gemini += segundos
+
+
+def rota_da_requisicao():
+    # A regra (ex.: /api/admin/pedidos/<int:id>), nunca o caminho cru: cardinalidade limitada
+    return request.url_rule.rule if request.url_rule else "(sem_rota)"
+
+
+@app.before_request
+def iniciar_medidas():
+    _medidas_requisicao.set(MedidasRequisicao())
+
+
+@app.after_request
+def agendar_fim_medidas(response):
+    medidas = _medidas_requisicao.get()
+    if medidas is None: return response
+    rota, metodo, status = rota_da_requisicao(), request.method, response.status_code
+    # call_on_close roda depois do último byte: respostas em streaming entram com a duração real
+    response.call_on_close(lambda: finalizar_medidas(medidas, rota, metodo, status))
+    return response
+
+
+def finalizar_medidas(medidas, rota, metodo, status):
+    if medidas.finalizada: return  # close() chamado duas vezes pelo servidor
+    medidas.finalizada = True
+    duracao = time.perf_counter() - medidas.inicio
+    metricas.somar("suagrafica_http_requisicoes_total", rota=rota, metodo=metodo, status=status)
+    metricas.observar("suagrafica_http_requisicao_segundos", duracao, rota=rota, metodo=metodo)
+    if medidas.consultas:
+        metricas.observar("suagrafica_http_db_segundos", medidas.db, rota=rota, metodo=metodo)
+        metricas.somar("suagrafica_http_consultas_total", medidas.consultas, rota=rota, metodo=metodo)
+        metricas.somar("suagrafica_http_linhas_total", medidas.linhas, rota=rota, metodo=metodo)
+
+    limites = LENTO_LIMITES_ROTA.get(rota, {})
+    limite_ms = limites.get("ms", LENTO_LIMITE_MS)
+    limite_db_ms = limites.get("db_ms", LENTO_DB_LIMITE_MS)
+    limite_consultas = limites.get("consultas", LENTO_CONSULTAS_LIMITE)
+    motivos = [motivo for motivo, valor, limite in (
+        ("tempo", duracao * 1000, limite_ms),
+        ("db", medidas.db * 1000, limite_db_ms),
+        ("consultas", medidas.consultas, limite_consultas),
+    ) if limite and valor > limite]
+    if motivos:
+        print(json.dumps({
+            "evento": "requisicao_lenta", "motivos": motivos, "rota": rota, "metodo": metodo, "status": status,
+            "ms": round(duracao * 1000, 1), "db_ms": round(medidas.db * 1000, 1), "consultas": medidas.consultas,
+            "linhas": medidas.linhas, "checkout_ms": round(medidas.checkout * 1000, 1),
+            "gemini_ms": round(medidas.gemini * 1000, 1), "pid": os.getpid(),
+            "consulta_mais_lenta_ms": round(medidas.mais_lenta_s * 1000, 1),
+            "consulta_mais_lenta": ' '.join(str(medidas.mais_lenta).split())[:200] if medidas.mais_lenta else None,
+        }, ensure_ascii=False), flush=True)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+            return jsonify({"erro": "Não autorizado"}), 403
+    elif not check_auth(request):
+        return jsonify({"erro": "Não autorizado"}), 403
+    return Response(metricas.renderizar(), mimetype='text/plain; version=0.0.4')
+
+
+metricas.medidor("db_pool", "Estado do pool de conexões do processo",
+                 lambda: get_db_pool().stats() if _db_pool is not None else {})
+
+
+# --- LISTEN/NOTIFY (UM LISTENER POR PROCESSO) ---
+class PgListener:
+    """Conexão dedicada (fora do pool) que faz LISTEN e despacha NOTIFYs para callbacks.
+
+    Enquanto a conexão estiver caída `online` fica False: quem depende das
+    notificações (ex.: caches) deve deixar de confiar no estado local.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pid = os.getpid()
+        self.online = False
+        self._callbacks = {}  # canal -> [callback(payload)]
+        self._ao_reconectar = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reiniciar = False
+        # registrar() acorda o select() por aqui, sem esperar o keepalive de 5s
+        self._despertar_r, self._despertar_w = os.pipe()
+        os.set_blocking(self._despertar_r, False)
+
+    def registrar(self, canal, callback, ao_reconectar=None):
+        with self._lock:
+            novo_canal = canal not in self._callbacks
+            self._callbacks.setdefault(canal, []).append(callback)
+            if ao_reconectar:
+                self._ao_reconectar.append(ao_reconectar)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="pg-listener", daemon=True)
+                self._thread.start()
+                return
+            # Thread já rodando: reconecta para incluir o canal novo no LISTEN
+            if novo_canal:
+                self._reiniciar = True
+                os.write(self._despertar_w, b'1')
+
+    def _loop(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, connect_timeout=DB_CONNECT_TIMEOUT)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                with self._lock:
+                    # Zera antes de ler os canais: um registrar() daqui em diante pede outra volta
+                    self._reiniciar = False
+                    canais = list(self._callbacks)
+                    ao_reconectar = list(self._ao_reconectar)
+                for canal in canais:
+                    cur.execute(f'LISTEN "{canal}"')
+                self.online = True
+                # Notificações perdidas enquanto estávamos offline: quem depende delas se resincroniza
+                for cb in ao_reconectar:
+                    cb()
+                while not self._reiniciar:
+                    prontos = select.select([conn, self._despertar_r], [], [], 5)[0]
+                    if not prontos:
+                        cur.execute("SELECT 1")  # keepalive
+                        continue
+                    if self._despertar_r in prontos:
+                        try:
+                            os.read(self._despertar_r, 64)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        with self._lock:
+                            callbacks = list(self._callbacks.get(n.channel, []))
+                        for cb in callbacks:
+                            try:
+                                cb(n.payload)
+                            except Exception:
+                                traceback.print_exc()
+            except Exception as e:
+                print(f"🔴 [LISTEN] Conexão perdida: {e}")
+                time.sleep(5)
+            finally:
+                self.online = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+
+_pg_listener = None
+
+
+def get_pg_listener():
+    """Listener do processo atual (recriado após fork, como o pool)."""
+    global _pg_listener
+    with _db_pool_lock:
+        if _pg_listener is None or _pg_listener.pid != os.getpid():
+            _pg_listener = PgListener(DATABASE_URL)
+        return _pg_listener
+
+
+# --- VERSÕES DE TABELA / GET CONDICIONAL (ETAG) ---
+# Triggers por statement (ver setup_database) incrementam um contador por
+# tabela em suagrafica_versoes e fazem NOTIFY no canal abaixo com
+# "tabela:versao". Por ser uma UPDATE transacional, a versão nova só fica
+# visível junto com os dados que a geraram: o ETag nunca aponta para dados velhos.
+VERSOES_CANAL = "suagrafica_versoes"
+
+
+def versoes_tabelas(cur, *tabelas):
+    """Lê a versão atual de cada tabela (lookup por PK, bem mais barato que a listagem)."""
+    vcur = cur.connection.cursor()  # cursor de tuplas, mesmo que `cur` seja RealDictCursor
+    vcur.execute("SELECT tabela, versao FROM suagrafica_versoes WHERE tabela = ANY(%s)", (list(tabelas),))
+    versoes = {t: 0 for t in tabelas}
+    for tabela, versao in vcur.fetchall():
+        versoes[tabela] = versao
+    vcur.close()
+    return [versoes[t] for t in tabelas]
+
+
+def montar_etag(nome, *partes):
+    return '"' + '-'.join([nome] + [str(p) for p in partes]) + '"'
+
+
+def etag_confere(etag):
+    """True se o cliente mandou If-None-Match com esse ETag (ou '*')."""
+    return request.if_none_match.contains_raw(etag) or request.if_none_match.star_tag
+
+
+def nao_modificado(etag):
+    resp = Response(status=304)
+    return com_etag(resp, etag)
+
+
+def com_etag(resp, etag):
+    resp.headers['ETag'] = etag
+    # Dados autenticados: o navegador pode guardar, mas sempre revalida
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Authorization')
+    return resp
+
+# --- SERIALIZAÇÃO JSON ---
+# Todas as respostas JSON passam por json_bytes(): orjson quando instalado,
+# json da stdlib como fallback. Datas saem em ISO-8601 nos dois casos.
+# Listagens grandes usam resposta_json_stream(), que lê o cursor de tuplas em
+# lotes e já escreve os bytes, sem montar a lista inteira de dicts na memória.
+STREAM_LOTE = int(os.environ.get("STREAM_LOTE", 1000))
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return DefaultJSONProvider.default(obj)
+
+
+if orjson is not None:
+    def json_bytes(obj):
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def json_bytes(obj):
+        return json.dumps(obj, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class PortalJSONProvider(DefaultJSONProvider):
+    """jsonify()/request.json do Flask usando json_bytes()."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:  # opções específicas (indent, sort_keys...): deixa com a stdlib
+            kwargs.setdefault("default", _json_default)
+            return json.dumps(obj, **kwargs)
+        return json_bytes(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_bytes(obj), mimetype=self.mimetype)
+
+
+app.json = PortalJSONProvider(app)
+
+
+def linhas_json(cur, lote=STREAM_LOTE):
+    """Array JSON das linhas de um cursor de tuplas já executado, gerado em pedaços de `lote` linhas."""
+    colunas = [d[0] for d in cur.description]
+    yield b'['
+    primeiro = True
+    while True:
+        linhas = cur.fetchmany(lote)
+        if not linhas: break
+        if not primeiro: yield b','
+        # Serializa o lote como lista e tira os colchetes: um dumps por lote, não por linha
+        yield json_bytes([dict(zip(colunas, linha)) for linha in linhas])[1:-1]
+        primeiro = False
+    yield b']'
+
+
+def resposta_json_stream(sql, params=(), etag_de=None):
+    """
+    Executa `sql` e devolve as linhas como array JSON em streaming.
+    `etag_de(cur)`, se informado, calcula o ETag antes da consulta: com
+    If-None-Match batendo responde 304 sem rodar o SELECT. A conexão fica
+    emprestada até o servidor terminar de enviar o corpo.
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        etag = etag_de(cur) if etag_de else None
+        if etag and etag_confere(etag):
+            pool.putconn(conn)
+            return nao_modificado(etag)
+        cur.execute(sql, params)
+    except BaseException:
+        pool.putconn(conn, close=bool(conn.closed))
+        raise
+    resp = resposta_com_conexao(pool, conn, linhas_json(cur), mimetype='application/json')
+    return com_etag(resp, etag) if etag else resp
+
+
+def resposta_com_conexao(pool, conn, pedacos, **kwargs):
+    """Response em streaming de `pedacos` que devolve `conn` ao pool no fim do corpo (ou se o cliente desconectar)."""
+    devolvida = threading.Event()
+
+    def devolver():
+        if not devolvida.is_set():
+            devolvida.set()
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def corpo():
+        try:
+            yield from pedacos
+        finally:
+            devolver()  # fim do corpo: libera a conexão sem esperar o close() do servidor
+
+    resp = Response(corpo(), **kwargs)
+    resp.call_on_close(devolver)  # cliente desconectou antes do fim
+    return resp
 
 # ======================================================================
-# 1. SETUP (TABELAS)
+# 1. SETUP (TABELAS E MIGRAÇÕES)
 # ======================================================================
-def setup_database():
-    conn = get_db_connection()
-    if not conn: return
-    
-    SQL_COMMANDS = [
+# O schema é versionado: cada migração roda uma única vez e fica registrada
+# em suagrafica_schema_version. Rodar no deploy (não a cada start):
+#     flask --app app migrar
+# Colunas expostas de produto (a tabela também tem busca_tsv, que não vai para a API)
+PRODUTO_COLUNAS = "id, codigo_produto, nome_produto, descricao, preco_minimo, multiplos_de, estoque_disponivel, imagem_url, esta_ativo"
+PRODUTO_COLUNAS_P = ", ".join("p." + c for c in PRODUTO_COLUNAS.split(", "))
+TABELAS_VERSIONADAS = ['suagrafica_clientes', 'suagrafica_produtos', 'suagrafica_pedidos', 'suagrafica_pedido_itens']
+MIGRACOES_LOCK_ID = 48151623  # pg_advisory_lock: só um processo migra por vez
+
+
+def indice_concorrente(nome, definicao, unico=False):
+    """Passo de migração que cria um índice com CREATE INDEX CONCURRENTLY.
+
+    Um CONCURRENTLY que falha no meio deixa o índice INVALID; nesse caso ele é
+    removido e recriado, então o passo pode ser repetido com segurança.
+    """
+    def passo(cur):
+        cur.execute("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s
+        """, (nome,))
+        existente = cur.fetchone()
+        if existente and existente[0]:
+            return
+        if existente:
+            print(f"⚠️  [DB] Índice {nome} inválido, recriando...")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}")
+        cur.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX CONCURRENTLY IF NOT EXISTS {nome} {definicao}")
+    return passo
+
+
+def extensao_opcional(nome):
+    """Passo que tenta CREATE EXTENSION; sem a extensão (ou sem permissão) apenas avisa."""
+    def passo(cur):
+        cur.execute(f"SAVEPOINT ext_{nome}")
+        try:
+            cur.execute(f"CREATE EXTENSION IF NOT EXISTS {nome}")
+            cur.execute(f"RELEASE SAVEPOINT ext_{nome}")
+        except psycopg2.Error as e:
+            cur.execute(f"ROLLBACK TO SAVEPOINT ext_{nome}")
+            motivo = (e.pgerror or str(e)).strip().splitlines()[0]
+            print(f"⚠️  [DB] Extensão {nome} indisponível ({motivo}). Seguindo sem ela.")
+    return passo
+
+
+def extensao_instalada(cur, nome):
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = %s", (nome,))
+    return cur.fetchone() is not None
+
+
+def se_extensao(nome, passo_original):
+    """Executa o passo apenas se a extensão estiver instalada."""
+    def passo(cur):
+        if extensao_instalada(cur, nome):
+            passo_original(cur)
+    return passo
+
+
+def _normaliza_com_unaccent(cur):
+    # unaccent() é STABLE; o wrapper com dicionário explícito pode ser IMMUTABLE
+    cur.execute("""
+        SELECT n.nspname FROM pg_extension e
+        JOIN pg_namespace n ON n.oid = e.extnamespace
+        WHERE e.extname = 'unaccent'
+    """)
+    row = cur.fetchone()
+    if not row:
+        return
+    schema = row[0]
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION suagrafica_normaliza(texto TEXT) RETURNS TEXT AS $$
+            SELECT lower({schema}.unaccent('{schema}.unaccent'::regdictionary, coalesce(texto, '')));
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+    """)
+
+
+# --- ESTATÍSTICAS DO PAINEL (tabelas-resumo mantidas por trigger) ---
+# Triggers por comando, com transition tables: um INSERT de 500 pedidos
+# atualiza cada linha de resumo uma vez só. As linhas de resumo com delta
+# zero não são tocadas (ex.: UPDATE só do link de pagamento). Receita exclui
+# pedidos 'Cancelado'. TRUNCATE não passa pelos triggers: depois de um,
+# rodar `flask --app app estatisticas-reconstruir`.
+STATUS_PEDIDO_CANCELADO = 'Cancelado'
+STATUS_PEDIDOS_ABERTOS = ('Aguardando Aprovação', 'Aguardando Pagamento')
+
+ESTATISTICAS_TABELAS = [
+    """
+    CREATE TABLE IF NOT EXISTS suagrafica_stats_contadores (
+        chave VARCHAR(63) PRIMARY KEY,
+        valor BIGINT NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS suagrafica_stats_status (
+        status_pedido VARCHAR(50) PRIMARY KEY,
+        pedidos BIGINT NOT NULL DEFAULT 0,
+        valor NUMERIC(16, 2) NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS suagrafica_stats_receita_dia (
+        dia DATE PRIMARY KEY,
+        pedidos BIGINT NOT NULL DEFAULT 0,
+        valor NUMERIC(16, 2) NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS suagrafica_stats_produtos (
+        produto_id INTEGER PRIMARY KEY,
+        quantidade BIGINT NOT NULL DEFAULT 0,
+        receita NUMERIC(16, 2) NOT NULL DEFAULT 0,
+        itens BIGINT NOT NULL DEFAULT 0
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_stats_produtos_quantidade ON suagrafica_stats_produtos (quantidade DESC);",
+]
+
+# Aplicação dos deltas; as linhas vêm ordenadas pela chave para dois
+# commits concorrentes travarem as linhas de resumo na mesma ordem.
+ESTATISTICAS_FUNCOES = [
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_contador(p_chave TEXT, p_delta BIGINT) RETURNS void AS $$
+        INSERT INTO suagrafica_stats_contadores AS c (chave, valor) SELECT p_chave, p_delta WHERE p_delta <> 0
+        ON CONFLICT (chave) DO UPDATE SET valor = c.valor + EXCLUDED.valor;
+    $$ LANGUAGE sql;
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION suagrafica_stats_aplicar_pedidos(p_status TEXT[], p_dia DATE[], p_sinal INT[], p_valor NUMERIC[])
+    RETURNS void AS $$
+        INSERT INTO suagrafica_stats_status AS s (status_pedido, pedidos, valor)
+        SELECT status, sum(sinal), sum(sinal * valor)
+        FROM unnest(p_status, p_sinal, p_valor) AS d(status, sinal, valor)
+        GROUP BY status HAVING sum(sinal) <> 0 OR sum(sinal * valor) <> 0
+        ORDER BY status
+        ON CONFLICT (status_pedido) DO UPDATE SET pedidos = s.pedidos + EXCLUDED.pedidos, valor = s.valor + EXCLUDED.valor;
+
+        INSERT INTO suagrafica_stats_receita_dia AS r (dia, pedidos, valor)
+        SELECT dia, sum(sinal), sum(sinal * valor)
+        FROM unnest(p_status, p_dia, p_sinal, p_valor) AS d(status, dia, sinal, valor)
+        WHERE dia IS NOT NULL AND status <> '{STATUS_PEDIDO_CANCELADO}'
+        GROUP BY dia HAVING sum(sinal) <> 0 OR sum(sinal * valor) <> 0
+        ORDER BY dia
+        ON CONFLICT (dia) DO UPDATE SET pedidos = r.pedidos + EXCLUDED.pedidos, valor = r.valor + EXCLUDED.valor;
+    $$ LANGUAGE sql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_aplicar_itens(p_produto INT[], p_sinal INT[], p_quantidade INT[], p_preco NUMERIC[])
+    RETURNS void AS $$
+        INSERT INTO suagrafica_stats_produtos AS p (produto_id, quantidade, receita, itens)
+        SELECT produto, sum(sinal * quantidade), sum(sinal * quantidade * preco), sum(sinal)
+        FROM unnest(p_produto, p_sinal, p_quantidade, p_preco) AS d(produto, sinal, quantidade, preco)
+        WHERE produto IS NOT NULL
+        GROUP BY produto HAVING sum(sinal) <> 0 OR sum(sinal * quantidade) <> 0 OR sum(sinal * quantidade * preco) <> 0
+        ORDER BY produto
+        ON CONFLICT (produto_id) DO UPDATE
+            SET quantidade = p.quantidade + EXCLUDED.quantidade, receita = p.receita + EXCLUDED.receita, itens = p.itens + EXCLUDED.itens;
+    $$ LANGUAGE sql;
+    """,
+    # plpgsql só planeja a consulta do ramo executado: 'antigos'/'novos' só existem no evento certo
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_trg_clientes() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM suagrafica_stats_contador('clientes_ativos', count(*)) FROM novos WHERE status_acesso = 'Ativo';
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM suagrafica_stats_contador('clientes_ativos', -count(*)) FROM antigos WHERE status_acesso = 'Ativo';
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_trg_produtos() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM suagrafica_stats_contador('produtos_ativos', count(*)) FROM novos WHERE esta_ativo;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM suagrafica_stats_contador('produtos_ativos', -count(*)) FROM antigos WHERE esta_ativo;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_trg_pedidos() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM suagrafica_stats_aplicar_pedidos(array_agg(coalesce(status_pedido, '')), array_agg(data_criacao::date),
+                                                     array_agg(1), array_agg(valor_total)) FROM novos;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM suagrafica_stats_aplicar_pedidos(array_agg(coalesce(status_pedido, '')), array_agg(data_criacao::date),
+                                                     array_agg(-1), array_agg(valor_total)) FROM antigos;
+        ELSE
+            PERFORM suagrafica_stats_aplicar_pedidos(array_agg(coalesce(status_pedido, '')), array_agg(dia), array_agg(sinal), array_agg(valor_total))
+            FROM (SELECT status_pedido, data_criacao::date AS dia, 1 AS sinal, valor_total FROM novos
+                  UNION ALL
+                  SELECT status_pedido, data_criacao::date, -1, valor_total FROM antigos) d;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION suagrafica_stats_trg_pedido_itens() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM suagrafica_stats_aplicar_itens(array_agg(produto_id), array_agg(1), array_agg(quantidade),
+                                                   array_agg(preco_unitario_registrado)) FROM novos;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM suagrafica_stats_aplicar_itens(array_agg(produto_id), array_agg(-1), array_agg(quantidade),
+                                                   array_agg(preco_unitario_registrado)) FROM antigos;
+        ELSE
+            PERFORM suagrafica_stats_aplicar_itens(array_agg(produto_id), array_agg(sinal), array_agg(quantidade), array_agg(preco_unitario_registrado))
+            FROM (SELECT produto_id, 1 AS sinal, quantidade, preco_unitario_registrado FROM novos
+                  UNION ALL
+                  SELECT produto_id, -1, quantidade, preco_unitario_registrado FROM antigos) d;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+]
+
+ESTATISTICAS_TRIGGERS = [sql for tabela in TABELAS_VERSIONADAS for sql in (
+    f"DROP TRIGGER IF EXISTS trg_{tabela}_stats_ins ON {tabela};",
+    f"DROP TRIGGER IF EXISTS trg_{tabela}_stats_upd ON {tabela};",
+    f"DROP TRIGGER IF EXISTS trg_{tabela}_stats_del ON {tabela};",
+    f"""CREATE TRIGGER trg_{tabela}_stats_ins AFTER INSERT ON {tabela}
+        REFERENCING NEW TABLE AS novos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_stats_trg_{tabela[len('suagrafica_'):]}();""",
+    f"""CREATE TRIGGER trg_{tabela}_stats_upd AFTER UPDATE ON {tabela}
+        REFERENCING OLD TABLE AS antigos NEW TABLE AS novos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_stats_trg_{tabela[len('suagrafica_'):]}();""",
+    f"""CREATE TRIGGER trg_{tabela}_stats_del AFTER DELETE ON {tabela}
+        REFERENCING OLD TABLE AS antigos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_stats_trg_{tabela[len('suagrafica_'):]}();""",
+)]
+
+# Mesmas agregações dos triggers, calculadas do zero (backfill, reconstrução e verificação)
+ESTATISTICAS_AO_VIVO = {
+    "suagrafica_stats_contadores": ("chave", """
+        SELECT 'clientes_ativos'::text AS chave, count(*)::bigint AS valor FROM suagrafica_clientes WHERE status_acesso = 'Ativo'
+        UNION ALL
+        SELECT 'produtos_ativos', count(*) FROM suagrafica_produtos WHERE esta_ativo
+    """),
+    "suagrafica_stats_status": ("status_pedido", """
+        SELECT coalesce(status_pedido, '') AS status_pedido, count(*)::bigint AS pedidos, coalesce(sum(valor_total), 0) AS valor
+        FROM suagrafica_pedidos GROUP BY 1
+    """),
+    "suagrafica_stats_receita_dia": ("dia", f"""
+        SELECT data_criacao::date AS dia, count(*)::bigint AS pedidos, coalesce(sum(valor_total), 0) AS valor
+        FROM suagrafica_pedidos
+        WHERE data_criacao IS NOT NULL AND coalesce(status_pedido, '') <> '{STATUS_PEDIDO_CANCELADO}'
+        GROUP BY 1
+    """),
+    "suagrafica_stats_produtos": ("produto_id", """
+        SELECT produto_id, sum(quantidade)::bigint AS quantidade, coalesce(sum(quantidade * preco_unitario_registrado), 0) AS receita,
+               count(*)::bigint AS itens
+        FROM suagrafica_pedido_itens WHERE produto_id IS NOT NULL GROUP BY 1
+    """),
+}
+ESTATISTICAS_RECONSTRUIR = [
+    # SHARE: leituras seguem normais, escritas nas tabelas de origem esperam a reconstrução
+    f"LOCK TABLE {', '.join(TABELAS_VERSIONADAS)} IN SHARE MODE;",
+] + [sql for tabela, (_, consulta) in ESTATISTICAS_AO_VIVO.items() for sql in (
+    f"DELETE FROM {tabela};",
+    f"INSERT INTO {tabela} {consulta};",
+)]
+
+
+# (versao, nome, transacional, passos). Passos são SQL ou funções f(cur).
+# Migrações não transacionais rodam em autocommit (necessário para CONCURRENTLY).
+MIGRACOES = [
+    (1, "schema inicial", True, [
         """
         CREATE TABLE IF NOT EXISTS suagrafica_admin (
             id SERIAL PRIMARY KEY,
@@ -100,81 +1120,678 @@ def setup_database():
             quantidade INTEGER NOT NULL,
             preco_unitario_registrado DECIMAL(10, 2) NOT NULL
         );
+        """,
+        # Contador de versão por tabela (ETag e invalidação do cache do catálogo)
+        """
+        CREATE TABLE IF NOT EXISTS suagrafica_versoes (
+            tabela VARCHAR(63) PRIMARY KEY,
+            versao BIGINT NOT NULL DEFAULT 0
+        );
+        """,
         """
-    ]
-    
+        CREATE OR REPLACE FUNCTION suagrafica_incrementa_versao() RETURNS trigger AS $$
+        DECLARE
+            nova_versao BIGINT;
+        BEGIN
+            UPDATE suagrafica_versoes SET versao = versao + 1
+            WHERE tabela = TG_TABLE_NAME
+            RETURNING versao INTO nova_versao;
+            PERFORM pg_notify('suagrafica_versoes', TG_TABLE_NAME || ':' || nova_versao);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+    ] + [sql for tabela in TABELAS_VERSIONADAS for sql in (
+        f"INSERT INTO suagrafica_versoes (tabela) VALUES ('{tabela}') ON CONFLICT DO NOTHING;",
+        f"DROP TRIGGER IF EXISTS trg_{tabela}_versao ON {tabela};",
+        f"""
+        CREATE TRIGGER trg_{tabela}_versao
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {tabela}
+        FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_incrementa_versao();
+        """,
+    )]),
+    (2, "índices de pedidos, itens e login", False, [
+        # Listagem paginada de pedidos (filtro + ordem keyset). Os compostos também
+        # cobrem buscas só por cliente_id, status_pedido ou data_criacao.
+        indice_concorrente("idx_pedidos_data_id", "ON suagrafica_pedidos (data_criacao DESC, id DESC)"),
+        indice_concorrente("idx_pedidos_status_data_id", "ON suagrafica_pedidos (status_pedido, data_criacao DESC, id DESC)"),
+        indice_concorrente("idx_pedidos_cliente_data_id", "ON suagrafica_pedidos (cliente_id, data_criacao DESC, id DESC)"),
+        # Itens por pedido (detalhe) e por produto (ON DELETE SET NULL ao excluir produto)
+        indice_concorrente("idx_pedido_itens_pedido", "ON suagrafica_pedido_itens (pedido_id)"),
+        indice_concorrente("idx_pedido_itens_produto", "ON suagrafica_pedido_itens (produto_id)"),
+        # login_admin busca por LOWER(username)
+        indice_concorrente("idx_admin_username_lower", "ON suagrafica_admin (LOWER(username))"),
+    ]),
+    (3, "busca de produtos (unaccent, tsvector e pg_trgm)", True, [
+        # Normalização imutável (minúsculas, sem acento), usável em índices.
+        # Começa com translate(); se a extensão unaccent existir, passa a usá-la.
+        """
+        CREATE OR REPLACE FUNCTION suagrafica_normaliza(texto TEXT) RETURNS TEXT AS $$
+            SELECT lower(translate(coalesce(texto, ''),
+                'áàâãäåéèêëíìîïóòôõöúùûüçñÁÀÂÃÄÅÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇÑ',
+                'aaaaaaeeeeiiiiooooouuuucnaaaaaaeeeeiiiiooooouuuucn'));
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+        """,
+        extensao_opcional("unaccent"),
+        extensao_opcional("pg_trgm"),
+        _normaliza_com_unaccent,
+        """
+        CREATE OR REPLACE FUNCTION suagrafica_produto_tsv(nome TEXT, codigo TEXT, descricao TEXT) RETURNS tsvector AS $$
+            SELECT setweight(to_tsvector('portuguese', suagrafica_normaliza(nome)), 'A')
+                || setweight(to_tsvector('simple', suagrafica_normaliza(codigo)), 'A')
+                || setweight(to_tsvector('portuguese', suagrafica_normaliza(descricao)), 'B');
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+        """,
+        "ALTER TABLE suagrafica_produtos ADD COLUMN IF NOT EXISTS busca_tsv tsvector;",
+        """
+        CREATE OR REPLACE FUNCTION suagrafica_produtos_atualiza_tsv() RETURNS trigger AS $$
+        BEGIN
+            NEW.busca_tsv := suagrafica_produto_tsv(NEW.nome_produto, NEW.codigo_produto, NEW.descricao);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS trg_produtos_busca_tsv ON suagrafica_produtos;",
+        """
+        CREATE TRIGGER trg_produtos_busca_tsv
+        BEFORE INSERT OR UPDATE OF nome_produto, codigo_produto, descricao ON suagrafica_produtos
+        FOR EACH ROW EXECUTE FUNCTION suagrafica_produtos_atualiza_tsv();
+        """,
+        "UPDATE suagrafica_produtos SET busca_tsv = suagrafica_produto_tsv(nome_produto, codigo_produto, descricao);",
+    ]),
+    (4, "índices da busca de produtos", False, [
+        indice_concorrente("idx_produtos_busca_tsv", "ON suagrafica_produtos USING gin (busca_tsv)"),
+        # Busca por trecho/erro de digitação no nome (só se pg_trgm estiver instalado)
+        se_extensao("pg_trgm", indice_concorrente(
+            "idx_produtos_nome_trgm", "ON suagrafica_produtos USING gin (suagrafica_normaliza(nome_produto) gin_trgm_ops)")),
+    ]),
+    (5, "sessões de admin compartilhadas entre workers", True, [
+        """
+        CREATE TABLE IF NOT EXISTS suagrafica_sessoes (
+            token_hash CHAR(64) PRIMARY KEY,
+            admin_id INTEGER NOT NULL REFERENCES suagrafica_admin(id) ON DELETE CASCADE,
+            criada_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expira_em TIMESTAMP NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_expira ON suagrafica_sessoes (expira_em);",
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_admin ON suagrafica_sessoes (admin_id);",
+    ]),
+    (6, "chaves de idempotência da criação de pedidos", True, [
+        """
+        CREATE TABLE IF NOT EXISTS suagrafica_idempotencia (
+            escopo VARCHAR(40) NOT NULL,
+            chave VARCHAR(255) NOT NULL,
+            hash_corpo CHAR(64) NOT NULL,
+            status SMALLINT,
+            resposta JSONB,
+            criada_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (escopo, chave)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_idempotencia_criada ON suagrafica_idempotencia (criada_em);",
+    ]),
+    (7, "estatísticas do painel mantidas por trigger", True,
+        ESTATISTICAS_TABELAS + ESTATISTICAS_FUNCOES + ESTATISTICAS_TRIGGERS + ESTATISTICAS_RECONSTRUIR),
+    (8, "eventos de pedidos (NOTIFY para o SSE)", True, [
+        # Um NOTIFY por pedido; alterações que não mudam o que as telas mostram não geram evento
+        """
+        CREATE OR REPLACE FUNCTION suagrafica_pedidos_eventos() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('suagrafica_pedidos_eventos',
+                                  json_build_object('op', 'DELETE', 'id', a.id, 'cliente_id', a.cliente_id)::text)
+                FROM antigos a;
+            ELSIF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('suagrafica_pedidos_eventos', json_build_object(
+                    'op', 'INSERT', 'id', n.id, 'cliente_id', n.cliente_id, 'nome_cliente', c.nome_cliente,
+                    'valor_total', n.valor_total, 'status_pedido', n.status_pedido,
+                    'link_pagamento', n.link_pagamento, 'data_criacao', n.data_criacao)::text)
+                FROM novos n LEFT JOIN suagrafica_clientes c ON c.id = n.cliente_id;
+            ELSE
+                PERFORM pg_notify('suagrafica_pedidos_eventos', json_build_object(
+                    'op', 'UPDATE', 'id', n.id, 'cliente_id', n.cliente_id, 'nome_cliente', c.nome_cliente,
+                    'valor_total', n.valor_total, 'status_pedido', n.status_pedido,
+                    'link_pagamento', n.link_pagamento, 'data_criacao', n.data_criacao)::text)
+                FROM novos n
+                JOIN antigos a ON a.id = n.id
+                LEFT JOIN suagrafica_clientes c ON c.id = n.cliente_id
+                WHERE (a.status_pedido, a.valor_total, a.link_pagamento, a.cliente_id)
+                      IS DISTINCT FROM (n.status_pedido, n.valor_total, n.link_pagamento, n.cliente_id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS trg_suagrafica_pedidos_eventos_ins ON suagrafica_pedidos;",
+        "DROP TRIGGER IF EXISTS trg_suagrafica_pedidos_eventos_upd ON suagrafica_pedidos;",
+        "DROP TRIGGER IF EXISTS trg_suagrafica_pedidos_eventos_del ON suagrafica_pedidos;",
+        """CREATE TRIGGER trg_suagrafica_pedidos_eventos_ins AFTER INSERT ON suagrafica_pedidos
+           REFERENCING NEW TABLE AS novos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_pedidos_eventos();""",
+        """CREATE TRIGGER trg_suagrafica_pedidos_eventos_upd AFTER UPDATE ON suagrafica_pedidos
+           REFERENCING OLD TABLE AS antigos NEW TABLE AS novos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_pedidos_eventos();""",
+        """CREATE TRIGGER trg_suagrafica_pedidos_eventos_del AFTER DELETE ON suagrafica_pedidos
+           REFERENCING OLD TABLE AS antigos FOR EACH STATEMENT EXECUTE FUNCTION suagrafica_pedidos_eventos();""",
+    ]),
+    (9, "imagens de produtos (versões por conteúdo)", True, [
+        # hash = sha256 da original; larguras = versões geradas (em ordem crescente)
+        """
+        CREATE TABLE IF NOT EXISTS suagrafica_imagens (
+            hash CHAR(64) PRIMARY KEY,
+            origem TEXT,
+            largura INTEGER NOT NULL,
+            altura INTEGER NOT NULL,
+            larguras INTEGER[] NOT NULL,
+            criada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_imagens_origem ON suagrafica_imagens (origem);",
+        # imagem_origem = imagem_url já processado (diferente = pendente)
+        "ALTER TABLE suagrafica_produtos ADD COLUMN IF NOT EXISTS imagem_hash CHAR(64) REFERENCES suagrafica_imagens(hash) ON DELETE SET NULL;",
+        "ALTER TABLE suagrafica_produtos ADD COLUMN IF NOT EXISTS imagem_origem VARCHAR(255);",
+    ]),
+    (10, "configuração compartilhada (segredo dos tokens de cliente)", True, [
+        """
+        CREATE TABLE IF NOT EXISTS suagrafica_config (
+            chave VARCHAR(100) PRIMARY KEY,
+            valor TEXT NOT NULL,
+            criada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        lambda cur: _semear_segredo_cliente(cur),
+    ]),
+]
+
+
+def _garantir_tabela_versao(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS suagrafica_schema_version (
+            versao INTEGER PRIMARY KEY,
+            nome VARCHAR(255) NOT NULL,
+            aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cur.execute("SELECT versao FROM suagrafica_schema_version")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migracoes_pendentes():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('suagrafica_schema_version')")
+        if cur.fetchone()[0] is None:
+            return list(MIGRACOES)
+        cur.execute("SELECT versao FROM suagrafica_schema_version")
+        aplicadas = {row[0] for row in cur.fetchall()}
+    return [m for m in MIGRACOES if m[0] not in aplicadas]
+
+
+def aplicar_migracoes():
+    """Aplica, em ordem, as migrações ainda não registradas. Retorna quantas rodaram."""
+    # Conexão dedicada (fora do pool): autocommit e advisory lock de sessão
+    conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    aplicadas_agora = 0
     try:
         cur = conn.cursor()
-        print("ℹ️  [DB] Verificando tabelas...")
-        for cmd in SQL_COMMANDS:
-            cur.execute(cmd)
-        conn.commit()
-        print("✅ [DB] Tabelas OK.")
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRACOES_LOCK_ID,))
+        aplicadas = _garantir_tabela_versao(cur)
+        for versao, nome, transacional, passos in sorted(MIGRACOES, key=lambda m: m[0]):
+            if versao in aplicadas:
+                continue
+            print(f"ℹ️  [DB] Aplicando migração {versao:04d} ({nome})...")
+            inicio = time.monotonic()
+            if transacional:
+                cur.execute("BEGIN")
+            try:
+                for passo in passos:
+                    if callable(passo):
+                        passo(cur)
+                    else:
+                        cur.execute(passo)
+                cur.execute("INSERT INTO suagrafica_schema_version (versao, nome) VALUES (%s, %s)", (versao, nome))
+                if transacional:
+                    cur.execute("COMMIT")
+            except Exception:
+                if transacional:
+                    cur.execute("ROLLBACK")
+                raise
+            aplicadas_agora += 1
+            print(f"✅ [DB] Migração {versao:04d} aplicada em {time.monotonic() - inicio:.2f}s.")
+        if not aplicadas_agora:
+            print("✅ [DB] Schema já está na versão mais recente.")
+        return aplicadas_agora
+    finally:
+        try:
+            conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (MIGRACOES_LOCK_ID,))
+        finally:
+            conn.close()
+
+
+def setup_database():
+    """Mantido por compatibilidade: equivale a `flask --app app migrar`."""
+    try:
+        aplicar_migracoes()
     except Exception as e:
         print(f"🔴 ERRO NO SETUP: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
+
+
+@app.cli.command("migrar")
+def cli_migrar():
+    """Aplica as migrações pendentes do banco."""
+    aplicar_migracoes()
+
+
+@app.cli.command("migracoes")
+def cli_migracoes():
+    """Lista as migrações e se já foram aplicadas."""
+    pendentes = {m[0] for m in migracoes_pendentes()}
+    for versao, nome, _, _ in MIGRACOES:
+        print(f"{versao:04d}  {'PENDENTE' if versao in pendentes else 'aplicada'}  {nome}")
 
 # ======================================================================
 # 2. AUTENTICAÇÃO
 # ======================================================================
-def check_auth(request):
-    token = request.headers.get('Authorization')
-    if not token: return None
-    token = token.replace('Bearer ', '')
-    
-    # Aceita os tokens forçados para que o painel admin carregue
-    if token in ['FORCED_LEANDRO_TOKEN', 'FORCED_TESTE_TOKEN']:
-        conn = get_db_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM suagrafica_admin LIMIT 1")
-            admin = cur.fetchone()
-            return admin[0] if admin else 1
-        except:
-            return 1 
-        finally:
-            if conn: conn.close()
+# --- SESSÕES DE ADMIN ---
+# Tabela suagrafica_sessoes (migração 0005) compartilhada por todos os
+# workers, com um cache LRU local na frente: num hit a validação é um
+# sha256 + lookup no dict, sem ida ao banco. Expiração deslizante (cada uso
+# empurra o vencimento para agora + SESSAO_TTL); a renovação é gravada em
+# lote pela thread de manutenção, no máximo a cada SESSAO_RENOVAR_INTERVALO
+# por sessão, e a mesma thread apaga as vencidas. Logout e remoção de admin
+# fazem NOTIFY em SESSOES_CANAL para os outros workers tirarem do cache; com
+# o listener fora do ar, o cache local só vale por SESSAO_CACHE_TTL.
+SESSAO_TTL = int(os.environ.get("SESSAO_TTL", 8 * 3600))
+SESSAO_CACHE_MAX = int(os.environ.get("SESSAO_CACHE_MAX", 10000))
+SESSAO_CACHE_TTL = float(os.environ.get("SESSAO_CACHE_TTL", 30))
+SESSAO_RENOVAR_INTERVALO = float(os.environ.get("SESSAO_RENOVAR_INTERVALO", 300))
+SESSAO_MANUTENCAO_INTERVALO = float(os.environ.get("SESSAO_MANUTENCAO_INTERVALO", 30))
+SESSAO_PURGA_INTERVALO = float(os.environ.get("SESSAO_PURGA_INTERVALO", 600))
+SESSOES_CANAL = "suagrafica_sessoes"
+# Tokens fixos que o painel usa hoje (login forçado em clientes.html)
+TOKENS_FORCADOS = ('FORCED_LEANDRO_TOKEN', 'FORCED_TESTE_TOKEN')
 
-    return ADMIN_SESSIONS.get(token)
 
-def check_client_auth(request):
-    """ Verifica a presença do token do cliente. """
-    token = request.headers.get('Authorization')
-    if not token: 
-        return False
-    return True
+def hash_token(token):
+    """Só o hash do token vai para o banco: um dump da tabela não expõe sessões válidas."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
 
-@app.route('/api/admin/login', methods=['POST'])
-def login_admin():
-    data = request.json or {}
-    username = data.get('username', '').strip()
-    chave_admin = data.get('chave_admin', '').strip()
 
-    if not username or not chave_admin:
-        return jsonify({"erro": "Credenciais incompletas"}), 400
+class SessaoStore:
+    """Sessões de admin no Postgres com cache LRU read-through por processo."""
+
+    def __init__(self):
+        self.pid = None
+        self._lock = threading.Lock()
+        # token_hash -> [admin_id, expira_em (epoch), verificada_em (monotonic), gravada_em (monotonic)]
+        self._cache = OrderedDict()
+        self._pendentes = set()  # hashes com renovação a gravar no banco
+        self._ultima_purga = 0.0
+        self._stats = {"hits": 0, "misses": 0, "criadas": 0, "encerradas": 0, "renovacoes_gravadas": 0, "purgadas": 0}
+
+    def _garantir_processo(self):
+        if self.pid == os.getpid(): return
+        with self._lock:
+            if self.pid == os.getpid(): return
+            self.pid = os.getpid()
+            self._cache.clear()
+            self._pendentes.clear()
+        get_pg_listener().registrar(SESSOES_CANAL, self._on_notify, ao_reconectar=self._limpar_cache)
+        threading.Thread(target=self._manutencao, name="sessoes-manutencao", daemon=True).start()
+
+    def _limpar_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _on_notify(self, payload):
+        tipo, _, valor = payload.partition(':')
+        with self._lock:
+            if tipo == 'token':
+                self._cache.pop(valor, None)
+            elif tipo == 'admin':
+                for h in [h for h, item in self._cache.items() if str(item[0]) == valor]:
+                    del self._cache[h]
+
+    def _guardar(self, token_hash, admin_id, expira_em, gravada_em):
+        self._cache[token_hash] = [admin_id, expira_em, time.monotonic(), gravada_em]
+        self._cache.move_to_end(token_hash)
+        while len(self._cache) > SESSAO_CACHE_MAX:
+            self._cache.popitem(last=False)
+
+    def criar(self, admin_id):
+        self._garantir_processo()
+        token = secrets.token_urlsafe(32)
+        token_hash = hash_token(token)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO suagrafica_sessoes (token_hash, admin_id, expira_em)
+                VALUES (%s, %s, now() + make_interval(secs => %s))
+            """, (token_hash, admin_id, SESSAO_TTL))
+            conn.commit()
+        with self._lock:
+            self._guardar(token_hash, admin_id, time.time() + SESSAO_TTL, time.monotonic())
+            self._stats["criadas"] += 1
+        return token
+
+    def validar(self, token):
+        """admin_id da sessão, ou None. Num hit do cache não toca no banco."""
+        self._garantir_processo()
+        token_hash = hash_token(token)
+        agora, agora_mono = time.time(), time.monotonic()
+        confia_em_cache = get_pg_listener().online
+        with self._lock:
+            item = self._cache.get(token_hash)
+            if item is not None and item[1] > agora and (confia_em_cache or agora_mono - item[2] < SESSAO_CACHE_TTL):
+                self._cache.move_to_end(token_hash)
+                item[1] = agora + SESSAO_TTL  # expiração deslizante
+                if agora_mono - item[3] >= SESSAO_RENOVAR_INTERVALO:
+                    self._pendentes.add(token_hash)
+                    item[3] = agora_mono
+                self._stats["hits"] += 1
+                return item[0]
+            self._stats["misses"] += 1
+
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT admin_id, EXTRACT(EPOCH FROM expira_em - now())
+                FROM suagrafica_sessoes
+                WHERE token_hash = %s AND expira_em > now()
+            """, (token_hash,))
+            linha = cur.fetchone()
+        with self._lock:
+            if linha is None:
+                self._cache.pop(token_hash, None)
+                return None
+            admin_id, restante = linha
+            # O banco foi gravado há (TTL - restante) segundos: renova já se passou do intervalo
+            gravada_em = agora_mono - (SESSAO_TTL - float(restante))
+            self._guardar(token_hash, admin_id, agora + SESSAO_TTL, gravada_em)
+            if agora_mono - gravada_em >= SESSAO_RENOVAR_INTERVALO:
+                self._pendentes.add(token_hash)
+                self._cache[token_hash][3] = agora_mono
+        return admin_id
+
+    def encerrar(self, token):
+        self._garantir_processo()
+        token_hash = hash_token(token)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM suagrafica_sessoes WHERE token_hash = %s", (token_hash,))
+            cur.execute("SELECT pg_notify(%s, %s)", (SESSOES_CANAL, f"token:{token_hash}"))
+            conn.commit()
+        with self._lock:
+            self._cache.pop(token_hash, None)
+            self._pendentes.discard(token_hash)
+            self._stats["encerradas"] += 1
+
+    def notificar_admin_removido(self, cur, admin_id):
+        """Chamar na transação que apaga o admin (as sessões somem por ON DELETE CASCADE)."""
+        cur.execute("SELECT pg_notify(%s, %s)", (SESSOES_CANAL, f"admin:{admin_id}"))
+        self._on_notify(f"admin:{admin_id}")
+
+    def _manutencao(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(SESSAO_MANUTENCAO_INTERVALO)
+            try:
+                self.gravar_renovacoes()
+                if time.monotonic() - self._ultima_purga >= SESSAO_PURGA_INTERVALO:
+                    self.purgar()
+            except Exception as e:
+                print(f"🔴 [SESSÕES] Falha na manutenção: {e}")
+
+    def gravar_renovacoes(self):
+        with self._lock:
+            pendentes, self._pendentes = list(self._pendentes), set()
+        if not pendentes: return
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE suagrafica_sessoes SET expira_em = now() + make_interval(secs => %s)
+                WHERE token_hash = ANY(%s) AND expira_em > now()
+            """, (SESSAO_TTL, pendentes))
+            conn.commit()
+        with self._lock:
+            self._stats["renovacoes_gravadas"] += len(pendentes)
+
+    def purgar(self):
+        self._ultima_purga = time.monotonic()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM suagrafica_sessoes WHERE expira_em <= now()")
+            apagadas = cur.rowcount
+            conn.commit()
+        agora = time.time()
+        with self._lock:
+            for h in [h for h, item in self._cache.items() if item[1] <= agora]:
+                del self._cache[h]
+            self._stats["purgadas"] += apagadas
+        if apagadas:
+            print(f"ℹ️ [SESSÕES] {apagadas} sessão(ões) vencida(s) removida(s).")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, em_cache=len(self._cache), pendentes=len(self._pendentes),
+                        listener_online=get_pg_listener().online, pid=self.pid)
+
+
+sessoes = SessaoStore()
+metricas.medidor("sessoes", "Cache de sessões de admin", sessoes.stats)
+_admin_padrao = {"id": None, "em": 0.0}
+
+
+def admin_padrao():
+    """admin_id dos tokens forçados: o primeiro admin, relido no máximo a cada SESSAO_CACHE_TTL."""
+    if _admin_padrao["id"] is None or time.monotonic() - _admin_padrao["em"] > SESSAO_CACHE_TTL:
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT id FROM suagrafica_admin ORDER BY id LIMIT 1")
+                admin = cur.fetchone()
+            _admin_padrao.update(id=admin[0] if admin else 1, em=time.monotonic())
+        except Exception:
+            return _admin_padrao["id"] or 1
+    return _admin_padrao["id"]
+
+
+def token_da_requisicao(request):
+    token = request.headers.get('Authorization')
+    if not token: return None
+    return token.replace('Bearer ', '')
+
+
+def check_auth(request):
+    token = token_da_requisicao(request)
+    if not token: return None
+    
+    # Aceita os tokens forçados para que o painel admin carregue
+    if token in TOKENS_FORCADOS:
+        return admin_padrao()
+
+    return sessoes.validar(token)
+
+# --- TOKENS DE CLIENTE (assinados, sem estado) ---
+# Formato "v1.<claims>.<assinatura>", base64url sem padding; a assinatura é
+# HMAC-SHA256 de "v1.<claims>" com CLIENTE_TOKEN_SEGREDO. As claims levam
+# cliente_id, status e validade, então a verificação não consulta o banco:
+# é um HMAC + compare_digest. Cliente desativado ou apagado depois do login
+# sai da lista de ativos (RevogacaoClientes), recarregada por NOTIFY.
+#
+# Sem CLIENTE_TOKEN_SEGREDO no ambiente, o segredo é aleatório (secrets),
+# gerado uma vez e guardado em suagrafica_config: todos os workers e
+# instâncias do mesmo banco usam o mesmo. Lido na primeira assinatura ou
+# verificação (a importação não abre conexão) e mantido em memória.
+CLIENTE_TOKEN_TTL = int(os.environ.get("CLIENTE_TOKEN_TTL", 24 * 3600))
+CLIENTE_TOKEN_SEGREDO = os.environ.get("CLIENTE_TOKEN_SEGREDO")
+_chave_cliente = CLIENTE_TOKEN_SEGREDO.encode('utf-8') if CLIENTE_TOKEN_SEGREDO else None
+_chave_cliente_lock = threading.Lock()
+REVOGACAO_TTL = float(os.environ.get("REVOGACAO_TTL", 30))
+# Intervalo mínimo entre recargas disparadas por id fora da lista (cliente recém-criado)
+REVOGACAO_RECARGA_MIN = float(os.environ.get("REVOGACAO_RECARGA_MIN", 1))
+
+
+def _b64url(dados):
+    return base64.urlsafe_b64encode(dados).rstrip(b'=')
+
+
+def _b64url_decode(texto):
+    return base64.urlsafe_b64decode(texto + b'=' * (-len(texto) % 4))
+
+
+def _semear_segredo_cliente(cur):
+    """Grava um segredo aleatório para os tokens de cliente, se ainda não houver; devolve o do banco."""
+    cur.execute("INSERT INTO suagrafica_config (chave, valor) VALUES ('cliente_token_segredo', %s) ON CONFLICT DO NOTHING",
+                (secrets.token_hex(32),))
+    cur.execute("SELECT valor FROM suagrafica_config WHERE chave = 'cliente_token_segredo'")
+    return cur.fetchone()[0]
+
+
+def chave_cliente():
+    global _chave_cliente
+    if _chave_cliente is None:
+        with _chave_cliente_lock:
+            if _chave_cliente is None:
+                with db_connection() as conn:
+                    segredo = _semear_segredo_cliente(conn.cursor())
+                    conn.commit()
+                _chave_cliente = segredo.encode('utf-8')
+    return _chave_cliente
+
+
+def _assinatura_cliente(corpo):
+    return _b64url(hmac.new(chave_cliente(), corpo, hashlib.sha256).digest())
+
+
+def assinar_token_cliente(cliente_id, status_acesso, ttl=CLIENTE_TOKEN_TTL):
+    agora = int(time.time())
+    claims = {"cliente_id": cliente_id, "status": status_acesso, "iat": agora, "exp": agora + ttl}
+    corpo = b"v1." + _b64url(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return (corpo + b"." + _assinatura_cliente(corpo)).decode('ascii')
+
+
+def verificar_token_cliente(token):
+    """Claims do token se a assinatura confere e ele está na validade; senão None."""
+    try:
+        corpo, _, assinatura = token.encode('ascii').rpartition(b'.')
+        if not corpo.startswith(b"v1."): return None
+        if not hmac.compare_digest(assinatura, _assinatura_cliente(corpo)): return None
+        claims = json.loads(_b64url_decode(corpo[3:]))
+    except (ValueError, UnicodeError):
+        return None
+    if claims.get('exp', 0) <= time.time() or claims.get('status') != 'Ativo':
+        return None
+    return claims
 
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT id, username, chave_admin 
-            FROM suagrafica_admin 
-            WHERE LOWER(username) = LOWER(%s)
-        """, (username,))
-        
-        admin = cur.fetchone()
-        
-        if admin and admin[2] == chave_admin:
-            token = str(uuid.uuid4())
-            ADMIN_SESSIONS[token] = admin[0]
-            return jsonify({"mensagem": "Login realizado", "token": token, "admin_id": admin[0]})
-        else:
-            return jsonify({"erro": "Usuário ou senha incorretos"}), 401
-    finally:
-        if conn: conn.close()
+
+class RevogacaoClientes:
+    """
+    IDs de clientes com status_acesso = 'Ativo', em memória por processo: o
+    token de um id fora da lista (bloqueado ou apagado) é recusado.
+    Recarrega quando suagrafica_clientes muda (NOTIFY de versão); com o
+    listener fora do ar, no máximo a cada REVOGACAO_TTL segundos. Um id
+    desconhecido (cliente criado depois da carga, NOTIFY ainda a caminho)
+    força uma recarga, no máximo uma a cada REVOGACAO_RECARGA_MIN segundos.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self._lock = threading.Lock()
+        self._ativos = None
+        self._carregado_em = 0.0
+        self._geracao = 0
+        self.recargas = 0
+
+    def _garantir_listener(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.invalidar()
+            get_pg_listener().registrar(VERSOES_CANAL, self._on_notify, ao_reconectar=self.invalidar)
+
+    def _on_notify(self, payload):
+        if payload.split(':', 1)[0] == 'suagrafica_clientes':
+            self.invalidar()
+
+    def invalidar(self):
+        with self._lock:
+            self._geracao += 1
+            self._ativos = None
+
+    def revogado(self, cliente_id):
+        self._garantir_listener()
+        ativos = self._ativos
+        idade = time.monotonic() - self._carregado_em
+        if (ativos is None or (not get_pg_listener().online and idade > REVOGACAO_TTL)
+                or (cliente_id not in ativos and idade > REVOGACAO_RECARGA_MIN)):
+            ativos = self._carregar()
+        return cliente_id not in ativos
+
+    def _carregar(self):
+        geracao = self._geracao
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM suagrafica_clientes WHERE status_acesso = 'Ativo'")
+            ativos = frozenset(r[0] for r in cur.fetchall())
+        with self._lock:
+            self.recargas += 1
+            if geracao == self._geracao:
+                self._ativos, self._carregado_em = ativos, time.monotonic()
+        return ativos
+
+    def stats(self):
+        return {"ativos": None if self._ativos is None else len(self._ativos),
+                "recargas": self.recargas, "listener_online": get_pg_listener().online}
+
+
+revogacao_clientes = RevogacaoClientes()
+metricas.medidor("revogacao_clientes", "Lista de clientes ativos (revogação de tokens)", revogacao_clientes.stats)
+
+
+def check_client_auth(request):
+    """ Claims do token do cliente (cliente_id, status, exp) ou None. Não consulta o banco. """
+    token = token_da_requisicao(request)
+    if not token: return None
+    claims = verificar_token_cliente(token)
+    if not claims or revogacao_clientes.revogado(claims['cliente_id']):
+        return None
+    return claims
+
+
+@app.route('/api/admin/login', methods=['POST'])
+def login_admin():
+    data = request.json or {}
+    username = data.get('username', '').strip()
+    chave_admin = data.get('chave_admin', '').strip()
+
+    if not username or not chave_admin:
+        return jsonify({"erro": "Credenciais incompletas"}), 400
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute("""
+            SELECT id, username, chave_admin 
+            FROM suagrafica_admin 
+            WHERE LOWER(username) = LOWER(%s)
+        """, (username,))
+        
+        admin = cur.fetchone()
+
+    # Fora do with: sessoes.criar pega a sua própria conexão, e segurar esta
+    # junto faria cada login ocupar duas (com o pool cheio, todos esperariam)
+    if admin and admin[2] == chave_admin:
+        token = sessoes.criar(admin[0])
+        return jsonify({"mensagem": "Login realizado", "token": token, "admin_id": admin[0], "expira_em_segundos": SESSAO_TTL})
+    else:
+        return jsonify({"erro": "Usuário ou senha incorretos"}), 401
+
+@app.route('/api/admin/logout', methods=['POST'])
+def logout_admin():
+    token = token_da_requisicao(request)
+    if token and token not in TOKENS_FORCADOS:
+        sessoes.encerrar(token)
+    return jsonify({"mensagem": "Sessão encerrada"})
 
 @app.route('/api/cliente/login', methods=['POST'])
 def login_cliente():
@@ -184,385 +1801,1997 @@ def login_cliente():
     if not codigo_acesso:
         return jsonify({"erro": "Código de Acesso não fornecido"}), 400
 
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
         
-        cur.execute("""
-            SELECT id, nome_cliente, status_acesso 
-            FROM suagrafica_clientes 
-            WHERE codigo_acesso = %s
-        """, (codigo_acesso,))
+            cur.execute("""
+                SELECT id, nome_cliente, status_acesso 
+                FROM suagrafica_clientes 
+                WHERE codigo_acesso = %s
+            """, (codigo_acesso,))
         
-        cliente = cur.fetchone()
+            cliente = cur.fetchone()
         
-        if cliente:
-            cliente_id, nome_cliente, status_acesso = cliente
+            if cliente:
+                cliente_id, nome_cliente, status_acesso = cliente
             
-            if status_acesso != 'Ativo':
-                return jsonify({"erro": "Seu acesso está inativo. Contate o suporte."}), 401
+                if status_acesso != 'Ativo':
+                    return jsonify({"erro": "Seu acesso está inativo. Contate o suporte."}), 401
                 
-            cliente_token = hashlib.sha256(f"{cliente_id}:{uuid.uuid4()}".encode()).hexdigest()
+                cliente_token = assinar_token_cliente(cliente_id, status_acesso)
             
-            return jsonify({
-                "mensagem": "Login de Cliente realizado", 
-                "token": cliente_token, 
-                "cliente_id": cliente_id,
-                "nome_cliente": nome_cliente
-            }), 200
-        else:
-            return jsonify({"erro": "Código de acesso incorreto ou cliente não encontrado"}), 401
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"erro": f"Erro interno: {str(e)}"}), 500
-    finally:
-        if conn: conn.close()
+                return jsonify({
+                    "mensagem": "Login de Cliente realizado", 
+                    "token": cliente_token, 
+                    "cliente_id": cliente_id,
+                    "nome_cliente": nome_cliente,
+                    "expira_em_segundos": CLIENTE_TOKEN_TTL
+                }), 200
+            else:
+                return jsonify({"erro": "Código de acesso incorreto ou cliente não encontrado"}), 401
+        except Exception as e:
+            traceback.print_exc()
+            return jsonify({"erro": f"Erro interno: {str(e)}"}), 500
         
 # ======================================================================
 # 3. DASHBOARD & CRUD (ADMIN)
 # ======================================================================
+# --- ESTATÍSTICAS DO PAINEL ---
+# Lidas das tabelas-resumo (migração 0007): lookups por PK/índice, sem
+# varrer pedidos. O ETag sai das versões das tabelas de origem.
+STATS_DIAS_PADRAO = 30
+STATS_TOP_PRODUTOS = 10
+
+
 @app.route('/api/admin/dashboard_stats', methods=['GET'])
 def admin_stats():
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
     try:
+        dias = max(1, min(int(request.args.get('dias', STATS_DIAS_PADRAO)), 366))
+    except ValueError:
+        raise ParametroInvalido("dias deve ser um número.")
+    with db_connection() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM suagrafica_clientes WHERE status_acesso = 'Ativo'")
-        cl = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM suagrafica_produtos WHERE esta_ativo = TRUE")
-        pr = cur.fetchone()[0]
-        # Conta pedidos no status 'Aguardando Aprovação' ou 'Aguardando Pagamento'
-        cur.execute("SELECT COUNT(*) FROM suagrafica_pedidos WHERE status_pedido IN ('Aguardando Aprovação', 'Aguardando Pagamento')")
-        pe = cur.fetchone()[0]
-        return jsonify({"stat_clientes": cl, "stat_produtos": pr, "stat_pedidos": pe})
-    finally:
-        if conn: conn.close()
+        etag = montar_etag('dashboard', dias, date.today().isoformat(), *versoes_tabelas(cur, *TABELAS_VERSIONADAS))
+        if etag_confere(etag): return nao_modificado(etag)
+
+        cur.execute("SELECT chave, valor FROM suagrafica_stats_contadores")
+        contadores = dict(cur.fetchall())
+        cur.execute("SELECT status_pedido, pedidos, valor FROM suagrafica_stats_status WHERE pedidos <> 0 ORDER BY status_pedido")
+        por_status = [{"status_pedido": s, "pedidos": n, "valor": v} for s, n, v in cur.fetchall()]
+        cur.execute("""
+            SELECT dia, pedidos, valor FROM suagrafica_stats_receita_dia
+            WHERE dia > CURRENT_DATE - %s AND pedidos <> 0 ORDER BY dia
+        """, (dias,))
+        receita = [{"dia": d, "pedidos": n, "valor": v} for d, n, v in cur.fetchall()]
+        cur.execute("""
+            SELECT s.produto_id, p.nome_produto, s.quantidade, s.receita
+            FROM suagrafica_stats_produtos s JOIN suagrafica_produtos p ON p.id = s.produto_id
+            WHERE s.quantidade > 0 ORDER BY s.quantidade DESC LIMIT %s
+        """, (STATS_TOP_PRODUTOS,))
+        top = [{"produto_id": i, "nome_produto": n, "quantidade": q, "receita": r} for i, n, q, r in cur.fetchall()]
+
+    abertos = sum(s["pedidos"] for s in por_status if s["status_pedido"] in STATUS_PEDIDOS_ABERTOS)
+    return com_etag(jsonify({
+        "stat_clientes": contadores.get('clientes_ativos', 0),
+        "stat_produtos": contadores.get('produtos_ativos', 0),
+        "stat_pedidos": abertos,
+        "pedidos_por_status": por_status,
+        "receita_por_dia": receita,
+        "top_produtos": top,
+    }), etag)
+
+
+def reconstruir_estatisticas(cur):
+    """Recalcula todas as tabelas-resumo a partir das tabelas de origem (na transação de `cur`)."""
+    for sql in ESTATISTICAS_RECONSTRUIR:
+        cur.execute(sql)
+
+
+def verificar_estatisticas(cur):
+    """Divergências entre as tabelas-resumo e as contagens ao vivo: [(tabela, chave, resumo, ao_vivo)]."""
+    divergencias = []
+    for tabela, (chave, consulta) in ESTATISTICAS_AO_VIVO.items():
+        # Linhas zeradas no resumo equivalem a ausentes ao vivo (o trigger não apaga linhas)
+        cur.execute(f"""
+            SELECT coalesce(r.{chave}, v.{chave})::text, to_jsonb(r) - '{chave}', to_jsonb(v) - '{chave}'
+            FROM {tabela} r FULL JOIN ({consulta}) v ON v.{chave} = r.{chave}
+        """)
+        for valor_chave, resumo, ao_vivo in cur.fetchall():
+            zerado = {k: 0 for k in (resumo or ao_vivo)}
+            if {k: float(x) for k, x in (resumo or zerado).items()} != {k: float(x) for k, x in (ao_vivo or zerado).items()}:
+                divergencias.append((tabela, valor_chave, resumo, ao_vivo))
+    return divergencias
+
+
+@app.cli.command("estatisticas-reconstruir")
+def cli_estatisticas_reconstruir():
+    """Recalcula as tabelas-resumo do painel (depois de TRUNCATE ou restauração de backup)."""
+    inicio = time.perf_counter()
+    with db_connection() as conn:
+        reconstruir_estatisticas(conn.cursor())
+        conn.commit()
+    print(f"✅ Estatísticas reconstruídas em {time.perf_counter() - inicio:.2f}s.")
+
+
+@app.cli.command("estatisticas-verificar")
+@click.option("--corrigir", is_flag=True, help="Reconstrói as tabelas-resumo se houver divergência.")
+def cli_estatisticas_verificar(corrigir):
+    """Compara as tabelas-resumo com as contagens ao vivo (sai com código 1 se divergirem)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Mesmo snapshot para resumo e origem (os triggers gravam os dois na mesma transação)
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        divergencias = verificar_estatisticas(cur)
+        conn.rollback()
+        for tabela, chave, resumo, ao_vivo in divergencias:
+            print(f"⚠️ {tabela} [{chave}]: resumo={resumo} ao_vivo={ao_vivo}")
+        if not divergencias:
+            print("✅ Estatísticas consistentes.")
+            return
+        if corrigir:
+            reconstruir_estatisticas(cur)
+            conn.commit()
+            print(f"✅ {len(divergencias)} divergência(s) corrigida(s) com reconstrução.")
+            return
+    raise SystemExit(1)
 
 @app.route('/api/admin/produtos', methods=['GET', 'POST'])
 def admin_gerenciar_produtos():
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        if request.method == 'GET':
-            cur.execute("SELECT * FROM suagrafica_produtos ORDER BY nome_produto")
-            produtos = cur.fetchall()
-            for p in produtos: p['preco_minimo'] = float(p['preco_minimo'])
-            return jsonify(produtos)
-        elif request.method == 'POST':
-            data = request.json or {}
-            cur.execute("""
-                INSERT INTO suagrafica_produtos (codigo_produto, nome_produto, preco_minimo, multiplos_de, descricao, imagem_url, esta_ativo, estoque_disponivel)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
-            """, (data.get('codigo_produto'), data.get('nome_produto'), data.get('preco_minimo'), data.get('multiplos_de', 1), data.get('descricao'), data.get('imagem_url'), data.get('esta_ativo', True), data.get('estoque_disponivel', True)))
-            conn.commit()
-            return jsonify({"mensagem": "Produto criado!", "id": cur.fetchone()['id']}), 201
-    except Exception as e:
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    if request.method == 'GET':
+        return resposta_json_stream(
+            f"SELECT {PRODUTO_COLUNAS_P}, {IMAGENS_SQL} FROM suagrafica_produtos p {IMAGENS_JOIN} ORDER BY p.nome_produto",
+            IMAGENS_PARAMS, etag_de=lambda cur: montar_etag('admin-produtos', *versoes_tabelas(cur, 'suagrafica_produtos')))
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if request.method == 'POST':
+                data = request.json or {}
+                cur.execute("""
+                    INSERT INTO suagrafica_produtos (codigo_produto, nome_produto, preco_minimo, multiplos_de, descricao, imagem_url, esta_ativo, estoque_disponivel)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+                """, (data.get('codigo_produto'), data.get('nome_produto'), data.get('preco_minimo'), data.get('multiplos_de', 1), data.get('descricao'), data.get('imagem_url'), data.get('esta_ativo', True), data.get('estoque_disponivel', True)))
+                novo_id = cur.fetchone()['id']
+                conn.commit()
+                catalog_cache.invalidar()
+                if data.get('imagem_url'): agendar_imagens([novo_id])
+                return jsonify({"mensagem": "Produto criado!", "id": novo_id}), 201
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/admin/produtos/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 def admin_crud_produto_by_id(id):
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        if request.method == 'GET':
-            cur.execute("SELECT * FROM suagrafica_produtos WHERE id = %s", (id,))
-            p = cur.fetchone()
-            if p: p['preco_minimo'] = float(p['preco_minimo'])
-            return jsonify(p or {"erro": "Não encontrado"}), 200 if p else 404
-        elif request.method == 'PUT':
-            data = request.json or {}
-            cur.execute("""
-                UPDATE suagrafica_produtos SET codigo_produto=%s, nome_produto=%s, preco_minimo=%s, multiplos_de=%s, descricao=%s, imagem_url=%s, esta_ativo=%s, estoque_disponivel=%s WHERE id=%s
-            """, (data.get('codigo_produto'), data.get('nome_produto'), data.get('preco_minimo'), data.get('multiplos_de'), data.get('descricao'), data.get('imagem_url'), data.get('esta_ativo'), data.get('estoque_disponivel'), id))
-            conn.commit()
-            return jsonify({"mensagem": "Atualizado!"})
-        elif request.method == 'DELETE':
-            cur.execute("DELETE FROM suagrafica_produtos WHERE id = %s", (id,))
-            conn.commit()
-            return jsonify({"mensagem": "Deletado!"})
-    except Exception as e:
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if request.method == 'GET':
+                cur.execute(f"SELECT {PRODUTO_COLUNAS} FROM suagrafica_produtos WHERE id = %s", (id,))
+                p = cur.fetchone()
+                return jsonify(p or {"erro": "Não encontrado"}), 200 if p else 404
+            elif request.method == 'PUT':
+                data = request.json or {}
+                cur.execute("""
+                    UPDATE suagrafica_produtos SET codigo_produto=%s, nome_produto=%s, preco_minimo=%s, multiplos_de=%s, descricao=%s, imagem_url=%s, esta_ativo=%s, estoque_disponivel=%s WHERE id=%s
+                """, (data.get('codigo_produto'), data.get('nome_produto'), data.get('preco_minimo'), data.get('multiplos_de'), data.get('descricao'), data.get('imagem_url'), data.get('esta_ativo'), data.get('estoque_disponivel'), id))
+                conn.commit()
+                catalog_cache.invalidar()
+                if data.get('imagem_url'): agendar_imagens([id])
+                return jsonify({"mensagem": "Atualizado!"})
+            elif request.method == 'DELETE':
+                cur.execute("DELETE FROM suagrafica_produtos WHERE id = %s", (id,))
+                conn.commit()
+                catalog_cache.invalidar()
+                return jsonify({"mensagem": "Deletado!"})
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/admin/clientes', methods=['GET', 'POST'])
 def admin_gerenciar_clientes():
     admin_id = check_auth(request)
     if not admin_id: return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        if request.method == 'GET':
-            cur.execute("SELECT * FROM suagrafica_clientes ORDER BY nome_cliente")
-            return jsonify(cur.fetchall())
-        elif request.method == 'POST':
-            data = request.json or {}
-            cur.execute("""
-                INSERT INTO suagrafica_clientes (admin_id, nome_cliente, cnpj, email_contato, codigo_acesso, status_acesso)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
-            """, (admin_id, data.get('nome_cliente'), data.get('cnpj'), data.get('email_contato'), data.get('codigo_acesso'), 'Ativo'))
-            conn.commit()
-            return jsonify({"mensagem": "Cliente criado!", "id": cur.fetchone()['id']}), 201
-    except Exception as e:
-        if conn: conn.rollback()
-        if "unique constraint" in str(e).lower(): return jsonify({"erro": "Código/CNPJ duplicado"}), 409
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    if request.method == 'GET':
+        return resposta_json_stream(
+            "SELECT * FROM suagrafica_clientes ORDER BY nome_cliente",
+            etag_de=lambda cur: montar_etag('admin-clientes', *versoes_tabelas(cur, 'suagrafica_clientes')))
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if request.method == 'POST':
+                data = request.json or {}
+                cur.execute("""
+                    INSERT INTO suagrafica_clientes (admin_id, nome_cliente, cnpj, email_contato, codigo_acesso, status_acesso)
+                    VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+                """, (admin_id, data.get('nome_cliente'), data.get('cnpj'), data.get('email_contato'), data.get('codigo_acesso'), 'Ativo'))
+                conn.commit()
+                return jsonify({"mensagem": "Cliente criado!", "id": cur.fetchone()['id']}), 201
+        except Exception as e:
+            conn.rollback()
+            if "unique constraint" in str(e).lower(): return jsonify({"erro": "Código/CNPJ duplicado"}), 409
+            return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/admin/clientes/<int:id>', methods=['DELETE'])
 def admin_delete_cliente(id):
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM suagrafica_clientes WHERE id = %s", (id,))
-        conn.commit()
-        return jsonify({"mensagem": "Cliente deletado!"})
-    except Exception as e:
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM suagrafica_clientes WHERE id = %s", (id,))
+            conn.commit()
+            revogacao_clientes.invalidar()  # neste worker já na próxima requisição; nos outros, pelo NOTIFY
+            return jsonify({"mensagem": "Cliente deletado!"})
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/admin/users', methods=['GET', 'POST'])
 def admin_gerenciar_admins():
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        if request.method == 'GET':
-            cur.execute("SELECT id, username, data_criacao FROM suagrafica_admin ORDER BY id")
-            return jsonify(cur.fetchall())
-        elif request.method == 'POST':
-            data = request.json or {}
-            cur.execute("INSERT INTO suagrafica_admin (username, chave_admin) VALUES (%s, %s) RETURNING id", (data.get('username'), data.get('chave_admin')))
-            conn.commit()
-            return jsonify({"mensagem": "Admin criado!", "id": cur.fetchone()['id']}), 201
-    except Exception as e:
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if request.method == 'GET':
+                cur.execute("SELECT id, username, data_criacao FROM suagrafica_admin ORDER BY id")
+                return jsonify(cur.fetchall())
+            elif request.method == 'POST':
+                data = request.json or {}
+                cur.execute("INSERT INTO suagrafica_admin (username, chave_admin) VALUES (%s, %s) RETURNING id", (data.get('username'), data.get('chave_admin')))
+                conn.commit()
+                return jsonify({"mensagem": "Admin criado!", "id": cur.fetchone()['id']}), 201
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/admin/users/<int:id>', methods=['DELETE'])
 def admin_delete_admin(id):
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM suagrafica_admin")
+            if cur.fetchone()[0] == 1: return jsonify({"erro": "Não pode deletar o último admin"}), 400
+            cur.execute("DELETE FROM suagrafica_admin WHERE id = %s", (id,))
+            sessoes.notificar_admin_removido(cur, id)
+            conn.commit()
+            return jsonify({"mensagem": "Admin deletado!"})
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
+
+@app.route('/api/admin/pool_stats', methods=['GET'])
+def admin_pool_stats():
+    """ Métricas do pool de conexões deste worker (em uso, ociosas, espera, criadas). """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    return jsonify(get_db_pool().stats())
+
+@app.route('/api/admin/sessoes_stats', methods=['GET'])
+def admin_sessoes_stats():
+    """ Cache de sessões deste worker (hits, misses, renovações, purgas) e a lista de clientes ativos (revogação). """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    return jsonify(dict(sessoes.stats(), revogacao_clientes=revogacao_clientes.stats()))
+
+# --- PAGINAÇÃO POR CURSOR (KEYSET) ---
+# Cursor opaco = base64 de [data_criacao, id] da última linha entregue.
+# Páginas seguintes usam (data_criacao, id) < (...) e descem pelo índice
+# composto, sem OFFSET: o custo por página não cresce com o histórico.
+PAGINA_PADRAO = 50
+PAGINA_MAXIMA = 200
+
+
+class ParametroInvalido(ValueError):
+    """Query string inválida (vira 400 com a mensagem em 'erro')."""
+
+
+def codificar_cursor(data_criacao, id):
+    bruto = json.dumps([data_criacao.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(bruto).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM suagrafica_admin")
-        if cur.fetchone()[0] == 1: return jsonify({"erro": "Não pode deletar o último admin"}), 400
-        cur.execute("DELETE FROM suagrafica_admin WHERE id = %s", (id,))
-        conn.commit()
-        return jsonify({"mensagem": "Admin deletado!"})
-    except Exception as e:
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+        bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data_iso, id = json.loads(bruto)
+        return datetime.fromisoformat(data_iso), int(id)
+    except Exception:
+        raise ParametroInvalido("Cursor inválido.")
+
+
+def ler_limite(args):
+    try:
+        limite = int(args.get('limit', PAGINA_PADRAO))
+    except ValueError:
+        raise ParametroInvalido("limit deve ser um número.")
+    return max(1, min(limite, PAGINA_MAXIMA))
+
+
+def ler_data(args, nome, fim_do_dia=False):
+    """Aceita YYYY-MM-DD ou ISO completo. Para 'até' com só a data, inclui o dia inteiro."""
+    valor = args.get(nome)
+    if not valor: return None
+    try:
+        data = datetime.fromisoformat(valor)
+    except ValueError:
+        raise ParametroInvalido(f"{nome} deve estar no formato AAAA-MM-DD.")
+    if fim_do_dia and len(valor) == 10:
+        data += timedelta(days=1)
+    return data
+
+
+def filtros_pedidos(args):
+    """Condições (sobre o alias `p` de suagrafica_pedidos) para status, cliente_id e período."""
+    filtros, params = [], []
+    if args.get('status'):
+        filtros.append("p.status_pedido = %s"); params.append(args['status'])
+    if args.get('cliente_id'):
+        try:
+            params.append(int(args['cliente_id']))
+        except ValueError:
+            raise ParametroInvalido("cliente_id inválido.")
+        filtros.append("p.cliente_id = %s")
+    data_inicio = ler_data(args, 'data_inicio')
+    data_fim = ler_data(args, 'data_fim', fim_do_dia=True)
+    if data_inicio:
+        filtros.append("p.data_criacao >= %s"); params.append(data_inicio)
+    if data_fim:
+        filtros.append("p.data_criacao < %s"); params.append(data_fim)
+    return filtros, params
+
+
+def estimar_total(cur, sql_from_where, params):
+    """Total aproximado pela estimativa do planner (EXPLAIN), sem COUNT(*) na tabela."""
+    ecur = cur.connection.cursor()
+    ecur.execute("EXPLAIN (FORMAT JSON) SELECT 1 " + sql_from_where, params)
+    plano = ecur.fetchone()[0]
+    ecur.close()
+    if isinstance(plano, str): plano = json.loads(plano)
+    return int(plano[0]['Plan']['Plan Rows'])
+
+
+@app.errorhandler(ParametroInvalido)
+def parametro_invalido(e):
+    return jsonify({"erro": str(e)}), 400
+
 
 # Rotas de Pedidos para o Painel Admin
 @app.route('/api/admin/pedidos', methods=['GET'])
 def admin_listar_pedidos():
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            # A listagem traz o nome do cliente: muda se pedidos OU clientes mudarem
+            etag = montar_etag('admin-pedidos', *versoes_tabelas(cur, 'suagrafica_pedidos', 'suagrafica_clientes'))
+            if etag_confere(etag): return nao_modificado(etag)
+
+            args = request.args
+            limite = ler_limite(args)
+            ordem = args.get('ordem', 'desc').lower()
+            if ordem not in ('asc', 'desc'):
+                raise ParametroInvalido("ordem deve ser 'asc' ou 'desc'.")
+
+            filtros, params = filtros_pedidos(args)
+            sql_filtros = (" WHERE " + " AND ".join(filtros)) if filtros else ""
+
+            # Estimativa do total (só na primeira página; as demais não precisam)
+            total_estimado = None
+            if not args.get('cursor'):
+                total_estimado = estimar_total(cur, "FROM suagrafica_pedidos p" + sql_filtros, params)
+
+            keyset, params_keyset = "", []
+            if args.get('cursor'):
+                data_cursor, id_cursor = decodificar_cursor(args['cursor'])
+                keyset = f" {'AND' if filtros else 'WHERE'} (p.data_criacao, p.id) {'<' if ordem == 'desc' else '>'} (%s, %s)"
+                params_keyset = [data_cursor, id_cursor]
+
+            cur.execute(f"""
+                SELECT p.id, c.nome_cliente, p.cliente_id, p.valor_total, p.status_pedido, p.data_criacao
+                FROM suagrafica_pedidos p
+                JOIN suagrafica_clientes c ON p.cliente_id = c.id
+                {sql_filtros}{keyset}
+                ORDER BY p.data_criacao {ordem}, p.id {ordem}
+                LIMIT %s
+            """, params + params_keyset + [limite + 1])
+            pedidos = cur.fetchall()
+
+            proximo_cursor = None
+            if len(pedidos) > limite:
+                pedidos = pedidos[:limite]
+                proximo_cursor = codificar_cursor(pedidos[-1]['data_criacao'], pedidos[-1]['id'])
+            elif total_estimado is not None:
+                total_estimado = len(pedidos)  # página única: o total é exato
+            return com_etag(jsonify({
+                "pedidos": pedidos,
+                "proximo_cursor": proximo_cursor,
+                "total_estimado": total_estimado
+            }), etag)
+        except ParametroInvalido:
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            return jsonify({"erro": str(e)}), 500
+
+# Detalhe de pedidos em uma única ida ao banco: os itens vêm agregados em JSON
+# e os valores já saem como float do próprio Postgres.
+DETALHE_PEDIDOS_SQL = """
+    SELECT p.id, c.nome_cliente, p.cliente_id, p.valor_total::float8 AS valor_total, p.status_pedido,
+           p.link_pagamento, p.path_comprovante, p.data_criacao,
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'quantidade', pi.quantidade,
+                          'preco_unitario', pi.preco_unitario_registrado::float8,
+                          'nome_produto', pr.nome_produto,
+                          'codigo_produto', pr.codigo_produto
+                      ) ORDER BY pi.id)
+               FROM suagrafica_pedido_itens pi
+               JOIN suagrafica_produtos pr ON pi.produto_id = pr.id
+               WHERE pi.pedido_id = p.id
+           ), '[]'::json) AS itens
+    FROM suagrafica_pedidos p
+    JOIN suagrafica_clientes c ON p.cliente_id = c.id
+    WHERE p.id = ANY(%s)
+"""
+LOTE_MAXIMO_PEDIDOS = 200
+
+
+def detalhes_pedidos(cur, ids):
+    """Pedidos (com itens) na ordem dos `ids` pedidos; ids inexistentes são omitidos."""
+    cur.execute(DETALHE_PEDIDOS_SQL, (list(ids),))
+    por_id = {p['id']: p for p in cur.fetchall()}
+    return [por_id[i] for i in ids if i in por_id]
+
+
+@app.route('/api/admin/pedidos/batch', methods=['GET'])
+def admin_pedidos_batch():
+    """ Detalhe de vários pedidos de uma vez (?ids=1,2,3), para o painel pré-carregar a página visível. """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
     try:
+        ids = list(dict.fromkeys(int(i) for i in request.args.get('ids', '').split(',') if i.strip()))
+    except ValueError:
+        raise ParametroInvalido("ids deve ser uma lista de números separados por vírgula.")
+    if not ids:
+        raise ParametroInvalido("Informe ao menos um id em ?ids=")
+    if len(ids) > LOTE_MAXIMO_PEDIDOS:
+        raise ParametroInvalido(f"Máximo de {LOTE_MAXIMO_PEDIDOS} pedidos por requisição.")
+
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT p.id, c.nome_cliente, p.valor_total, p.status_pedido, p.data_criacao
-            FROM suagrafica_pedidos p
-            JOIN suagrafica_clientes c ON p.cliente_id = c.id
-            ORDER BY p.data_criacao DESC
-        """)
-        pedidos = cur.fetchall()
-        for p in pedidos: p['valor_total'] = float(p['valor_total'])
-        return jsonify(pedidos)
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+        pedidos = detalhes_pedidos(cur, ids)
+    encontrados = {p['id'] for p in pedidos}
+    return jsonify({"pedidos": pedidos, "nao_encontrados": [i for i in ids if i not in encontrados]})
 
 @app.route('/api/admin/pedidos/<int:id>', methods=['GET', 'PUT'])
 def admin_crud_pedido_by_id(id):
     if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        if request.method == 'GET':
-            cur.execute("""
-                SELECT p.id, c.nome_cliente, p.cliente_id, p.valor_total, p.status_pedido, p.link_pagamento, p.path_comprovante, p.data_criacao
-                FROM suagrafica_pedidos p
-                JOIN suagrafica_clientes c ON p.cliente_id = c.id
-                WHERE p.id = %s
-            """, (id,))
-            pedido = cur.fetchone()
-            
-            if not pedido: return jsonify({"erro": "Pedido não encontrado"}), 404
+            if request.method == 'GET':
+                pedidos = detalhes_pedidos(cur, [id])
+                if not pedidos: return jsonify({"erro": "Pedido não encontrado"}), 404
+                return jsonify(pedidos[0])
 
-            cur.execute("""
-                SELECT pi.quantidade, pi.preco_unitario_registrado, pr.nome_produto, pr.codigo_produto
-                FROM suagrafica_pedido_itens pi
-                JOIN suagrafica_produtos pr ON pi.produto_id = pr.id
-                WHERE pi.pedido_id = %s
-            """, (id,))
-            itens = cur.fetchall()
-
-            pedido['valor_total'] = float(pedido['valor_total'])
-            pedido['itens'] = [{'quantidade': i['quantidade'], 'preco_unitario': float(i['preco_unitario_registrado']), 'nome_produto': i['nome_produto'], 'codigo_produto': i['codigo_produto']} for i in itens]
+            elif request.method == 'PUT':
+                data = request.json or {}
+                cur.execute("""
+                    UPDATE suagrafica_pedidos 
+                    SET status_pedido = %s, link_pagamento = %s, valor_total = %s 
+                    WHERE id = %s
+                """, (data.get('status_pedido'), data.get('link_pagamento'), data.get('valor_total'), id))
+                conn.commit()
+                return jsonify({"mensagem": "Pedido atualizado!"})
             
-            return jsonify(pedido)
+        except Exception as e:
+            traceback.print_exc()
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
-        elif request.method == 'PUT':
-            data = request.json or {}
-            cur.execute("""
-                UPDATE suagrafica_pedidos 
-                SET status_pedido = %s, link_pagamento = %s, valor_total = %s 
-                WHERE id = %s
-            """, (data.get('status_pedido'), data.get('link_pagamento'), data.get('valor_total'), id))
-            conn.commit()
-            return jsonify({"mensagem": "Pedido atualizado!"})
-            
-    except Exception as e:
+# --- EXPORTAÇÕES (NDJSON / CSV EM STREAMING) ---
+# Para conciliação do financeiro. Cursor nomeado (server-side): o Postgres
+# entrega EXPORT_ITERSIZE linhas por vez e a memória do worker não cresce com
+# o tamanho da tabela. Filtros iguais aos da listagem de pedidos; em clientes
+# eles selecionam quem tem pedido no filtro.
+EXPORT_ITERSIZE = int(os.environ.get("EXPORT_ITERSIZE", 2000))
+
+EXPORTACOES = {
+    'pedidos': """
+        SELECT p.id, p.cliente_id, c.nome_cliente, c.cnpj, p.valor_total, p.status_pedido,
+               p.link_pagamento, p.data_criacao
+        FROM suagrafica_pedidos p
+        JOIN suagrafica_clientes c ON p.cliente_id = c.id
+        {filtros}
+        ORDER BY p.id
+    """,
+    'pedido_itens': """
+        SELECT pi.id, pi.pedido_id, p.cliente_id, p.status_pedido, p.data_criacao AS data_pedido,
+               pi.produto_id, pr.codigo_produto, pr.nome_produto, pi.quantidade,
+               pi.preco_unitario_registrado, pi.quantidade * pi.preco_unitario_registrado AS subtotal
+        FROM suagrafica_pedido_itens pi
+        JOIN suagrafica_pedidos p ON pi.pedido_id = p.id
+        LEFT JOIN suagrafica_produtos pr ON pi.produto_id = pr.id
+        {filtros}
+        ORDER BY pi.pedido_id, pi.id
+    """,
+    # Sem codigo_acesso: é a senha do cliente no portal
+    'clientes': """
+        SELECT c.id, c.nome_cliente, c.cnpj, c.email_contato, c.status_acesso
+        FROM suagrafica_clientes c
+        {filtros}
+        ORDER BY c.id
+    """,
+}
+
+
+def linhas_ndjson(cur, lote):
+    """Um objeto JSON por linha, gerado em pedaços de `lote` linhas."""
+    colunas = None
+    while True:
+        linhas = cur.fetchmany(lote)
+        if not linhas: break
+        colunas = colunas or [d[0] for d in cur.description]
+        yield b''.join(json_bytes(dict(zip(colunas, linha))) + b'\n' for linha in linhas)
+
+
+def linhas_csv(cur, lote):
+    """CSV com cabeçalho, gerado em pedaços de `lote` linhas."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM: o Excel só reconhece os acentos em UTF-8 com ele
+    cabecalho = False
+    while True:
+        linhas = cur.fetchmany(lote)
+        if not cabecalho:
+            escritor.writerow([d[0] for d in cur.description])
+            cabecalho = True
+        if not linhas: break
+        escritor.writerows([v.isoformat() if isinstance(v, (datetime, date)) else v for v in linha] for linha in linhas)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0); buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def comprimir_gzip(pedacos, nivel=6):
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+: cabeçalho gzip
+    for pedaco in pedacos:
+        comprimido = compressor.compress(pedaco)
+        if comprimido: yield comprimido
+    yield compressor.flush()
+
+
+FORMATOS_EXPORTACAO = {
+    'ndjson': (linhas_ndjson, 'application/x-ndjson', 'ndjson'),
+    'csv': (linhas_csv, 'text/csv; charset=utf-8', 'csv'),
+}
+
+
+@app.route('/api/admin/export/<recurso>', methods=['GET'])
+def admin_exportar(recurso):
+    """ Exporta pedidos, pedido_itens ou clientes (?formato=ndjson|csv&data_inicio=&data_fim=&status=&cliente_id=). """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    if recurso not in EXPORTACOES:
+        return jsonify({"erro": f"Exportação desconhecida. Use: {', '.join(EXPORTACOES)}."}), 404
+    formato = request.args.get('formato', 'ndjson').lower()
+    if formato not in FORMATOS_EXPORTACAO:
+        raise ParametroInvalido("formato deve ser 'ndjson' ou 'csv'.")
+
+    filtros, params = filtros_pedidos(request.args)
+    if recurso == 'clientes' and filtros:
+        filtros = ["EXISTS (SELECT 1 FROM suagrafica_pedidos p WHERE p.cliente_id = c.id AND " + " AND ".join(filtros) + ")"]
+    sql = EXPORTACOES[recurso].format(filtros=("WHERE " + " AND ".join(filtros)) if filtros else "")
+
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cur.itersize = EXPORT_ITERSIZE
+        cur.execute(sql, params)
+    except BaseException:
+        pool.putconn(conn, close=bool(conn.closed))
+        raise
+
+    gerador, content_type, extensao = FORMATOS_EXPORTACAO[formato]
+    pedacos = gerador(cur, cur.itersize)
+    headers = {'Content-Disposition': f'attachment; filename="{recurso}-{datetime.now():%Y%m%d-%H%M}.{extensao}"',
+               'Cache-Control': 'no-store'}
+    if request.accept_encodings['gzip']:
+        pedacos = comprimir_gzip(pedacos)
+        headers['Content-Encoding'] = 'gzip'
+    resp = resposta_com_conexao(pool, conn, pedacos, content_type=content_type, headers=headers)
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+# --- IMPORTAÇÃO DE PRODUTOS EM MASSA (COPY + UPSERT) ---
+# Catálogo do fornecedor em CSV ou NDJSON. O corpo é lido em streaming, cada
+# linha é validada em Python e as válidas seguem por COPY para uma tabela
+# temporária; um único INSERT ... ON CONFLICT (codigo_produto) grava tudo.
+# Coluna ausente ou vazia mantém o valor atual (em produto novo, o padrão);
+# código repetido no arquivo: vale a última linha. Um comando só: o trigger de
+# versão dispara uma vez por instrução (no máximo duas: INSERT e o UPDATE do
+# ON CONFLICT), não por produto, e o cache local é invalidado uma vez.
+IMPORTACAO_MAX_LINHAS = int(os.environ.get("IMPORTACAO_MAX_LINHAS", 200_000))
+IMPORTACAO_MAX_ERROS = int(os.environ.get("IMPORTACAO_MAX_ERROS", 1000))
+IMPORTACAO_LOTE_COPY = 1000
+
+COLUNAS_IMPORTACAO = ('codigo_produto', 'nome_produto', 'descricao', 'preco_minimo', 'multiplos_de',
+                      'estoque_disponivel', 'imagem_url', 'esta_ativo')
+TAMANHOS_IMPORTACAO = {'codigo_produto': 50, 'nome_produto': 255, 'imagem_url': 255}
+BOOLEANOS_IMPORTACAO = {'1': True, 'true': True, 'sim': True, 's': True, 'yes': True, 'x': True,
+                        '0': False, 'false': False, 'nao': False, 'não': False, 'n': False, 'no': False}
+PRECO_MAXIMO = Decimal('99999999.99')  # DECIMAL(10, 2)
+INT_MAXIMO = 2 ** 31 - 1
+
+IMPORTACAO_STAGING_SQL = """
+    CREATE TEMP TABLE produtos_importacao (
+        linha INTEGER NOT NULL,
+        codigo_produto VARCHAR(50) NOT NULL,
+        nome_produto VARCHAR(255),
+        descricao TEXT,
+        preco_minimo DECIMAL(10, 2),
+        multiplos_de INTEGER,
+        estoque_disponivel BOOLEAN,
+        imagem_url VARCHAR(255),
+        esta_ativo BOOLEAN
+    ) ON COMMIT DROP
+"""
+IMPORTACAO_UPSERT_SQL = """
+    WITH gravados AS (
+        INSERT INTO suagrafica_produtos AS p (codigo_produto, nome_produto, descricao, preco_minimo, multiplos_de,
+                                              estoque_disponivel, imagem_url, esta_ativo)
+        SELECT DISTINCT ON (s.codigo_produto)
+               s.codigo_produto,
+               COALESCE(s.nome_produto, e.nome_produto),
+               COALESCE(s.descricao, e.descricao),
+               COALESCE(s.preco_minimo, e.preco_minimo, 0),
+               COALESCE(s.multiplos_de, e.multiplos_de, 1),
+               COALESCE(s.estoque_disponivel, e.estoque_disponivel, TRUE),
+               COALESCE(s.imagem_url, e.imagem_url),
+               COALESCE(s.esta_ativo, e.esta_ativo, TRUE)
+        FROM produtos_importacao s
+        LEFT JOIN suagrafica_produtos e ON e.codigo_produto = s.codigo_produto
+        WHERE s.nome_produto IS NOT NULL OR e.id IS NOT NULL
+        ORDER BY s.codigo_produto, s.linha DESC
+        ON CONFLICT (codigo_produto) DO UPDATE SET
+            nome_produto = EXCLUDED.nome_produto, descricao = EXCLUDED.descricao,
+            preco_minimo = EXCLUDED.preco_minimo, multiplos_de = EXCLUDED.multiplos_de,
+            estoque_disponivel = EXCLUDED.estoque_disponivel, imagem_url = EXCLUDED.imagem_url,
+            esta_ativo = EXCLUDED.esta_ativo
+        -- Linha idêntica à atual não é regravada (nem conta como atualizada)
+        WHERE (p.nome_produto, p.descricao, p.preco_minimo, p.multiplos_de, p.estoque_disponivel,
+               p.imagem_url, p.esta_ativo)
+              IS DISTINCT FROM
+              (EXCLUDED.nome_produto, EXCLUDED.descricao, EXCLUDED.preco_minimo, EXCLUDED.multiplos_de,
+               EXCLUDED.estoque_disponivel, EXCLUDED.imagem_url, EXCLUDED.esta_ativo)
+        RETURNING (xmax = 0) AS inserido
+    )
+    SELECT count(*) FILTER (WHERE inserido), count(*) FILTER (WHERE NOT inserido) FROM gravados
+"""
+
+
+def normalizar_produto_importado(bruto):
+    """Linha do arquivo -> tupla na ordem de COLUNAS_IMPORTACAO (None = manter). Levanta ValueError."""
+    valores = {}
+    for coluna in COLUNAS_IMPORTACAO:
+        valor = bruto.get(coluna)
+        if isinstance(valor, str):
+            valor = valor.strip() or None
+        valores[coluna] = valor
+
+    for coluna in ('codigo_produto', 'nome_produto', 'descricao', 'imagem_url'):
+        valor = valores[coluna]
+        if valor is None: continue
+        if isinstance(valor, (dict, list, bool)):
+            raise ValueError(f"{coluna} deve ser texto.")
+        valor = valores[coluna] = str(valor)
+        if len(valor) > TAMANHOS_IMPORTACAO.get(coluna, len(valor)):
+            raise ValueError(f"{coluna} passa de {TAMANHOS_IMPORTACAO[coluna]} caracteres.")
+    if not valores['codigo_produto']:
+        raise ValueError("codigo_produto é obrigatório.")
+
+    preco = valores['preco_minimo']
+    if preco is not None:
+        if isinstance(preco, str):
+            preco = preco.replace('R$', '').strip()
+            if ',' in preco: preco = preco.replace('.', '').replace(',', '.')  # 1.234,56
+        try:
+            if isinstance(preco, (bool, dict, list)): raise InvalidOperation
+            preco = Decimal(str(preco))
+        except InvalidOperation:
+            raise ValueError("preco_minimo inválido.")
+        if not preco.is_finite() or preco < 0 or preco > PRECO_MAXIMO:
+            raise ValueError("preco_minimo fora da faixa (0 a 99.999.999,99).")
+        valores['preco_minimo'] = preco.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    multiplo = valores['multiplos_de']
+    if multiplo is not None:
+        try:
+            if isinstance(multiplo, (bool, dict, list)): raise InvalidOperation
+            multiplo = Decimal(str(multiplo))
+        except InvalidOperation:
+            raise ValueError("multiplos_de inválido.")
+        if not multiplo.is_finite() or multiplo != multiplo.to_integral_value() or not 1 <= multiplo <= INT_MAXIMO:
+            raise ValueError("multiplos_de deve ser um inteiro positivo.")
+        valores['multiplos_de'] = int(multiplo)
+
+    for coluna in ('estoque_disponivel', 'esta_ativo'):
+        valor = valores[coluna]
+        if valor is None or isinstance(valor, bool): continue
+        chave = str(valor).lower() if not isinstance(valor, (dict, list)) else None
+        if chave not in BOOLEANOS_IMPORTACAO:
+            raise ValueError(f"{coluna} deve ser sim/não (true/false, 1/0).")
+        valores[coluna] = BOOLEANOS_IMPORTACAO[chave]
+    return tuple(valores[coluna] for coluna in COLUNAS_IMPORTACAO)
+
+
+def campo_copy(valor):
+    """Valor no formato texto do COPY (\\N = NULL, barras/tabs/quebras escapados)."""
+    if valor is None: return '\\N'
+    if isinstance(valor, bool): return 't' if valor else 'f'
+    return str(valor).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class FluxoCopy:
+    """
+    Objeto-arquivo sobre um gerador de pedaços de bytes, para cursor.copy_expert().
+    O psycopg2 troca uma exceção do read() por QueryCanceled; a original fica em `erro`.
+    """
+
+    def __init__(self, pedacos):
+        self._pedacos = iter(pedacos)
+        self.erro = None
+
+    def read(self, size=-1):
+        try:
+            return next(self._pedacos, b'')  # b'' = fim do COPY
+        except Exception as e:
+            self.erro = e
+            raise
+
+    readline = read
+
+
+def linhas_csv_importacao(fluxo):
+    """(número da linha, dict, erro) de um CSV com cabeçalho; ';' ou ',' detectado pela 1ª linha."""
+    texto = io.TextIOWrapper(fluxo, encoding='utf-8-sig', newline='')
+    leitor = None
+    try:
+        primeira = texto.readline()
+        delimitador = ';' if primeira.count(';') > primeira.count(',') else ','
+        leitor = csv.DictReader(itertools.chain([primeira], texto), delimiter=delimitador)
+        leitor.fieldnames = [(c or '').strip().lower() for c in (leitor.fieldnames or [])]
+        if 'codigo_produto' not in leitor.fieldnames:
+            raise ParametroInvalido("O CSV precisa de cabeçalho com a coluna codigo_produto.")
+        for linha in leitor:
+            yield leitor.line_num, linha, None
+    except UnicodeDecodeError:
+        raise ParametroInvalido(f"O CSV deve estar em UTF-8 (erro perto da linha {(leitor.line_num if leitor else 0) + 1}).")
+    except csv.Error as e:
+        raise ParametroInvalido(f"CSV malformado na linha {leitor.line_num}: {e}")
+
+
+def linhas_ndjson_importacao(fluxo):
+    """(número da linha, dict, erro) de um NDJSON: um objeto por linha."""
+    for numero, linha in enumerate(fluxo, start=1):
+        linha = linha.strip()
+        if not linha: continue
+        try:
+            objeto = json.loads(linha)
+        except ValueError:
+            yield numero, None, "JSON inválido."
+            continue
+        if not isinstance(objeto, dict):
+            yield numero, None, "Cada linha deve ser um objeto JSON."
+            continue
+        yield numero, objeto, None
+
+
+LEITORES_IMPORTACAO = {'csv': linhas_csv_importacao, 'ndjson': linhas_ndjson_importacao}
+
+
+def importar_produtos(conn, linhas, simular=False):
+    """
+    Carrega `linhas` ((número, dict, erro)) por COPY e faz o upsert num único
+    comando, na transação de `conn` (commit, ou rollback com `simular`).
+    Devolve o relatório com os erros por linha.
+    """
+    relatorio = {"linhas": 0, "inseridos": 0, "atualizados": 0, "sem_alteracao": 0, "com_erro": 0,
+                 "erros": [], "erros_omitidos": 0, "simulacao": simular}
+    vistos = {}  # codigo_produto -> linha da última ocorrência
+
+    def erro(numero, codigo, mensagem):
+        relatorio["com_erro"] += 1
+        if len(relatorio["erros"]) < IMPORTACAO_MAX_ERROS:
+            relatorio["erros"].append({"linha": numero, "codigo_produto": codigo, "erro": mensagem})
+        else:
+            relatorio["erros_omitidos"] += 1
+
+    def pedacos():
+        lote = []
+        for numero, bruto, problema in linhas:
+            relatorio["linhas"] += 1
+            if relatorio["linhas"] > IMPORTACAO_MAX_LINHAS:
+                raise ParametroInvalido(f"O arquivo passa de {IMPORTACAO_MAX_LINHAS} linhas; divida a importação.")
+            codigo = bruto.get('codigo_produto') if bruto else None
+            if problema:
+                erro(numero, codigo, problema)
+                continue
+            try:
+                valores = normalizar_produto_importado(bruto)
+            except ValueError as e:
+                erro(numero, codigo, str(e))
+                continue
+            anterior = vistos.get(valores[0])
+            if anterior is not None:
+                erro(anterior, valores[0], f"Código repetido na linha {numero}; vale a última ocorrência.")
+            vistos[valores[0]] = numero
+            lote.append('\t'.join([str(numero)] + [campo_copy(v) for v in valores]) + '\n')
+            if len(lote) >= IMPORTACAO_LOTE_COPY:
+                yield ''.join(lote).encode('utf-8')
+                lote = []
+        if lote:
+            yield ''.join(lote).encode('utf-8')
+
+    cur = conn.cursor()
+    cur.execute(IMPORTACAO_STAGING_SQL)
+    fluxo = FluxoCopy(pedacos())
+    try:
+        cur.copy_expert(f"COPY produtos_importacao (linha, {', '.join(COLUNAS_IMPORTACAO)}) FROM STDIN", fluxo)
+    except psycopg2.Error:
+        conn.rollback()
+        if fluxo.erro: raise fluxo.erro from None  # erro do arquivo (ParametroInvalido vira 400)
+        raise
+
+    # Produto novo precisa de nome: sem ele a linha não entra (e vira erro no relatório)
+    cur.execute("""
+        SELECT DISTINCT ON (s.codigo_produto) s.linha, s.codigo_produto FROM produtos_importacao s
+        WHERE s.nome_produto IS NULL
+          AND NOT EXISTS (SELECT 1 FROM suagrafica_produtos p WHERE p.codigo_produto = s.codigo_produto)
+        ORDER BY s.codigo_produto, s.linha DESC
+    """)
+    sem_nome = cur.fetchall()
+    for numero, codigo in sem_nome:
+        erro(numero, codigo, "Produto novo sem nome_produto.")
+
+    cur.execute(IMPORTACAO_UPSERT_SQL)
+    relatorio["inseridos"], relatorio["atualizados"] = cur.fetchone()
+    relatorio["sem_alteracao"] = len(vistos) - len(sem_nome) - relatorio["inseridos"] - relatorio["atualizados"]
+    relatorio["erros"].sort(key=lambda e: e["linha"])
+    if simular:
+        conn.rollback()
+    else:
+        conn.commit()
+    return relatorio
+
+
+@app.route('/api/admin/produtos/importar', methods=['POST'])
+def admin_importar_produtos():
+    """ Cria/atualiza produtos em massa pelo codigo_produto (corpo CSV ou NDJSON; ?formato=csv|ndjson&simular=1). """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    formato = request.args.get('formato') or ('ndjson' if 'json' in (request.mimetype or '') else 'csv')
+    if formato.lower() not in LEITORES_IMPORTACAO:
+        raise ParametroInvalido("formato deve ser 'csv' ou 'ndjson'.")
+    simular = request.args.get('simular', '').lower() in ('1', 'true', 'sim')
+
+    inicio = time.perf_counter()
+    with db_connection() as conn:
+        try:
+            relatorio = importar_produtos(conn, LEITORES_IMPORTACAO[formato.lower()](io.BufferedReader(request.stream)), simular)
+        except ParametroInvalido:
+            raise
+        except Exception as e:
+            conn.rollback()
+            traceback.print_exc()
+            return jsonify({"erro": str(e)}), 500
+    if not simular and (relatorio["inseridos"] or relatorio["atualizados"]):
+        catalog_cache.invalidar()  # os outros workers invalidam pelo NOTIFY do trigger de versão
+        agendar_imagens()  # imagem_url novos/alterados
+    relatorio["segundos"] = round(time.perf_counter() - inicio, 2)
+    print(f"📦 [IMPORTAÇÃO] {relatorio['linhas']} linhas: {relatorio['inseridos']} novos, "
+          f"{relatorio['atualizados']} atualizados, {relatorio['com_erro']} com erro ({relatorio['segundos']}s)")
+    return jsonify(relatorio)
+
+
+@app.cli.command("importar-produtos")
+@click.argument("arquivo", type=click.File("rb"))
+@click.option("--formato", type=click.Choice(list(LEITORES_IMPORTACAO)), help="Padrão: pela extensão do arquivo.")
+@click.option("--simular", is_flag=True, help="Valida e conta sem gravar.")
+def cli_importar_produtos(arquivo, formato, simular):
+    """Importa um catálogo (CSV ou NDJSON) direto no banco, como POST /api/admin/produtos/importar."""
+    formato = formato or ('ndjson' if arquivo.name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with db_connection() as conn:
+        relatorio = importar_produtos(conn, LEITORES_IMPORTACAO[formato](arquivo), simular)
+    for e in relatorio["erros"]:
+        print(f"⚠️  linha {e['linha']} ({e['codigo_produto']}): {e['erro']}")
+    print(f"{'ℹ️  Simulação' if simular else '✅ Importação'}: {relatorio['linhas']} linhas, "
+          f"{relatorio['inseridos']} novos, {relatorio['atualizados']} atualizados, "
+          f"{relatorio['sem_alteracao']} sem alteração, {relatorio['com_erro']} com erro.")
+
+
+# --- IMAGENS DE PRODUTOS (VERSÕES WEBP/JPEG ENDEREÇADAS POR CONTEÚDO) ---
+# A original (upload do admin, download do imagem_url ou arquivo local, como o
+# logo.png) é identificada pelo sha256 dos bytes. Dela saem versões em larguras
+# fixas, em WebP e JPEG, gravadas em IMAGENS_DIR/<2 primeiros>/<hash>-<largura>.<ext>.
+# Conteúdo novo = nome novo, então /img/ responde com cache imutável de um ano
+# (e Range/304 pelo send_file). Catálogo, busca e lista do admin trazem os
+# srcset prontos em "imagens"; sem versões (ou sem Pillow) o campo vem null e
+# o front continua no imagem_url original.
+IMAGENS_DIR = os.environ.get("IMAGENS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "imagens"))
+IMAGENS_LARGURAS = tuple(sorted({int(l) for l in os.environ.get("IMAGENS_LARGURAS", "160,320,640,1024").split(",")}))
+IMAGENS_URL_BASE = os.environ.get("IMAGENS_URL_BASE", "/img/")  # ex.: https://cdn.exemplo.com/img/
+IMAGENS_MAX_BYTES = int(os.environ.get("IMAGENS_MAX_BYTES", 10 * 1024 * 1024))
+IMAGENS_MAX_PIXELS = int(os.environ.get("IMAGENS_MAX_PIXELS", 40_000_000))
+IMAGENS_TIMEOUT = float(os.environ.get("IMAGENS_TIMEOUT", 15))
+IMAGENS_LOTE = 500  # produtos por UPDATE (= por versão nova do catálogo) no processamento em massa
+IMAGENS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+FORMATOS_IMAGEM = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+NOME_VERSAO_IMAGEM = re.compile(r'^([0-9a-f]{64})-(\d+)\.(webp|jpg)$')
+
+# Colunas "imagens" ({src, webp, jpeg} com os srcset) para SELECTs com LEFT JOIN suagrafica_imagens i
+IMAGENS_SQL = """
+    CASE WHEN i.hash IS NOT NULL THEN json_build_object(
+        'src', %(img_base)s || i.hash || '-' || i.larguras[1] || '.jpg',
+        'webp', (SELECT string_agg(%(img_base)s || i.hash || '-' || l || '.webp ' || l || 'w', ', ' ORDER BY l) FROM unnest(i.larguras) l),
+        'jpeg', (SELECT string_agg(%(img_base)s || i.hash || '-' || l || '.jpg ' || l || 'w', ', ' ORDER BY l) FROM unnest(i.larguras) l)
+    ) END AS imagens
+"""
+IMAGENS_JOIN = "LEFT JOIN suagrafica_imagens i ON i.hash = p.imagem_hash"
+IMAGENS_PARAMS = {"img_base": IMAGENS_URL_BASE}
+
+
+class ImagemInvalida(ParametroInvalido):
+    """Arquivo que não dá para transformar nas versões reduzidas (vira 400)."""
+
+
+def caminho_imagem(nome):
+    return os.path.join(IMAGENS_DIR, nome[:2], nome)
+
+
+def montar_imagens(hash_imagem, larguras):
+    """Mesmo formato de IMAGENS_SQL, para respostas montadas em Python."""
+    def srcset(ext):
+        return ', '.join(f"{IMAGENS_URL_BASE}{hash_imagem}-{l}.{ext} {l}w" for l in larguras)
+    return {"src": f"{IMAGENS_URL_BASE}{hash_imagem}-{larguras[0]}.jpg", "webp": srcset('webp'), "jpeg": srcset('jpg')}
+
+
+def gravar_arquivo(caminho, dados):
+    """Grava via arquivo temporário + rename: ninguém serve um arquivo pela metade."""
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporario, 'wb') as f:
+        f.write(dados)
+    os.replace(temporario, caminho)
+
+
+def gerar_versoes_imagem(conteudo):
+    """
+    Bytes da original -> (hash, largura, altura, larguras geradas). Idempotente:
+    versões que já estão no disco não são refeitas. Não amplia: só entram as
+    larguras até a da original (ou a própria, se for menor que todas).
+    """
+    if Image is None:
+        raise ImagemInvalida("Pillow não está instalado; as versões reduzidas das imagens estão desligadas.")
+    hash_imagem = hashlib.sha256(conteudo).hexdigest()
+    try:
+        img = Image.open(io.BytesIO(conteudo))
+        if img.width * img.height > IMAGENS_MAX_PIXELS:
+            raise ImagemInvalida(f"Imagem com mais de {IMAGENS_MAX_PIXELS} pixels.")
+        img = ImageOps.exif_transpose(img)  # foto de celular "deitada" no EXIF
+        img.load()
+    except ImagemInvalida:
+        raise
+    except Exception:
+        raise ImagemInvalida("O arquivo não é uma imagem reconhecida.")
+
+    larguras = [l for l in IMAGENS_LARGURAS if l <= img.width] or [img.width]
+    transparente = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    base = img.convert('RGBA' if transparente else 'RGB')
+    if not os.path.exists(caminho_imagem(hash_imagem)):
+        gravar_arquivo(caminho_imagem(hash_imagem), conteudo)  # original, para refazer com outras larguras
+    for largura in larguras:
+        faltando = [ext for ext in FORMATOS_IMAGEM if not os.path.exists(caminho_imagem(f"{hash_imagem}-{largura}.{ext}"))]
+        if not faltando: continue
+        reduzida = base if largura == base.width else base.resize(
+            (largura, max(1, round(base.height * largura / base.width))), Image.LANCZOS)
+        for ext in faltando:
+            formato, _, opcoes = FORMATOS_IMAGEM[ext]
+            saida = reduzida
+            if formato == 'JPEG' and saida.mode == 'RGBA':  # JPEG não tem alfa: fundo branco, como no card
+                saida = Image.new('RGB', reduzida.size, (255, 255, 255))
+                saida.paste(reduzida, mask=reduzida.getchannel('A'))
+            buffer = io.BytesIO()
+            saida.save(buffer, formato, **opcoes)
+            gravar_arquivo(caminho_imagem(f"{hash_imagem}-{largura}.{ext}"), buffer.getvalue())
+    return hash_imagem, img.width, img.height, larguras
+
+
+def registrar_imagem(cur, conteudo, origem):
+    """Gera as versões e registra a imagem em suagrafica_imagens (sem commit). Devolve (hash, larguras)."""
+    hash_imagem, largura, altura, larguras = gerar_versoes_imagem(conteudo)
+    cur.execute("""
+        INSERT INTO suagrafica_imagens (hash, origem, largura, altura, larguras) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (hash) DO UPDATE SET larguras = EXCLUDED.larguras
+    """, (hash_imagem, origem, largura, altura, larguras))
+    return hash_imagem, larguras
+
+
+def baixar_imagem(url):
+    """Baixa a imagem de um imagem_url http(s), com teto de tamanho e timeout."""
+    if not url.lower().startswith(('http://', 'https://')):
+        raise ImagemInvalida("imagem_url precisa ser um endereço http(s).")
+    try:
+        with requests.get(url, stream=True, timeout=IMAGENS_TIMEOUT) as r:
+            r.raise_for_status()
+            partes, total = [], 0
+            for parte in r.iter_content(64 * 1024):
+                total += len(parte)
+                if total > IMAGENS_MAX_BYTES:
+                    raise ImagemInvalida(f"Imagem com mais de {IMAGENS_MAX_BYTES // (1024 * 1024)} MB.")
+                partes.append(parte)
+    except requests.RequestException as e:
+        raise ImagemInvalida(f"Falha ao baixar a imagem: {e}")
+    return b''.join(partes)
+
+
+def processar_imagens_produtos(ids=None, todos=False):
+    """
+    Gera as versões dos produtos cujo imagem_url ainda não foi processado
+    (imagem_url <> imagem_origem), ou de todos com `todos`. Cada URL é baixada
+    uma vez; os produtos são atualizados em lotes de IMAGENS_LOTE. URL que
+    falha fica marcada como processada (sem imagem_hash) e vai para `erros`.
+    Devolve (produtos atualizados, erros).
+    """
+    filtros = ["imagem_url IS NOT NULL", "imagem_url <> ''"]
+    if not todos: filtros.append("imagem_url IS DISTINCT FROM imagem_origem")
+    if ids is not None: filtros.append("id = ANY(%(ids)s)")
+    atualizados, erros, feitos = 0, [], []
+
+    def gravar(cur):
+        nonlocal atualizados
+        if not feitos: return
+        # Só grava se o imagem_url não mudou enquanto baixávamos
+        psycopg2.extras.execute_values(cur, """
+            UPDATE suagrafica_produtos p SET imagem_hash = v.hash, imagem_origem = v.url
+            FROM (VALUES %s) AS v (id, url, hash)
+            WHERE p.id = v.id AND p.imagem_url = v.url
+        """, feitos, template="(%s, %s, %s::char(64))", page_size=len(feitos))
+        atualizados += cur.rowcount
+        cur.connection.commit()
+        feitos.clear()
+        catalog_cache.invalidar()
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT id, imagem_url FROM suagrafica_produtos WHERE {' AND '.join(filtros)} ORDER BY id",
+                    {"ids": list(ids or [])})
+        por_url = {}
+        for produto_id, url in cur.fetchall():
+            por_url.setdefault(url.strip(), []).append((produto_id, url))
+        conn.commit()  # não segura transação aberta durante os downloads
+
+        for url, produtos in por_url.items():
+            try:
+                cur.execute("SELECT hash FROM suagrafica_imagens WHERE origem = %s LIMIT 1", (url,))
+                linha = cur.fetchone()
+                hash_imagem = linha[0] if linha else registrar_imagem(cur, baixar_imagem(url), url)[0]
+                conn.commit()
+            except ImagemInvalida as e:
+                conn.rollback()
+                hash_imagem = None
+                erros.append({"url": url, "produtos": [p for p, _ in produtos], "erro": str(e)})
+            feitos.extend((produto_id, original, hash_imagem) for produto_id, original in produtos)
+            if len(feitos) >= IMAGENS_LOTE: gravar(cur)
+        gravar(cur)
+    return atualizados, erros
+
+
+_imagens_executor = None
+_imagens_executor_lock = threading.Lock()
+
+
+def agendar_imagens(ids=None):
+    """Processa as imagens pendentes em segundo plano (o admin não espera o download)."""
+    global _imagens_executor
+    if Image is None: return
+    with _imagens_executor_lock:
+        if _imagens_executor is None or _imagens_executor.pid != os.getpid():
+            _imagens_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imagens")
+            _imagens_executor.pid = os.getpid()
+        _imagens_executor.submit(_processar_imagens_agendadas, ids)
+
+
+def _processar_imagens_agendadas(ids):
+    try:
+        atualizados, erros = processar_imagens_produtos(ids)
+        for e in erros:
+            print(f"⚠️ [IMAGENS] {e['url']}: {e['erro']}")
+        if atualizados: print(f"✅ [IMAGENS] {atualizados} produto(s) com versões novas.")
+    except Exception:
         traceback.print_exc()
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
+
+
+@app.route('/img/<nome>', methods=['GET'])
+def servir_imagem(nome):
+    """ Versão de imagem (<hash>-<largura>.webp|jpg): cache imutável, ETag e Range. """
+    casou = NOME_VERSAO_IMAGEM.match(nome)
+    if not casou or not os.path.exists(caminho_imagem(nome)):
+        return jsonify({"erro": "Imagem não encontrada"}), 404
+    resp = send_file(caminho_imagem(nome), mimetype=FORMATOS_IMAGEM[casou.group(3)][1],
+                     conditional=True, etag=nome, max_age=31536000)
+    resp.headers['Cache-Control'] = IMAGENS_CACHE_CONTROL
+    return resp
+
+
+@app.route('/api/admin/produtos/<int:id>/imagem', methods=['POST'])
+def admin_enviar_imagem_produto(id):
+    """ Envia a imagem do produto: corpo cru (image/*) ou multipart com o campo 'arquivo'. """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    if (request.content_length or 0) > IMAGENS_MAX_BYTES + 64 * 1024:
+        return jsonify({"erro": f"Imagem com mais de {IMAGENS_MAX_BYTES // (1024 * 1024)} MB."}), 413
+    arquivo = request.files.get('arquivo')
+    conteudo = arquivo.read() if arquivo else request.get_data(cache=False)
+    if not conteudo:
+        raise ImagemInvalida("Envie a imagem no corpo (image/*) ou no campo 'arquivo'.")
+    if len(conteudo) > IMAGENS_MAX_BYTES:
+        return jsonify({"erro": f"Imagem com mais de {IMAGENS_MAX_BYTES // (1024 * 1024)} MB."}), 413
+
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1 FROM suagrafica_produtos WHERE id = %s", (id,))
+            if not cur.fetchone(): return jsonify({"erro": "Não encontrado"}), 404
+            hash_imagem, larguras = registrar_imagem(cur, conteudo, f"upload:produto/{id}")
+            # imagem_origem = imagem_url atual: o upload vale até o admin trocar a URL
+            cur.execute("UPDATE suagrafica_produtos SET imagem_hash = %s, imagem_origem = imagem_url WHERE id = %s",
+                        (hash_imagem, id))
+            conn.commit()
+        except ImagemInvalida:
+            conn.rollback()
+            raise
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
+    catalog_cache.invalidar()
+    return jsonify({"mensagem": "Imagem atualizada!", "hash": hash_imagem, "imagens": montar_imagens(hash_imagem, larguras)})
+
+
+@app.cli.command("imagens-processar")
+@click.option("--todos", is_flag=True, help="Refaz todos os produtos com imagem_url (não só os pendentes).")
+@click.option("--produto", "ids", type=int, multiple=True, help="Só estes produtos (pode repetir).")
+@click.option("--arquivo", "arquivos", type=click.Path(exists=True, dir_okay=False), multiple=True,
+              help="Arquivo local avulso (ex.: logo.png); mostra as URLs geradas.")
+def cli_imagens_processar(todos, ids, arquivos):
+    """Gera as versões WebP/JPEG das imagens dos produtos (e de arquivos avulsos)."""
+    if Image is None:
+        print("🔴 Pillow não está instalado (pip install Pillow).")
+        raise SystemExit(1)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for caminho in arquivos:
+            with open(caminho, 'rb') as f:
+                hash_imagem, larguras = registrar_imagem(cur, f.read(), f"arquivo:{os.path.basename(caminho)}")
+            conn.commit()
+            imagens = montar_imagens(hash_imagem, larguras)
+            print(f"✅ {caminho}: src={imagens['src']}\n   webp: {imagens['webp']}\n   jpeg: {imagens['jpeg']}")
+    if arquivos and not (todos or ids): return
+    atualizados, erros = processar_imagens_produtos(list(ids) or None, todos)
+    for e in erros:
+        print(f"⚠️  {e['url']} (produtos {e['produtos']}): {e['erro']}")
+    print(f"✅ {atualizados} produto(s) atualizados, {len(erros)} URL(s) com erro.")
 
 
 # ======================================================================
 # 4. ROTAS DO CLIENTE (B2B)
 # ======================================================================
+# --- CACHE DO CATÁLOGO (JSON PRONTO EM MEMÓRIA) ---
+# Qualquer escrita em suagrafica_produtos incrementa a versão da tabela e faz
+# NOTIFY (trigger); todos os workers descartam o JSON em cache ao receber.
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", 300))
+
+
+class CatalogCache:
+    """Guarda os bytes JSON de /api/cliente/produtos junto com a versão do catálogo."""
+
+    def __init__(self, ttl=CATALOG_CACHE_TTL):
+        self.ttl = ttl
+        self.pid = None
+        self._lock = threading.Lock()
+        self._payload = None
+        self._versao = None
+        self._carregado_em = 0.0
+        self._geracao = 0  # muda a cada invalidação; evita gravar um rebuild já obsoleto
+        self.hits = 0
+        self.misses = 0
+
+    def _garantir_listener(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.invalidar()
+            get_pg_listener().registrar(VERSOES_CANAL, self._on_notify, ao_reconectar=self.invalidar)
+
+    def _on_notify(self, payload):
+        if payload.split(':', 1)[0] == 'suagrafica_produtos':
+            self.invalidar()
+
+    def invalidar(self):
+        with self._lock:
+            self._geracao += 1
+            self._payload = None
+
+    def get(self):
+        """Retorna (versao, bytes). Só vai ao banco se o cache estiver vazio ou não confiável."""
+        self._garantir_listener()
+        confiavel = get_pg_listener().online
+        with self._lock:
+            if (confiavel and self._payload is not None
+                    and time.monotonic() - self._carregado_em < self.ttl):
+                self.hits += 1
+                return self._versao, self._payload
+            geracao = self._geracao
+            self.misses += 1
+
+        versao, payload = self._carregar()
+        with self._lock:
+            if confiavel and geracao == self._geracao:
+                self._versao, self._payload = versao, payload
+                self._carregado_em = time.monotonic()
+        return versao, payload
+
+    def _carregar(self):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # Versão lida na mesma transação dos dados
+            versao = versoes_tabelas(cur, 'suagrafica_produtos')[0]
+            cur.execute(f"""
+                SELECT {PRODUTO_COLUNAS_P}, {IMAGENS_SQL} FROM suagrafica_produtos p {IMAGENS_JOIN}
+                WHERE p.esta_ativo = TRUE AND p.estoque_disponivel = TRUE ORDER BY p.nome_produto
+            """, IMAGENS_PARAMS)
+            return versao, b''.join(linhas_json(cur))
+
+    def stats(self):
+        with self._lock:
+            return {"versao": self._versao, "em_cache": self._payload is not None,
+                    "hits": self.hits, "misses": self.misses,
+                    "listener_online": get_pg_listener().online}
+
+
+catalog_cache = CatalogCache()
+metricas.medidor("catalogo_cache", "Cache do catálogo", catalog_cache.stats)
+
+
 @app.route('/api/cliente/produtos', methods=['GET'])
 def cliente_produtos():
     if not check_client_auth(request): return jsonify({"erro": "Não autorizado"}), 403
     
-    conn = get_db_connection()
+    versao, payload = catalog_cache.get()
+    # ETag sai da versão guardada junto com o cache: 304 sem tocar no banco
+    etag = montar_etag('catalogo', versao)
+    if etag_confere(etag): return nao_modificado(etag)
+    resp = Response(payload, mimetype='application/json')
+    resp.headers['X-Catalog-Version'] = str(versao)
+    return com_etag(resp, etag)
+
+# --- BUSCA DE PRODUTOS (tsvector + pg_trgm) ---
+# Usa a coluna busca_tsv (mantida por trigger, migração 0003) com stemming em
+# português, sem acentos. Se o índice trigram existir, também aceita trechos e
+# erros de digitação no nome. Compartilhada pela rota de busca e pelo EloBot.
+_busca_trgm = {}  # pid -> bool
+
+
+def busca_trgm_disponivel(cur):
+    pid = os.getpid()
+    if pid not in _busca_trgm:
+        tcur = cur.connection.cursor()
+        tcur.execute("SELECT to_regclass('idx_produtos_nome_trgm') IS NOT NULL")
+        _busca_trgm[pid] = tcur.fetchone()[0]
+        tcur.close()
+    return _busca_trgm[pid]
+
+
+def montar_tsquery(termo):
+    """'Cadernos capa' -> 'Cadernos & capa:*' (a última palavra vale como prefixo, p/ type-ahead)."""
+    palavras = re.findall(r'\w+', termo or '')[:8]
+    if not palavras: return None
+    return ' & '.join(palavras[:-1] + [palavras[-1] + ':*'])
+
+
+def buscar_produtos(cur, termo, limite=5, offset=0, somente_disponiveis=False, com_imagens=False):
+    """Produtos ativos que casam com `termo`, ordenados por relevância (`com_imagens`: + coluna imagens)."""
+    tsquery = montar_tsquery(termo)
+    if not tsquery: return []
+    trgm = busca_trgm_disponivel(cur)
+    # As funções são IMMUTABLE: com o termo constante o planner as avalia uma vez e usa os índices GIN
+    relevancia = "ts_rank_cd(p.busca_tsv, to_tsquery('portuguese', suagrafica_normaliza(%(tsquery)s)))"
+    condicao = "p.busca_tsv @@ to_tsquery('portuguese', suagrafica_normaliza(%(tsquery)s))"
+    if trgm:
+        relevancia += " + similarity(suagrafica_normaliza(p.nome_produto), suagrafica_normaliza(%(termo)s))"
+        condicao = f"({condicao} OR suagrafica_normaliza(p.nome_produto) %% suagrafica_normaliza(%(termo)s))"
+    cur.execute(f"""
+        SELECT {PRODUTO_COLUNAS_P}, {relevancia} AS relevancia{", " + IMAGENS_SQL if com_imagens else ""}
+        FROM suagrafica_produtos p {IMAGENS_JOIN if com_imagens else ""}
+        WHERE p.esta_ativo = TRUE {"AND p.estoque_disponivel = TRUE" if somente_disponiveis else ""}
+          AND {condicao}
+        ORDER BY relevancia DESC, p.nome_produto
+        LIMIT %(limite)s OFFSET %(offset)s
+    """, {"tsquery": tsquery, "termo": termo, "limite": limite, "offset": offset, **IMAGENS_PARAMS})
+    return cur.fetchall()
+
+
+@app.route('/api/cliente/produtos/search', methods=['GET'])
+def cliente_buscar_produtos():
+    """ Busca paginada para o type-ahead do catálogo (?q=termo&pagina=1&limit=20). """
+    if not check_client_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    termo = request.args.get('q', '').strip()
+    limite = ler_limite(request.args)
     try:
+        pagina = max(1, int(request.args.get('pagina', 1)))
+    except ValueError:
+        raise ParametroInvalido("pagina deve ser um número.")
+    if len(termo) < 2:
+        return jsonify({"produtos": [], "pagina": pagina, "tem_mais": False})
+
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM suagrafica_produtos WHERE esta_ativo = TRUE AND estoque_disponivel = TRUE ORDER BY nome_produto")
-        produtos = cur.fetchall()
-        for p in produtos: 
-            p['preco_minimo'] = float(p['preco_minimo']) 
-        return jsonify(produtos)
-    finally:
-        if conn: conn.close()
+        produtos = buscar_produtos(cur, termo, limite + 1, (pagina - 1) * limite, somente_disponiveis=True,
+                                   com_imagens=True)
+    tem_mais = len(produtos) > limite
+    produtos = produtos[:limite]
+    for p in produtos:
+        p['relevancia'] = round(p['relevancia'], 4)
+    return jsonify({"produtos": produtos, "pagina": pagina, "tem_mais": tem_mais})
+
+# --- CRIAÇÃO DE PEDIDOS (preço no servidor, idempotente, em lote) ---
+# O preço unitário vem de suagrafica_produtos (uma consulta para todos os
+# produtos do lote), nunca do corpo; a quantidade tem que respeitar
+# multiplos_de. Cabeçalhos e itens entram num único INSERT com CTE, seja um
+# pedido ou centenas (integração com o ERP). Com o header Idempotency-Key a
+# chave é reservada em suagrafica_idempotencia na mesma transação do pedido:
+# repetir a requisição devolve a resposta gravada, sem pedido duplicado.
+PEDIDOS_LOTE_MAX = int(os.environ.get("PEDIDOS_LOTE_MAX", 500))
+PEDIDO_ITENS_MAX = int(os.environ.get("PEDIDO_ITENS_MAX", 200))
+IDEMPOTENCIA_TTL = int(os.environ.get("IDEMPOTENCIA_TTL", 24 * 3600))
+STATUS_PEDIDO_NOVO = 'Aguardando Aprovação'
+
+
+class PedidoInvalido(ParametroInvalido):
+    """Pedido(s) recusado(s) na validação; `detalhes` lista todos os problemas do lote."""
+
+    def __init__(self, detalhes):
+        extra = f" (e mais {len(detalhes) - 1})" if len(detalhes) > 1 else ""
+        super().__init__(f"Pedido inválido: {detalhes[0]}{extra}")
+        self.detalhes = detalhes
+
+
+@app.errorhandler(PedidoInvalido)
+def pedido_invalido(e):
+    return jsonify({"erro": str(e), "detalhes": e.detalhes}), 400
+
+
+def ler_inteiro_positivo(valor):
+    """int > 0 a partir de int ou string de dígitos; None para o resto (bool, float, texto)."""
+    if isinstance(valor, bool) or not isinstance(valor, (int, str)): return None
+    try:
+        numero = int(valor)
+    except ValueError:
+        return None
+    return numero if numero > 0 else None
+
+
+def ler_pedidos(lista, cliente_id=None):
+    """
+    [{"cliente_id"?, "itens": [{"produto_id", "quantidade"}]}] -> [(cliente_id, [(produto_id, quantidade)])].
+    Com `cliente_id` (token do cliente) o do corpo é ignorado. Campos de preço no corpo são ignorados.
+    """
+    if not isinstance(lista, list) or not lista:
+        raise PedidoInvalido(["nenhum pedido enviado"])
+    if len(lista) > PEDIDOS_LOTE_MAX:
+        raise PedidoInvalido([f"no máximo {PEDIDOS_LOTE_MAX} pedidos por requisição"])
+    pedidos, erros = [], []
+    for i, pedido in enumerate(lista):
+        prefixo = f"pedidos[{i}]" if len(lista) > 1 else "pedido"
+        if not isinstance(pedido, dict):
+            erros.append(f"{prefixo}: formato inválido")
+            continue
+        dono = cliente_id or ler_inteiro_positivo(pedido.get('cliente_id'))
+        if not dono:
+            erros.append(f"{prefixo}: cliente_id inválido")
+        itens = pedido.get('itens')
+        if not isinstance(itens, list) or not itens:
+            erros.append(f"{prefixo}: sem itens")
+            continue
+        if len(itens) > PEDIDO_ITENS_MAX:
+            erros.append(f"{prefixo}: no máximo {PEDIDO_ITENS_MAX} itens")
+            continue
+        lidos = []
+        for j, item in enumerate(itens):
+            item = item if isinstance(item, dict) else {}
+            produto_id = ler_inteiro_positivo(item.get('produto_id'))
+            quantidade = ler_inteiro_positivo(item.get('quantidade'))
+            if not produto_id or not quantidade:
+                erros.append(f"{prefixo}.itens[{j}]: produto_id e quantidade devem ser inteiros positivos")
+                continue
+            lidos.append((produto_id, quantidade))
+        pedidos.append((dono, lidos))
+    if erros: raise PedidoInvalido(erros)
+    return pedidos
+
+
+def precificar_pedidos(cur, pedidos):
+    """
+    Preço de cada item a partir do catálogo, com uma consulta para o lote todo.
+    Retorna [(cliente_id, valor_total, [(produto_id, quantidade, preco_unitario)])]; valores em Decimal.
+    """
+    ids = sorted({produto_id for _, itens in pedidos for produto_id, _ in itens})
+    # ::text mantém o NUMERIC exato (o typecaster do pool converte NUMERIC em float)
+    cur.execute("""
+        SELECT id, preco_minimo::text, COALESCE(multiplos_de, 1), esta_ativo AND estoque_disponivel
+        FROM suagrafica_produtos WHERE id = ANY(%s)
+    """, (ids,))
+    catalogo = {id: (Decimal(preco), max(multiplo, 1), disponivel) for id, preco, multiplo, disponivel in cur.fetchall()}
+
+    precificados, erros = [], []
+    for i, (cliente_id, itens) in enumerate(pedidos):
+        prefixo = f"pedidos[{i}]" if len(pedidos) > 1 else "pedido"
+        linhas = []
+        for j, (produto_id, quantidade) in enumerate(itens):
+            produto = catalogo.get(produto_id)
+            if not produto or not produto[2]:
+                erros.append(f"{prefixo}.itens[{j}]: produto {produto_id} inexistente ou indisponível")
+            elif quantidade % produto[1]:
+                erros.append(f"{prefixo}.itens[{j}]: quantidade do produto {produto_id} deve ser múltiplo de {produto[1]}")
+            else:
+                linhas.append((produto_id, quantidade, produto[0]))
+        precificados.append((cliente_id, sum(q * p for _, q, p in linhas), linhas))
+    if erros: raise PedidoInvalido(erros)
+    return precificados
+
+
+# nextval() numa CTE usada duas vezes é materializado: cada pedido recebe o id
+# antes do INSERT, e os itens se ligam a ele pela posição no lote (ordem).
+# Preparado uma vez por conexão: o plano da CTE custava mais que a execução.
+PREPARAR_INSERIR_PEDIDOS = """
+    PREPARE suagrafica_inserir_pedidos (int[], numeric[], text, int[], int[], int[], numeric[]) AS
+    WITH novos AS (
+        SELECT nextval('suagrafica_pedidos_id_seq')::int AS id, n.cliente_id, n.valor_total, n.ordem
+        FROM unnest($1, $2) WITH ORDINALITY AS n(cliente_id, valor_total, ordem)
+    ), cabecalhos AS (
+        INSERT INTO suagrafica_pedidos (id, cliente_id, valor_total, status_pedido)
+        SELECT id, cliente_id, valor_total, $3 FROM novos
+    ), itens AS (
+        INSERT INTO suagrafica_pedido_itens (pedido_id, produto_id, quantidade, preco_unitario_registrado)
+        SELECT novos.id, i.produto_id, i.quantidade, i.preco
+        FROM unnest($4, $5, $6, $7) AS i(ordem, produto_id, quantidade, preco)
+        JOIN novos ON novos.ordem = i.ordem
+    )
+    SELECT id FROM novos ORDER BY ordem
+"""
+_conexoes_preparadas = weakref.WeakSet()  # PREPARE sobrevive a rollback, some com a conexão
+
+
+def inserir_pedidos(cur, precificados):
+    """Grava todos os pedidos e itens num único comando; devolve os ids na ordem do lote."""
+    if cur.connection not in _conexoes_preparadas:
+        cur.execute(PREPARAR_INSERIR_PEDIDOS)
+        _conexoes_preparadas.add(cur.connection)
+    itens = [(ordem, produto_id, quantidade, preco)
+             for ordem, (_, _, linhas) in enumerate(precificados, start=1)
+             for produto_id, quantidade, preco in linhas]
+    cur.execute("EXECUTE suagrafica_inserir_pedidos (%s, %s, %s, %s, %s, %s, %s)", (
+        [p[0] for p in precificados],
+        [p[1] for p in precificados],
+        STATUS_PEDIDO_NOVO,
+        [i[0] for i in itens],
+        [i[1] for i in itens],
+        [i[2] for i in itens],
+        [i[3] for i in itens],
+    ))
+    return [r[0] for r in cur.fetchall()]
+
+
+def reservar_idempotencia(cur, escopo, chave, hash_corpo):
+    """
+    Reserva a chave nesta transação e devolve None; se ela já foi usada, devolve
+    (hash_corpo, status, resposta) gravados. Uma requisição concorrente com a mesma
+    chave espera aqui até a primeira terminar. Chaves vencidas são reaproveitadas.
+    """
+    cur.execute("""
+        INSERT INTO suagrafica_idempotencia AS i (escopo, chave, hash_corpo) VALUES (%s, %s, %s)
+        ON CONFLICT (escopo, chave) DO UPDATE
+            SET hash_corpo = EXCLUDED.hash_corpo, status = NULL, resposta = NULL, criada_em = CURRENT_TIMESTAMP
+            WHERE i.criada_em < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        RETURNING 1
+    """, (escopo, chave, hash_corpo, IDEMPOTENCIA_TTL))
+    if cur.fetchone(): return None
+    cur.execute("SELECT hash_corpo, status, resposta FROM suagrafica_idempotencia WHERE escopo = %s AND chave = %s",
+                (escopo, chave))
+    return cur.fetchone()
+
+
+def criar_pedidos(escopo, pedidos, lote):
+    """Precifica e grava `pedidos` (de ler_pedidos) e monta a resposta, respeitando o Idempotency-Key."""
+    chave = request.headers.get('Idempotency-Key', '').strip()
+    if len(chave) > 255: raise ParametroInvalido("Idempotency-Key deve ter até 255 caracteres.")
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
+            if chave:
+                hash_corpo = hashlib.sha256(json.dumps([lote, pedidos]).encode()).hexdigest()
+                anterior = reservar_idempotencia(cur, escopo, chave, hash_corpo)
+                if anterior:
+                    conn.rollback()
+                    if anterior[0] != hash_corpo:
+                        return jsonify({"erro": "Idempotency-Key já usada com outro conteúdo."}), 422
+                    resp = jsonify(anterior[2])
+                    resp.status_code = anterior[1]
+                    resp.headers['Idempotent-Replayed'] = 'true'
+                    return resp
+
+            precificados = precificar_pedidos(cur, pedidos)
+            ids = inserir_pedidos(cur, precificados)
+            criados = [{"pedido_id": id, "valor_total": float(p[1])} for id, p in zip(ids, precificados)]
+            if lote:
+                corpo = {"mensagem": f"{len(criados)} pedido(s) criado(s) com sucesso!", "pedidos": criados}
+            else:
+                corpo = dict(criados[0], mensagem="Pedido criado com sucesso!")
+
+            if chave:
+                cur.execute("UPDATE suagrafica_idempotencia SET status = 201, resposta = %s WHERE escopo = %s AND chave = %s",
+                            (psycopg2.extras.Json(corpo), escopo, chave))
+            conn.commit()
+            return jsonify(corpo), 201
+        except ParametroInvalido:
+            conn.rollback()  # a chave não fica reservada: o cliente pode corrigir e reenviar
+            raise
+        except psycopg2.errors.ForeignKeyViolation as e:
+            conn.rollback()
+            # Cliente (ou produto) apagado entre a autenticação/validação e o INSERT
+            if e.diag.table_name != 'suagrafica_pedidos':
+                raise PedidoInvalido(["produto removido durante a criação do pedido"])
+            if escopo.startswith('cliente:'):
+                return jsonify({"erro": "Não autorizado"}), 403
+            raise PedidoInvalido(["cliente inexistente"])
+        except Exception as e:
+            traceback.print_exc()
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
+
+
+@app.cli.command("purgar-idempotencia")
+def cli_purgar_idempotencia():
+    """Apaga as chaves de idempotência vencidas (IDEMPOTENCIA_TTL)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM suagrafica_idempotencia WHERE criada_em < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                    (IDEMPOTENCIA_TTL,))
+        conn.commit()
+        print(f"✅ {cur.rowcount} chave(s) de idempotência removida(s).")
+
 
 @app.route('/api/cliente/pedidos', methods=['GET', 'POST'])
 def cliente_pedidos():
-    if not check_client_auth(request): return jsonify({"erro": "Não autorizado"}), 403
-    conn = get_db_connection()
-    
-    try:
+    cliente = check_client_auth(request)
+    if not cliente: return jsonify({"erro": "Não autorizado"}), 403
+    # O cliente vem do token assinado; ?cliente_id / cliente_id no corpo são ignorados
+    cliente_id = cliente['cliente_id']
+
+    # 💡 CORREÇÃO CRÍTICA: Lógica separada para GET e POST
+    if request.method == 'GET':
+        return resposta_json_stream("""
+            SELECT id, valor_total, status_pedido, data_criacao 
+            FROM suagrafica_pedidos 
+            WHERE cliente_id = %s 
+            ORDER BY data_criacao DESC
+        """, (cliente_id,),
+            etag_de=lambda cur: montar_etag('cliente-pedidos', cliente_id, *versoes_tabelas(cur, 'suagrafica_pedidos')))
+
+    # POST: {"itens": [...]} cria um pedido; {"pedidos": [{"itens": [...]}, ...]} cria vários de uma vez
+    data = request.json or {}
+    lote = 'pedidos' in data
+    pedidos = ler_pedidos(data['pedidos'] if lote else [data], cliente_id=cliente_id)
+    return criar_pedidos(f"cliente:{cliente_id}", pedidos, lote)
+
+
+# Histórico paginado do cliente: página por keyset (data_criacao, id) no índice
+# idx_pedidos_cliente_data_id (cliente_id, data_criacao DESC, id DESC). Os itens vêm
+# resumidos na mesma consulta; a subconsulta só roda para as linhas da página.
+HISTORICO_CLIENTE_SQL = """
+    SELECT p.id, p.valor_total::float8 AS valor_total, p.status_pedido, p.link_pagamento, p.data_criacao,
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'codigo_produto', pr.codigo_produto,
+                          'quantidade', pi.quantidade,
+                          'preco_unitario', pi.preco_unitario_registrado::float8
+                      ) ORDER BY pi.id)
+               FROM suagrafica_pedido_itens pi
+               LEFT JOIN suagrafica_produtos pr ON pi.produto_id = pr.id
+               WHERE pi.pedido_id = p.id
+           ), '[]'::json) AS itens
+    FROM suagrafica_pedidos p
+    WHERE p.cliente_id = %s{filtros}
+    ORDER BY p.data_criacao DESC, p.id DESC
+    LIMIT %s
+"""
+
+
+@app.route('/api/cliente/pedidos/historico', methods=['GET'])
+def cliente_historico_pedidos():
+    """ Histórico paginado com itens (?limit=50&cursor=...&status=...&data_inicio=...&data_fim=...). """
+    cliente = check_client_auth(request)
+    if not cliente: return jsonify({"erro": "Não autorizado"}), 403
+    cliente_id = cliente['cliente_id']
+    args = request.args
+    limite = ler_limite(args)
+    # Só status e período: o cliente vem do token, nunca da query string
+    filtros, params = filtros_pedidos({k: args[k] for k in ('status', 'data_inicio', 'data_fim') if k in args})
+    if args.get('cursor'):
+        filtros.append("(p.data_criacao, p.id) < (%s, %s)")
+        params.extend(decodificar_cursor(args['cursor']))
+
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        # 💡 CORREÇÃO CRÍTICA: Lógica separada para GET e POST
-        if request.method == 'GET':
-            # Não tenta ler JSON. Apenas lê o parâmetro da URL.
-            cliente_id_from_url = request.args.get('cliente_id')
-            if not cliente_id_from_url:
-                return jsonify({"erro": "ID do Cliente necessário para ver pedidos"}), 400
-            
-            try:
-                # 💡 Correção do erro 500 original
-                cliente_id = int(cliente_id_from_url)
-            except ValueError:
-                return jsonify({"erro": "ID do Cliente inválido."}), 400
-            
-            cur.execute("""
-                SELECT id, valor_total, status_pedido, data_criacao 
-                FROM suagrafica_pedidos 
-                WHERE cliente_id = %s 
-                ORDER BY data_criacao DESC
-            """, (cliente_id,))
-            
-            pedidos = cur.fetchall()
-            for p in pedidos: 
-                p['valor_total'] = float(p['valor_total'])
-            return jsonify(pedidos)
-            
-        elif request.method == 'POST':
-            # 💡 APENAS AQUI LER O JSON
-            data = request.json or {}
-            
-            cliente_id = data.get('cliente_id')
-            itens = data.get('itens', [])
-            
-            if not cliente_id or not itens:
-                return jsonify({"erro": "Dados do pedido incompletos"}), 400
+        # Códigos de produto aparecem nos itens: produtos também entram na versão
+        etag = montar_etag('cliente-historico', cliente_id, *versoes_tabelas(
+            cur, 'suagrafica_pedidos', 'suagrafica_pedido_itens', 'suagrafica_produtos'))
+        if etag_confere(etag): return nao_modificado(etag)
 
-            valor_total = sum(float(item['preco_unitario_registrado']) * item['quantidade'] for item in itens)
-            
-            cur.execute("""
-                INSERT INTO suagrafica_pedidos (cliente_id, valor_total, status_pedido)
-                VALUES (%s, %s, %s) RETURNING id
-            """, (cliente_id, valor_total, 'Aguardando Aprovação'))
-            pedido_id = cur.fetchone()['id']
-            
-            item_values = [(pedido_id, item['produto_id'], item['quantidade'], item['preco_unitario_registrado']) for item in itens]
-            psycopg2.extras.execute_values(
-                cur,
-                """
-                INSERT INTO suagrafica_pedido_itens (pedido_id, produto_id, quantidade, preco_unitario_registrado)
-                VALUES %s
-                """,
-                item_values,
-                template="(%s, %s, %s, %s)",
-                page_size=100
-            )
-            
-            conn.commit()
-            return jsonify({"mensagem": "Pedido criado com sucesso!", "pedido_id": pedido_id, "valor_total": float(valor_total)}), 201
+        cur.execute(HISTORICO_CLIENTE_SQL.format(filtros="".join(" AND " + f for f in filtros)),
+                    [cliente_id] + params + [limite + 1])
+        pedidos = cur.fetchall()
+
+    proximo_cursor = None
+    if len(pedidos) > limite:
+        pedidos = pedidos[:limite]
+        proximo_cursor = codificar_cursor(pedidos[-1]['data_criacao'], pedidos[-1]['id'])
+    return com_etag(jsonify({"pedidos": pedidos, "proximo_cursor": proximo_cursor}), etag)
+
+
+@app.route('/api/admin/pedidos/lote', methods=['POST'])
+def admin_pedidos_lote():
+    """ Integração com o ERP: {"pedidos": [{"cliente_id", "itens": [...]}, ...]}, com Idempotency-Key. """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    data = request.json or {}
+    pedidos = ler_pedidos(data.get('pedidos'))
+    clientes = sorted({cliente_id for cliente_id, _ in pedidos})
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM suagrafica_clientes WHERE id = ANY(%s) AND status_acesso = 'Ativo'", (clientes,))
+        ativos = {r[0] for r in cur.fetchall()}
+    invalidos = [f"pedidos[{i}]: cliente {c} inexistente ou inativo" for i, (c, _) in enumerate(pedidos) if c not in ativos]
+    if invalidos: raise PedidoInvalido(invalidos)
+    return criar_pedidos("admin", pedidos, lote=True)
+
+# --- EVENTOS DE PEDIDOS (NOTIFY -> SSE) ---
+# O trigger da migração 0008 faz um NOTIFY em PEDIDOS_CANAL por pedido
+# inserido, alterado (status, valor, link ou cliente) ou apagado — vale para
+# qualquer caminho: POST do cliente, PUT do admin, link gerado pelo EloBot.
+# O listener único do processo entrega cada evento às filas das conexões
+# SSE: admin recebe todos, cliente só os seus (sem nome/cliente_id). Fila
+# cheia ou listener reconectado viram um evento 'resync' (o front recarrega
+# a lista). A conexão fecha após EVENTOS_DURACAO_MAXIMA e o front reconecta,
+# o que também revalida o token.
+PEDIDOS_CANAL = "suagrafica_pedidos_eventos"
+EVENTOS_HEARTBEAT = float(os.environ.get("EVENTOS_HEARTBEAT", 15))
+EVENTOS_DURACAO_MAXIMA = float(os.environ.get("EVENTOS_DURACAO_MAXIMA", 300))
+EVENTOS_FILA_MAXIMA = int(os.environ.get("EVENTOS_FILA_MAXIMA", 100))
+# Cada stream segura uma thread do worker gthread: o gunicorn.conf.py deriva
+# este limite do orçamento de threads (ver lá); 200 vale para gevent/dev.
+EVENTOS_MAX_ASSINANTES = int(os.environ.get("EVENTOS_MAX_ASSINANTES", 200))
+CAMPOS_EVENTO_CLIENTE = ('op', 'id', 'valor_total', 'status_pedido', 'link_pagamento', 'data_criacao')
+
+
+class EventosLotados(Exception):
+    """Limite de conexões SSE do processo atingido."""
+
+
+class EventosPedidos:
+    """Fan-out dos NOTIFYs de pedidos para as conexões SSE deste processo."""
+
+    def __init__(self):
+        self.pid = None
+        self._lock = threading.Lock()
+        self._assinantes = {}  # fila -> cliente_id (None = admin)
+        self._stats = {"eventos": 0, "entregues": 0, "resyncs": 0}
+        self.encerrando = False
+
+    def _garantir_listener(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._assinantes = {}
+            get_pg_listener().registrar(PEDIDOS_CANAL, self._on_notify, ao_reconectar=self._resincronizar)
+
+    def assinar(self, cliente_id=None):
+        self._garantir_listener()
+        with self._lock:
+            if self.encerrando or len(self._assinantes) >= EVENTOS_MAX_ASSINANTES:
+                raise EventosLotados()
+            fila = queue.Queue(EVENTOS_FILA_MAXIMA)
+            self._assinantes[fila] = cliente_id
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.pop(fila, None)
+
+    def encerrar(self):
+        """Worker saindo (reload/deploy): fecha os streams já, em vez de segurar até o graceful_timeout."""
+        with self._lock:
+            self.encerrando = True
+            filas = list(self._assinantes)
+        for fila in filas:
+            while True:
+                try:
+                    fila.get_nowait()
+                except queue.Empty:
+                    break
+            fila.put_nowait(None)  # fim do stream; o front reconecta em outro worker
+
+    def _entregar(self, fila, evento):
+        try:
+            fila.put_nowait(evento)
+            return True
+        except queue.Full:
+            # Conexão lenta: descarta o atrasado e manda recarregar
+            while True:
+                try:
+                    fila.get_nowait()
+                except queue.Empty:
+                    break
+            fila.put_nowait(evento_sse('resync', {"motivo": "fila_cheia"}))
+            self._stats["resyncs"] += 1
+            return False
+
+    def _on_notify(self, payload):
+        evento = json.loads(payload)
+        # Bytes SSE montados uma vez por audiência, não por conexão
+        para_admin = evento_sse('pedido', evento)
+        para_cliente = evento_sse('pedido', {k: evento[k] for k in CAMPOS_EVENTO_CLIENTE if k in evento})
+        with self._lock:
+            destinos = [(fila, para_admin if cliente_id is None else para_cliente)
+                        for fila, cliente_id in self._assinantes.items()
+                        if cliente_id is None or cliente_id == evento.get('cliente_id')]
+            self._stats["eventos"] += 1
+        entregues = sum(self._entregar(fila, dados) for fila, dados in destinos)
+        with self._lock:
+            self._stats["entregues"] += entregues
+
+    def _resincronizar(self):
+        # NOTIFYs enviados com o listener fora do ar se perderam
+        with self._lock:
+            filas = list(self._assinantes)
+            self._stats["resyncs"] += len(filas)
+        for fila in filas:
+            self._entregar(fila, evento_sse('resync', {"motivo": "reconexao"}))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, assinantes=len(self._assinantes),
+                        admins=sum(1 for c in self._assinantes.values() if c is None),
+                        listener_online=get_pg_listener().online, encerrando=self.encerrando, pid=self.pid)
+
+
+eventos_pedidos = EventosPedidos()
+metricas.medidor("eventos_pedidos", "Assinantes dos eventos de pedidos", eventos_pedidos.stats)
+
+
+def resposta_eventos_pedidos(cliente_id=None):
+    """text/event-stream com os eventos de pedidos (todos, ou só os de `cliente_id`)."""
+    try:
+        fila = eventos_pedidos.assinar(cliente_id)
+    except EventosLotados:
+        resp = jsonify({"erro": "Muitas conexões de eventos abertas. Tente novamente."})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = str(int(EVENTOS_HEARTBEAT))
+        return resp
+
+    def gerar():
+        try:
+            yield b'retry: 5000\n\n' + evento_sse('pronto', {"listener_online": get_pg_listener().online})
+            fim = time.monotonic() + EVENTOS_DURACAO_MAXIMA
+            while True:
+                restante = fim - time.monotonic()
+                if restante <= 0: break
+                try:
+                    evento = fila.get(timeout=min(EVENTOS_HEARTBEAT, restante))
+                except queue.Empty:
+                    yield b': ping\n\n'  # mantém o proxy aberto e detecta cliente que saiu
+                    continue
+                if evento is None: break
+                yield evento
+        finally:
+            eventos_pedidos.cancelar(fila)
+
+    resp = Response(gerar(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+@app.route('/api/admin/pedidos/eventos', methods=['GET'])
+def admin_pedidos_eventos():
+    """ SSE com todos os pedidos criados/alterados/apagados (event: pedido | resync | pronto). """
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    return resposta_eventos_pedidos()
+
+
+@app.route('/api/admin/eventos_stats', methods=['GET'])
+def admin_eventos_stats():
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    return jsonify(eventos_pedidos.stats())
+
+
+@app.route('/api/cliente/pedidos/eventos', methods=['GET'])
+def cliente_pedidos_eventos():
+    """ SSE só com os pedidos do cliente do token. """
+    cliente = check_client_auth(request)
+    if not cliente: return jsonify({"erro": "Não autorizado"}), 403
+    return resposta_eventos_pedidos(cliente['cliente_id'])
 
-    except Exception as e:
-        traceback.print_exc()
-        if conn: conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-    finally:
-        if conn: conn.close()
 
 # ======================================================================
 # 5. MÓDULO CHATBOT (ELO BOT - VENDAS & SUPORTE)
 # Adicionado na versão 1.6
 # ======================================================================
 
+# --- CACHES DO CHATBOT ---
+# Dois caches por processo, para turnos quase iguais ("quero canetas", "Quero canetas!"):
+#   - resultado de tool_consultar_produtos por termo normalizado, limpo a cada
+#     escrita em produtos (mesmo NOTIFY do cache do catálogo);
+#   - decisão da 1ª chamada ao Gemini (botResponse + actionRequired), pela
+#     mensagem normalizada + hash das últimas mensagens do histórico.
+# Ações de cliente (check_order, generate_payment) nunca são servidas de cache.
+CHAT_CACHE_FERRAMENTA_MAX = int(os.environ.get("CHAT_CACHE_FERRAMENTA_MAX", 500))
+CHAT_CACHE_FERRAMENTA_TTL = float(os.environ.get("CHAT_CACHE_FERRAMENTA_TTL", 300))
+CHAT_CACHE_INTENCAO_MAX = int(os.environ.get("CHAT_CACHE_INTENCAO_MAX", 1000))
+CHAT_CACHE_INTENCAO_TTL = float(os.environ.get("CHAT_CACHE_INTENCAO_TTL", 600))
+CHAT_CACHE_HISTORICO = int(os.environ.get("CHAT_CACHE_HISTORICO", 2))  # mensagens do histórico na chave
+ACOES_CACHEAVEIS = ('none', 'search_product')
+
+
+class CacheLRU:
+    """
+    Cache LRU com TTL e contadores. Com `tabela`, é limpo a cada NOTIFY de
+    versão dessa tabela e só é consultado com o listener online (como o
+    CatalogCache). set() recebe a geração lida antes do cálculo: se houve
+    invalidação no meio, o valor já nasceu velho e é descartado.
+    """
+
+    def __init__(self, nome, maxsize, ttl, tabela=None):
+        self.nome = nome
+        self.maxsize = max(maxsize, 1)
+        self.ttl = ttl
+        self.tabela = tabela
+        self.pid = None
+        self._lock = threading.Lock()
+        self._itens = OrderedDict()  # chave -> (valor, expira_em)
+        self._geracao = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidacoes": 0}
+
+    def _garantir_listener(self):
+        if self.tabela and self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.invalidar()
+            get_pg_listener().registrar(VERSOES_CANAL, self._on_notify, ao_reconectar=self.invalidar)
+
+    def _on_notify(self, payload):
+        if payload.split(':', 1)[0] == self.tabela:
+            self.invalidar()
+
+    def _confiavel(self):
+        self._garantir_listener()
+        return not self.tabela or get_pg_listener().online
+
+    def geracao(self):
+        with self._lock:
+            return self._geracao
+
+    def get(self, chave):
+        confiavel = self._confiavel()
+        with self._lock:
+            item = self._itens.get(chave) if confiavel else None
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._itens[chave]
+                self._stats["misses"] += 1
+                return None
+            self._itens.move_to_end(chave)
+            self._stats["hits"] += 1
+            return item[0]
+
+    def set(self, chave, valor, geracao=None):
+        if not self._confiavel(): return
+        with self._lock:
+            if geracao is not None and geracao != self._geracao: return
+            self._itens[chave] = (valor, time.monotonic() + self.ttl)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.maxsize:
+                self._itens.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidar(self):
+        with self._lock:
+            self._geracao += 1
+            self._itens.clear()
+            self._stats["invalidacoes"] += 1
+
+    def stats(self):
+        with self._lock:
+            consultas = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats, itens=len(self._itens), maxsize=self.maxsize, ttl=self.ttl,
+                        hit_rate=round(self._stats["hits"] / consultas, 3) if consultas else None)
+
+
+cache_ferramenta_produtos = CacheLRU("ferramenta_produtos", CHAT_CACHE_FERRAMENTA_MAX, CHAT_CACHE_FERRAMENTA_TTL,
+                                     tabela='suagrafica_produtos')
+cache_intencao = CacheLRU("intencao", CHAT_CACHE_INTENCAO_MAX, CHAT_CACHE_INTENCAO_TTL)
+metricas.medidor("chat_cache_intencao", "Cache de intenção do chat", cache_intencao.stats)
+metricas.medidor("chat_cache_produtos", "Cache da ferramenta de produtos do chat", cache_ferramenta_produtos.stats)
+
+
+def normalizar_texto_chat(texto):
+    """'  Tem CANETA? ' -> 'tem caneta' (sem acentos, pontuação e espaços extras)."""
+    texto = unicodedata.normalize('NFKD', str(texto or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', texto))
+
+
+def chave_intencao(user_msg, history):
+    recentes = history[-CHAT_CACHE_HISTORICO:] if CHAT_CACHE_HISTORICO > 0 else []
+    contexto = '\n'.join(f"{h.get('role')}:{normalizar_texto_chat(h.get('content'))}" for h in recentes)
+    return normalizar_texto_chat(user_msg) + '|' + hashlib.sha1(contexto.encode('utf-8')).hexdigest()[:16]
+
+
+def guardar_intencao(chave, ai_data):
+    acao = ai_data.get('actionRequired') or {'type': 'none'}
+    if acao.get('type') in ACOES_CACHEAVEIS:
+        cache_intencao.set(chave, ai_data)
+
+
 # --- FERRAMENTAS DO BANCO DE DADOS PARA O BOT ---
+def tool_db(msg_sem_conexao):
+    """Faz a ferramenta devolver uma mensagem ao bot (em vez de estourar) se o pool falhar."""
+    def decorador(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except (PoolEsgotado, psycopg2.OperationalError) as e:
+                print(f"🔴 ERRO AO CONECTAR NO DB: {e}")
+                return msg_sem_conexao
+        return wrapper
+    return decorador
+
+@tool_db("Erro de conexão com banco de dados.")
 def tool_consultar_produtos(termo_busca):
-    """Busca produtos no banco para oferecer ao cliente."""
-    conn = get_db_connection()
-    if not conn: return "Erro de conexão com banco de dados."
-    try:
+    """Busca produtos no banco para oferecer ao cliente (resultado em cache por termo)."""
+    chave = normalizar_texto_chat(termo_busca)
+    em_cache = cache_ferramenta_produtos.get(chave)
+    if em_cache is not None:
+        return em_cache
+    geracao = cache_ferramenta_produtos.geracao()
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT nome_produto, preco_minimo, multiplos_de, descricao 
-            FROM suagrafica_produtos 
-            WHERE esta_ativo = TRUE AND (nome_produto ILIKE %s OR descricao ILIKE %s)
-            LIMIT 5
-        """, (f'%{termo_busca}%', f'%{termo_busca}%'))
-        produtos = cur.fetchall()
-        if not produtos:
-            return "Não encontrei produtos exatos com esse nome no catálogo."
-        # Converte Decimal para float para o JSON
-        for p in produtos:
-            p['preco_minimo'] = float(p['preco_minimo'])
-        return json.dumps(produtos, ensure_ascii=False)
-    finally:
-        conn.close()
+        encontrados = buscar_produtos(cur, termo_busca, limite=5)
+    if not encontrados:
+        resultado = "Não encontrei produtos exatos com esse nome no catálogo."
+    else:
+        # Só os campos que o bot precisa
+        produtos = [{'nome_produto': p['nome_produto'], 'preco_minimo': p['preco_minimo'],
+                     'multiplos_de': p['multiplos_de'], 'descricao': p['descricao']} for p in encontrados]
+        resultado = json.dumps(produtos, ensure_ascii=False)
+    cache_ferramenta_produtos.set(chave, resultado, geracao)
+    return resultado
 
+@tool_db("Erro de conexão.")
 def tool_consultar_pedido(pedido_id, cliente_id_verificacao=None):
     """Consulta status e detalhes de um pedido específico."""
-    conn = get_db_connection()
-    if not conn: return "Erro de conexão."
-    try:
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         query = """
             SELECT id, valor_total, status_pedido, link_pagamento 
@@ -582,39 +3811,34 @@ def tool_consultar_pedido(pedido_id, cliente_id_verificacao=None):
         if not pedido:
             return "Pedido não encontrado ou não pertence a este cliente."
             
-        pedido['valor_total'] = float(pedido['valor_total'])
         return json.dumps(pedido, ensure_ascii=False)
-    finally:
-        conn.close()
 
-def tool_gerar_link_pagamento(pedido_id):
+@tool_db("Erro de conexão.")
+def tool_gerar_link_pagamento(pedido_id, cliente_id):
     """
-    Gera um link e SALVA no banco (simulado).
+    Gera um link e SALVA no banco (simulado). Só para pedidos do próprio cliente.
     """
-    conn = get_db_connection()
-    if not conn: return "Erro de conexão."
-    try:
-        cur = conn.cursor()
+    with db_connection() as conn:
+        try:
+            cur = conn.cursor()
         
-        # Link Simulado (Substitua por lógica do Mercado Pago se tiver no futuro)
-        link_template = f"https://www.elobrindes.com.br/checkout/pagamento?order={pedido_id}"
+            # Link Simulado (Substitua por lógica do Mercado Pago se tiver no futuro)
+            link_template = f"https://www.elobrindes.com.br/checkout/pagamento?order={pedido_id}"
         
-        cur.execute("""
-            UPDATE suagrafica_pedidos 
-            SET link_pagamento = %s, status_pedido = 'Aguardando Pagamento'
-            WHERE id = %s
-            RETURNING id
-        """, (link_template, pedido_id))
-        conn.commit()
+            cur.execute("""
+                UPDATE suagrafica_pedidos 
+                SET link_pagamento = %s, status_pedido = 'Aguardando Pagamento'
+                WHERE id = %s AND cliente_id = %s
+                RETURNING id
+            """, (link_template, pedido_id, cliente_id))
+            conn.commit()
         
-        if cur.fetchone():
-            return f"Link gerado com sucesso: {link_template}"
-        else:
-            return "Erro ao atualizar pedido. Verifique o ID."
-    except Exception as e:
-        return f"Erro ao gerar link: {str(e)}"
-    finally:
-        conn.close()
+            if cur.fetchone():
+                return f"Link gerado com sucesso: {link_template}"
+            else:
+                return "Erro ao atualizar pedido. Verifique o ID."
+        except Exception as e:
+            return f"Erro ao gerar link: {str(e)}"
 
 # --- CONTEXTO E PROMPT DO AGENTE ---
 ELO_BRINDES_KNOWLEDGE = """
@@ -673,64 +3897,424 @@ JSON Saída:
 }}
 """
 
-# --- ROTA DO CHAT ---
-@app.route('/api/chat_vendas', methods=['POST'])
-def chat_endpoint():
-    # Verifica API KEY para não quebrar se não tiver configurado
-    if not GEMINI_API_KEY:
-        return jsonify({"response": "O Chatbot está temporariamente indisponível (Falta API KEY).", "action_taken": "error"}), 503
+# --- EXECUÇÃO DAS CHAMADAS AO GEMINI (POOL LIMITADO) ---
+# As chamadas ao modelo rodam num pool de threads próprio. A thread do
+# request continua bloqueada esperando o resultado (futuro.result), então o
+# pool não libera a thread do worker: ele limita quantas threads o chat
+# ocupa ao mesmo tempo (CHAT_MAX_CONCORRENTES executando + CHAT_FILA_MAXIMA
+# na fila). Passado esse limite o chat responde 429 com Retry-After na hora,
+# e o resto das threads do worker fica para catálogo e pedidos (ver
+# gunicorn.conf.py). Cada chamada tem timeout (no cliente HTTP do Gemini e
+# na espera do resultado).
+CHAT_MAX_CONCORRENTES = int(os.environ.get("CHAT_MAX_CONCORRENTES", 4))
+CHAT_FILA_MAXIMA = int(os.environ.get("CHAT_FILA_MAXIMA", 4))
+CHAT_TIMEOUT_LLM = float(os.environ.get("CHAT_TIMEOUT_LLM", 20))
+CHAT_RETRY_AFTER = int(os.environ.get("CHAT_RETRY_AFTER", 5))
+# Modelo falso, local (ver ModeloStub): testes e carga sem chamar o Gemini
+GEMINI_STUB = os.environ.get("GEMINI_STUB", "").lower() in ("1", "true", "sim")
+GEMINI_STUB_LATENCIA = float(os.environ.get("GEMINI_STUB_LATENCIA", 0.2))
 
-    data = request.json or {}
-    history = data.get('history', []) 
-    user_msg = data.get('message', '')
-    client_id = data.get('client_id') 
-    
-    model = genai.GenerativeModel(
-        'gemini-2.5-flash-preview-09-2025',
-        system_instruction=SYSTEM_PROMPT
-    )
-    
-    gemini_history = []
-    for h in history:
-        role = 'user' if h['role'] == 'user' else 'model'
-        gemini_history.append({'role': role, 'parts': [h['content']]})
-    
-    gemini_history.append({'role': 'user', 'parts': [user_msg]})
 
+class ChatOcupado(Exception):
+    """Pool de chamadas ao modelo cheio (executando + fila)."""
+
+
+class ChatTimeout(Exception):
+    """O modelo não respondeu dentro de CHAT_TIMEOUT_LLM."""
+
+
+class ChatExecutor:
+    """ThreadPoolExecutor com fila limitada e contadores para /api/admin/chat_stats."""
+
+    def __init__(self, max_workers=CHAT_MAX_CONCORRENTES, fila=CHAT_FILA_MAXIMA, timeout=CHAT_TIMEOUT_LLM):
+        self.pid = os.getpid()
+        self.max_workers = max(max_workers, 1)
+        self.limite = self.max_workers + max(fila, 0)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="chat-llm")
+        self._lock = threading.Lock()
+        self._em_andamento = 0  # executando + na fila (inclui chamadas cujo request já desistiu)
+        self._stats = {"chamadas": 0, "rejeitadas": 0, "timeouts": 0, "erros": 0}
+
+    def saturado(self):
+        with self._lock:
+            return self._em_andamento >= self.limite
+
+    def _liberar(self, futuro):
+        with self._lock:
+            self._em_andamento -= 1
+
+    def _contar(self, chave):
+        # Chamado das threads de request, que rodam em paralelo: só muda sob self._lock
+        with self._lock:
+            self._stats[chave] += 1
+
+    def executar(self, func, *args, **kwargs):
+        """
+        Roda `func` no pool e espera até `timeout`, bloqueando a thread que
+        chama. Levanta ChatOcupado ou ChatTimeout.
+        """
+        with self._lock:
+            if self._em_andamento >= self.limite:
+                self._stats["rejeitadas"] += 1
+                raise ChatOcupado()
+            self._em_andamento += 1
+            self._stats["chamadas"] += 1
+        futuro = self._executor.submit(func, *args, **kwargs)
+        futuro.add_done_callback(self._liberar)
+        try:
+            return futuro.result(timeout=self.timeout)
+        except FuturesTimeout:
+            futuro.cancel()  # se ainda estava na fila, nem chega a rodar
+            self._contar("timeouts")
+            raise ChatTimeout()
+        except Exception:
+            self._contar("erros")
+            raise
+
+    def executar_stream(self, func, *args, **kwargs):
+        """
+        Como executar(), para respostas em stream: a thread do pool itera o
+        resultado de `func` e repassa os pedaços por uma fila. O timeout vale
+        entre um pedaço e o seguinte.
+        """
+        with self._lock:
+            if self._em_andamento >= self.limite:
+                self._stats["rejeitadas"] += 1
+                raise ChatOcupado()
+            self._em_andamento += 1
+            self._stats["chamadas"] += 1
+        fila, fim, parar = queue.Queue(), object(), threading.Event()
+
+        def consumir():
+            try:
+                for pedaco in func(*args, **kwargs):
+                    if parar.is_set(): break  # quem pediu já desistiu (timeout/desconexão)
+                    fila.put(pedaco)
+            except Exception as e:
+                fila.put(e)
+            finally:
+                fila.put(fim)
+
+        futuro = self._executor.submit(consumir)
+        futuro.add_done_callback(self._liberar)
+        try:
+            while True:
+                try:
+                    item = fila.get(timeout=self.timeout)
+                except queue.Empty:
+                    futuro.cancel()
+                    self._contar("timeouts")
+                    raise ChatTimeout()
+                if item is fim: return
+                if isinstance(item, Exception):
+                    self._contar("erros")
+                    raise item
+                yield item
+        finally:
+            parar.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, em_andamento=self._em_andamento, max_workers=self.max_workers,
+                        limite=self.limite, timeout=self.timeout, pid=self.pid)
+
+
+_chat_executor = None
+_chat_executor_lock = threading.Lock()
+
+
+def get_chat_executor():
+    """Executor do processo atual (threads não sobrevivem ao fork do gunicorn)."""
+    global _chat_executor
+    with _chat_executor_lock:
+        if _chat_executor is None or _chat_executor.pid != os.getpid():
+            _chat_executor = ChatExecutor()
+        return _chat_executor
+
+
+class ModeloStub:
+    """
+    Substituto local de genai.GenerativeModel (GEMINI_STUB=1). Decide a ação por
+    palavras-chave, espera GEMINI_STUB_LATENCIA segundos e devolve o mesmo JSON
+    que o prompt pede ao Gemini.
+    """
+
+    class _Resposta:
+        def __init__(self, text):
+            self.text = text
+
+    def __init__(self, latencia=None):
+        self.latencia = GEMINI_STUB_LATENCIA if latencia is None else latencia
+
+    def generate_content(self, contents, generation_config=None, request_options=None, stream=False, **kwargs):
+        if stream:
+            return self._em_pedacos(contents)
+        time.sleep(self.latencia)
+        return self._responder(contents)
+
+    def _em_pedacos(self, contents, tamanho=12):
+        texto = self._responder(contents).text
+        pedacos = [texto[i:i + tamanho] for i in range(0, len(texto), tamanho)]
+        for pedaco in pedacos:
+            time.sleep(self.latencia / len(pedacos))
+            yield self._Resposta(pedaco)
+
+    def _responder(self, contents):
+        ultima = contents[-1]['parts'][0] if contents else ''
+        if 'DADOS OBTIDOS DO SISTEMA' in ultima:
+            return self._Resposta(json.dumps({"botResponse": "Aqui está o que encontrei no sistema! 😊",
+                                              "actionRequired": {"type": "none"}}))
+        numero = re.search(r'\d+', ultima)
+        texto = ultima.lower()
+        if numero and ('pagar' in texto or 'link' in texto):
+            acao = {"type": "generate_payment", "order_id": int(numero.group())}
+        elif numero and 'pedido' in texto:
+            acao = {"type": "check_order", "order_id": int(numero.group())}
+        elif re.search(r'\w{3,}', texto):
+            acao = {"type": "search_product", "term": re.findall(r'\w{3,}', texto)[-1]}
+        else:
+            acao = {"type": "none"}
+        return self._Resposta(json.dumps({"botResponse": "Só um instante, vou verificar! 🔎", "actionRequired": acao}))
+
+
+class RegistroModelos:
+    """Um modelo por (nome, system_instruction), criado uma vez por worker e reaproveitado entre requests."""
+
+    def __init__(self):
+        self.pid = None
+        self._lock = threading.Lock()
+        self._modelos = {}
+        self.criados = 0
+
+    def obter(self, nome, system_instruction):
+        chave = (nome, hashlib.sha1(system_instruction.encode('utf-8')).hexdigest())
+        with self._lock:
+            if self.pid != os.getpid():  # clientes gRPC/HTTP do Gemini não atravessam o fork
+                self.pid = os.getpid()
+                self._modelos.clear()
+            if chave not in self._modelos:
+                if GEMINI_STUB:
+                    self._modelos[chave] = ModeloStub()
+                else:
+                    self._modelos[chave] = genai.GenerativeModel(nome, system_instruction=system_instruction)
+                self.criados += 1
+            return self._modelos[chave]
+
+    def stats(self):
+        with self._lock:
+            return {"modelos": len(self._modelos), "criados": self.criados, "pid": self.pid}
+
+
+registro_modelos = RegistroModelos()
+metricas.medidor("chat_executor", "Pool de chamadas ao Gemini",
+                 lambda: get_chat_executor().stats() if _chat_executor is not None else {})
+CHAT_MODELO = os.environ.get("CHAT_MODELO", 'gemini-2.5-flash-preview-09-2025')
+
+
+def modelo_chat():
+    return registro_modelos.obter(CHAT_MODELO, SYSTEM_PROMPT)
+
+
+RESULTADOS_GEMINI = {ChatOcupado: "ocupado", ChatTimeout: "timeout"}
+
+
+def gerar_conteudo(model, contents, etapa="decisao"):
+    """Chamada ao modelo pelo pool limitado, com timeout no cliente HTTP e na espera.
+
+    `etapa` ("decisao" = 1ª chamada, "resposta" = 2ª) só rotula a métrica de latência.
+    """
+    inicio, resultado = time.perf_counter(), "erro"
     try:
-        # 1. Primeira Chamada (Decisão)
-        response = model.generate_content(
-            gemini_history,
+        resposta = get_chat_executor().executar(
+            model.generate_content,
+            contents,
             generation_config=genai.types.GenerationConfig(
                 temperature=0.7,
                 response_mime_type="application/json"
-            )
+            ),
+            request_options={"timeout": CHAT_TIMEOUT_LLM}
         )
+        resultado = "ok"
+        return resposta
+    except Exception as e:
+        resultado = RESULTADOS_GEMINI.get(type(e), "erro")
+        raise
+    finally:
+        registrar_gemini(etapa, "sync", resultado, time.perf_counter() - inicio)
+
+
+MSG_CHAT_OCUPADO = "Estou atendendo muitos clientes agora. 🙏 Tente de novo em alguns segundos."
+
+
+def gerar_conteudo_stream(model, contents, etapa="decisao"):
+    """Como gerar_conteudo(), em stream: devolve os pedaços de texto conforme o modelo escreve."""
+    inicio, resultado, primeiro = time.perf_counter(), "interrompido", True
+    try:
+        for pedaco in get_chat_executor().executar_stream(
+            model.generate_content,
+            contents,
+            generation_config=genai.types.GenerationConfig(
+                temperature=0.7,
+                response_mime_type="application/json"
+            ),
+            request_options={"timeout": CHAT_TIMEOUT_LLM},
+            stream=True
+        ):
+            if primeiro:
+                metricas.observar("suagrafica_gemini_primeiro_pedaco_segundos", time.perf_counter() - inicio, etapa=etapa)
+                primeiro = False
+            yield pedaco.text
+        resultado = "ok"
+    except Exception as e:
+        resultado = RESULTADOS_GEMINI.get(type(e), "erro")
+        raise
+    finally:
+        # "interrompido": quem consumia parou antes do fim (cliente desconectou, JSON já completo)
+        registrar_gemini(etapa, "stream", resultado, time.perf_counter() - inicio)
+
+
+def chat_ocupado():
+    resp = jsonify({"response": MSG_CHAT_OCUPADO, "action_taken": "busy"})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(CHAT_RETRY_AFTER)
+    return resp
+
+
+@app.route('/api/admin/chat_stats', methods=['GET'])
+def admin_chat_stats():
+    if not check_auth(request): return jsonify({"erro": "Não autorizado"}), 403
+    return jsonify(dict(get_chat_executor().stats(), modelos=registro_modelos.stats(), latencias=latencias_chat.stats(), caches={
+        "intencao": cache_intencao.stats(),
+        "ferramenta_produtos": cache_ferramenta_produtos.stats(),
+    }))
+
+
+# --- ROTA DO CHAT ---
+MSG_CHAT_TIMEOUT = "A resposta está demorando mais que o normal. ⏳ Pode tentar de novo?"
+MSG_CHAT_ERRO = "Desculpe, tive um lapso de memória momentâneo. Pode repetir?"
+
+
+# --- HISTÓRICO DA CONVERSA (ORÇAMENTO DE TOKENS) ---
+# O front manda o histórico inteiro a cada mensagem. Antes de ir ao Gemini:
+#   - dumps de ferramenta (listas/objetos JSON, "DADOS OBTIDOS...") viram um marcador;
+#   - as mensagens mais recentes entram na íntegra até CHAT_HISTORICO_TOKENS
+#     (as últimas CHAT_HISTORICO_MIN_MENSAGENS sempre entram);
+#   - as mais antigas viram um resumo extrativo (sem chamada extra ao modelo),
+#     recalculado a cada turno e limitado a CHAT_RESUMO_TOKENS.
+CHAT_HISTORICO_TOKENS = int(os.environ.get("CHAT_HISTORICO_TOKENS", 1200))
+CHAT_HISTORICO_MIN_MENSAGENS = int(os.environ.get("CHAT_HISTORICO_MIN_MENSAGENS", 4))
+CHAT_MENSAGEM_MAX_TOKENS = int(os.environ.get("CHAT_MENSAGEM_MAX_TOKENS", 400))
+CHAT_RESUMO_TOKENS = int(os.environ.get("CHAT_RESUMO_TOKENS", 250))
+_DUMP_FERRAMENTA = re.compile(
+    r'DADOS OBTIDOS DO SISTEMA:.*'          # prompt da 2ª chamada colado no histórico
+    r'|\[\s*(?:\{[^{}]*\}\s*,?\s*)+\]'        # lista de produtos (tool_consultar_produtos)
+    r'|\{\s*"\w+"\s*:[^{}]*\}', re.S)          # pedido (tool_consultar_pedido)
+MARCADOR_DUMP = "[dados do sistema omitidos]"
+
+
+def estimar_tokens(texto):
+    """Estimativa local (~4 caracteres por token em português), sem ida ao count_tokens do Gemini."""
+    return len(texto) // 4 + 1
+
+
+def limpar_mensagem(texto):
+    texto = _DUMP_FERRAMENTA.sub(MARCADOR_DUMP, str(texto or '')).strip()
+    limite = CHAT_MENSAGEM_MAX_TOKENS * 4
+    return texto if len(texto) <= limite else texto[:limite] + '…'
+
+
+def resumir_mensagens(mensagens, max_tokens=CHAT_RESUMO_TOKENS):
+    """Resumo extrativo: a 1ª frase de cada mensagem (as mais recentes que couberem) e os pedidos citados."""
+    linhas = []
+    for h in mensagens:
+        texto = ' '.join(h['content'].replace(MARCADOR_DUMP, '').split())
+        if not texto: continue
+        frase = re.split(r'(?<=[.!?])\s', texto, maxsplit=1)[0][:160]
+        linhas.append(f"{'Cliente' if h['role'] == 'user' else 'Bot'}: {frase}")
+    pedidos = sorted({int(n) for h in mensagens for n in re.findall(r'pedido\D{0,5}(\d+)', h['content'], re.I)})
+    rodape = f"Pedidos citados: {', '.join(map(str, pedidos[-10:]))}" if pedidos else ''
+    escolhidas, total = [], estimar_tokens(rodape)
+    for linha in reversed(linhas):
+        total += estimar_tokens(linha)
+        if total > max_tokens: break
+        escolhidas.append(linha)
+    partes = ["RESUMO DA CONVERSA ANTERIOR (mensagens mais antigas):"] + escolhidas[::-1] + ([rodape] if rodape else [])
+    return '\n'.join(partes)
+
+
+def compactar_historico(history):
+    """(mensagens recentes limpas, resumo das antigas ou None)."""
+    limpas = [{'role': h['role'], 'content': limpar_mensagem(h['content'])}
+              for h in history if isinstance(h, dict) and h.get('content')]
+    mantidas, total = [], 0
+    for i, h in enumerate(reversed(limpas)):
+        tokens = estimar_tokens(h['content'])
+        if i >= CHAT_HISTORICO_MIN_MENSAGENS and total + tokens > CHAT_HISTORICO_TOKENS: break
+        mantidas.append(h)
+        total += tokens
+    mantidas.reverse()
+    antigas = limpas[:len(limpas) - len(mantidas)]
+    return mantidas, (resumir_mensagens(antigas) if antigas else None)
+
+
+def historico_gemini(history, user_msg):
+    mantidas, resumo = compactar_historico(history)
+    mensagens = ([{'role': 'user', 'content': resumo}] if resumo else []) + mantidas
+    mensagens.append({'role': 'user', 'content': user_msg})
+
+    gemini_history = []
+    for h in mensagens:
+        role = 'user' if h['role'] == 'user' else 'model'
+        # Mensagens seguidas do mesmo papel (ex.: as duas bolhas do bot no stream) viram um turno só
+        if gemini_history and gemini_history[-1]['role'] == role:
+            gemini_history[-1]['parts'][0] += '\n\n' + h['content']
+        else:
+            gemini_history.append({'role': role, 'parts': [h['content']]})
+    return gemini_history
+
+
+def ler_conversa_chat(data):
+    """
+    (mensagem, histórico) do corpo do chat, validados antes da chave de cache e
+    da compactação: o histórico é uma lista de {"role": str, "content": str}.
+    """
+    if not isinstance(data, dict): raise ParametroInvalido("Corpo deve ser um objeto JSON.")
+    mensagem, history = data.get('message', ''), data.get('history', [])
+    if not isinstance(mensagem, str): raise ParametroInvalido("message deve ser texto.")
+    if not isinstance(history, list): raise ParametroInvalido("history deve ser uma lista.")
+    for i, h in enumerate(history):
+        if not (isinstance(h, dict) and isinstance(h.get('role'), str) and isinstance(h.get('content'), str)):
+            raise ParametroInvalido(f"history[{i}] deve ter role e content como texto.")
+    return mensagem, history
+
+
+def ler_json_modelo(texto):
+    return json.loads(texto.replace('```json', '').replace('```', '').strip())
+
+
+def executar_ferramenta(action, client_id):
+    """Roda a ferramenta pedida em actionRequired; None se não houver ferramenta."""
+    if action['type'] == 'search_product':
+        print(f"🔍 [Bot] Buscando produtos: {action['term']}")
+        return tool_consultar_produtos(action['term'])
         
-        resp_text = response.text.replace('```json', '').replace('```', '').strip()
-        ai_data = json.loads(resp_text)
-        
-        action = ai_data.get('actionRequired', {'type': 'none'})
-        bot_text = ai_data.get('botResponse', '')
-        
-        # 2. Execução de Ferramentas
-        tool_result = None
+    elif action['type'] in ('check_order', 'generate_payment') and not client_id:
+        # Pedidos só do cliente do token; sem login o bot não consulta nem altera nenhum
+        return "Para consultar pedidos, faça login no portal do cliente."
+
+    elif action['type'] == 'check_order':
+        print(f"🔍 [Bot] Verificando pedido: {action['order_id']}")
+        return tool_consultar_pedido(action['order_id'], client_id)
         
-        if action['type'] == 'search_product':
-            print(f"🔍 [Bot] Buscando produtos: {action['term']}")
-            tool_result = tool_consultar_produtos(action['term'])
-            
-        elif action['type'] == 'check_order':
-            print(f"🔍 [Bot] Verificando pedido: {action['order_id']}")
-            tool_result = tool_consultar_pedido(action['order_id'], client_id)
-            
-        elif action['type'] == 'generate_payment':
-            print(f"💰 [Bot] Gerando pagamento pedido: {action['order_id']}")
-            tool_result = tool_gerar_link_pagamento(action['order_id'])
+    elif action['type'] == 'generate_payment':
+        print(f"💰 [Bot] Gerando pagamento pedido: {action['order_id']}")
+        return tool_gerar_link_pagamento(action['order_id'], client_id)
+    return None
 
-        # 3. Segunda Chamada (Se houve ferramenta)
-        if tool_result:
-            prompt_com_dados = f"""
+
+def prompt_com_dados(tool_result):
+    return f"""
             DADOS OBTIDOS DO SISTEMA:
             {tool_result}
             
@@ -738,30 +4322,448 @@ def chat_endpoint():
             Se for produto, apresente de forma atraente com preço.
             Se for link, envie o link.
             """
-            
-            final_response = model.generate_content(
-                [{'role': 'user', 'parts': [prompt_com_dados]}],
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7,
-                    response_mime_type="application/json"
-                )
-            )
-            
-            final_resp_text = final_response.text.replace('```json', '').replace('```', '').strip()
-            final_json = json.loads(final_resp_text)
-            bot_text = final_json.get('botResponse', 'Aqui estão os dados.')
 
+
+def contents_segunda_chamada(gemini_history, ai_data, tool_result):
+    """Histórico + decisão do modelo + dados da ferramenta: a 2ª chamada mantém o contexto da conversa."""
+    return gemini_history + [
+        {'role': 'model', 'parts': [json.dumps(ai_data, ensure_ascii=False)]},
+        {'role': 'user', 'parts': [prompt_com_dados(tool_result)]},
+    ]
+
+
+# --- RESPOSTA FINAL POR TEMPLATE (SEM 2ª CHAMADA) ---
+# Lista de produtos, status de pedido e link de pagamento são dados
+# determinísticos: um template no servidor monta a resposta e a 2ª ida ao
+# Gemini (a metade da latência de um turno com ferramenta) deixa de existir.
+# O modelo só é chamado de novo quando não há template para o resultado.
+# CHAT_RENDERIZACAO=llm volta ao comportamento antigo (sempre 2ª chamada).
+CHAT_RENDERIZACAO = os.environ.get("CHAT_RENDERIZACAO", "template").lower()
+
+
+def formatar_reais(valor):
+    return "R$ " + f"{float(valor):,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+
+
+def renderizar_produtos(tool_result):
+    try:
+        produtos = json.loads(tool_result)
+    except ValueError:
+        return tool_result  # "Não encontrei produtos..." já é uma frase para o cliente
+    if not isinstance(produtos, list): return None
+    linhas = []
+    for p in produtos:
+        linha = f"• **{p['nome_produto']}** — a partir de {formatar_reais(p['preco_minimo'])}"
+        if (p.get('multiplos_de') or 1) > 1:
+            linha += f" (múltiplos de {p['multiplos_de']} un.)"
+        if p.get('descricao'):
+            linha += f"\n   {p['descricao'][:140]}"
+        linhas.append(linha)
+    linhas.append("💡 Quanto maior a quantidade, menor o custo unitário. Quer que eu monte um orçamento?")
+    return '\n'.join(linhas)
+
+
+def renderizar_pedido(tool_result):
+    try:
+        pedido = json.loads(tool_result)
+    except ValueError:
+        return tool_result  # "Pedido não encontrado..."
+    if not isinstance(pedido, dict) or 'id' not in pedido: return None
+    linhas = [f"📦 **Pedido #{pedido['id']}**", f"Status: **{pedido.get('status_pedido')}**"]
+    if pedido.get('valor_total') is not None:
+        linhas.append(f"Valor: {formatar_reais(pedido['valor_total'])}")
+    if pedido.get('link_pagamento'):
+        linhas.append(f"Link de pagamento: {pedido['link_pagamento']}")
+    return '\n'.join(linhas)
+
+
+def renderizar_pagamento(tool_result):
+    link = re.search(r'https?://\S+', tool_result)
+    if not link or 'sucesso' not in tool_result:
+        return tool_result  # mensagem de erro da ferramenta
+    return (f"Prontinho! 🎉 Aqui está o seu link seguro de pagamento:\n{link.group()}\n"
+            "Assim que o pagamento for confirmado, seu pedido segue para produção.")
+
+
+RENDERIZADORES = {
+    'search_product': renderizar_produtos,
+    'check_order': renderizar_pedido,
+    'generate_payment': renderizar_pagamento,
+}
+
+
+def renderizar_resultado(action, tool_result):
+    """Texto final montado no servidor, ou None se precisar do modelo."""
+    if CHAT_RENDERIZACAO != 'template': return None
+    renderizar = RENDERIZADORES.get(action['type'])
+    return renderizar(tool_result) if renderizar else None
+
+
+class HistogramaLatencia:
+    """Histograma de latência (ms) por (ação, modo), com baldes cumulativos fixos."""
+
+    LIMITES_MS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 15000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # (acao, modo) -> {"baldes": [...], "soma": ms, "n": int}
+
+    def observar(self, acao, modo, ms):
+        with self._lock:
+            serie = self._series.setdefault((acao, modo), {"baldes": [0] * (len(self.LIMITES_MS) + 1), "soma": 0.0, "n": 0})
+            for i, limite in enumerate(self.LIMITES_MS):
+                if ms <= limite:
+                    serie["baldes"][i] += 1
+                    break
+            else:
+                serie["baldes"][-1] += 1
+            serie["soma"] += ms
+            serie["n"] += 1
+
+    def _percentil(self, baldes, n, q):
+        acumulado = 0
+        for limite, contagem in zip(self.LIMITES_MS + (float('inf'),), baldes):
+            acumulado += contagem
+            if acumulado >= q * n:
+                return limite
+        return float('inf')
+
+    def stats(self):
+        with self._lock:
+            series = {k: dict(v, baldes=list(v["baldes"])) for k, v in self._series.items()}
+        saida = {}
+        for (acao, modo), serie in sorted(series.items()):
+            saida[f"{acao}/{modo}"] = {
+                "n": serie["n"],
+                "media_ms": round(serie["soma"] / serie["n"], 1),
+                # Percentis pelo limite superior do balde
+                "p50_ms_ate": self._percentil(serie["baldes"], serie["n"], 0.5),
+                "p95_ms_ate": self._percentil(serie["baldes"], serie["n"], 0.95),
+                "baldes": {f"<={limite}": c for limite, c in zip(self.LIMITES_MS, serie["baldes"])} | {"+Inf": serie["baldes"][-1]},
+            }
+        return saida
+
+
+latencias_chat = HistogramaLatencia()
+
+
+@app.route('/api/chat_vendas', methods=['POST'])
+def chat_endpoint():
+    # Verifica API KEY para não quebrar se não tiver configurado
+    if not GEMINI_API_KEY and not GEMINI_STUB:
+        return jsonify({"response": "O Chatbot está temporariamente indisponível (Falta API KEY).", "action_taken": "error"}), 503
+    # Backpressure: com o pool cheio nem lê o corpo, responde 429 na hora
+    if get_chat_executor().saturado():
+        return chat_ocupado()
+
+    inicio = time.perf_counter()
+    mensagem, history = ler_conversa_chat(request.json or {})
+    cliente = check_client_auth(request)
+    client_id = cliente['cliente_id'] if cliente else None
+    model = modelo_chat()
+    gemini_history = historico_gemini(history, mensagem)
+    chave = chave_intencao(mensagem, history)
+
+    try:
+        # 1. Primeira Chamada (Decisão) — ou a mesma decisão já tomada para essa mensagem
+        ai_data = cache_intencao.get(chave)
+        if ai_data is None:
+            response = gerar_conteudo(model, gemini_history)
+            ai_data = ler_json_modelo(response.text)
+            guardar_intencao(chave, ai_data)
+        
+        action = ai_data.get('actionRequired', {'type': 'none'})
+        bot_text = ai_data.get('botResponse', '')
+        
+        # 2. Execução de Ferramentas
+        tool_result = executar_ferramenta(action, client_id)
+        modo = 'sem_ferramenta'
+
+        # 3. Resposta final: template no servidor ou, sem template, Segunda Chamada
+        if tool_result:
+            renderizado = renderizar_resultado(action, tool_result)
+            if renderizado is not None:
+                modo = 'template'
+                bot_text = f"{bot_text}\n\n{renderizado}" if bot_text else renderizado
+            else:
+                modo = 'llm'
+                try:
+                    final_response = gerar_conteudo(model, contents_segunda_chamada(gemini_history, ai_data, tool_result), etapa="resposta")
+                except (ChatOcupado, ChatTimeout):
+                    # A ferramenta já rodou (ex.: link gerado): entrega os dados crus em vez de perdê-los
+                    latencias_chat.observar(action['type'], 'dados_crus', (time.perf_counter() - inicio) * 1000)
+                    return jsonify({"response": f"{bot_text}\n\n{tool_result}", "action_taken": action['type']})
+                
+                final_json = ler_json_modelo(final_response.text)
+                bot_text = final_json.get('botResponse', 'Aqui estão os dados.')
+
+        latencias_chat.observar(action['type'], modo, (time.perf_counter() - inicio) * 1000)
         return jsonify({
             "response": bot_text,
             "action_taken": action['type']
         })
 
+    except ChatOcupado:
+        return chat_ocupado()
+    except ChatTimeout:
+        print(f"⚠️ [Bot] Gemini não respondeu em {get_chat_executor().timeout}s")
+        return jsonify({"response": MSG_CHAT_TIMEOUT, "action_taken": "timeout"}), 504
     except Exception as e:
         print(f"🔴 Erro Chatbot: {e}")
-        return jsonify({"response": "Desculpe, tive um lapso de memória momentâneo. Pode repetir?", "error": str(e)}), 500
+        return jsonify({"response": MSG_CHAT_ERRO, "error": str(e)}), 500
+
+
+# --- CHAT EM STREAMING (SERVER-SENT EVENTS) ---
+# Mesmo fluxo e mesmo contrato JSON (botResponse + actionRequired) do
+# chat_endpoint, mas o cliente vê o texto enquanto o modelo escreve.
+# Eventos, em ordem:
+#   token       {"fase": "decisao", "texto"}  pedaços do botResponse da 1ª chamada
+#   acao        {"botResponse", "actionRequired"}  JSON completo da 1ª chamada
+#   ferramenta  {"type", "status": "executando" | "concluida"}
+#   token       {"fase": "final", "texto"}  pedaços da resposta final (2ª chamada)
+#   fim         {"response", "action_taken"}  mesmo corpo do chat_endpoint
+#   erro        {"response", "action_taken"[, "retry_after"]}
+_ESCAPES_JSON = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class ExtratorBotResponse:
+    """Decodifica o valor de "botResponse" de um JSON que chega em pedaços, à medida que chega."""
+
+    def __init__(self):
+        self.bruto = ''   # tudo que o modelo mandou até agora
+        self.texto = ''   # valor decodificado já emitido
+        self.fechado = False
+        self._cursor = None
+
+    def alimentar(self, pedaco):
+        """Acrescenta `pedaco` e devolve o trecho novo do botResponse (pode ser '')."""
+        self.bruto += pedaco
+        if self.fechado: return ''
+        if self._cursor is None:
+            m = re.search(r'"botResponse"\s*:\s*"', self.bruto)
+            if not m: return ''
+            self._cursor = m.end()
+        b, i, saida = self.bruto, self._cursor, []
+        while i < len(b):
+            ch = b[i]
+            if ch == '"':
+                self.fechado = True
+                break
+            if ch != '\\':
+                saida.append(ch); i += 1
+                continue
+            # Escape: só consome quando ele chegou inteiro
+            if i + 1 >= len(b): break
+            if b[i + 1] != 'u':
+                saida.append(_ESCAPES_JSON.get(b[i + 1], b[i + 1])); i += 2
+                continue
+            if i + 6 > len(b): break
+            codigo = int(b[i + 2:i + 6], 16)
+            if 0xD800 <= codigo < 0xDC00:  # par substituto (emoji escapado)
+                if i + 12 > len(b): break
+                baixo = int(b[i + 8:i + 12], 16)
+                codigo = 0x10000 + ((codigo - 0xD800) << 10) + (baixo - 0xDC00)
+                i += 6
+            saida.append(chr(codigo)); i += 6
+        self._cursor = i
+        novo = ''.join(saida)
+        self.texto += novo
+        return novo
+
+
+def evento_sse(evento, dados):
+    return b'event: ' + evento.encode() + b'\ndata: ' + json_bytes(dados) + b'\n\n'
+
+
+@app.route('/api/chat_vendas/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """ Variante do /api/chat_vendas em text/event-stream (ver eventos acima). """
+    if not GEMINI_API_KEY and not GEMINI_STUB:
+        return jsonify({"response": "O Chatbot está temporariamente indisponível (Falta API KEY).", "action_taken": "error"}), 503
+    if get_chat_executor().saturado():
+        return chat_ocupado()
+
+    inicio = time.perf_counter()
+    mensagem, history = ler_conversa_chat(request.json or {})
+    cliente = check_client_auth(request)
+    client_id = cliente['cliente_id'] if cliente else None
+    model = modelo_chat()
+    gemini_history = historico_gemini(history, mensagem)
+    chave = chave_intencao(mensagem, history)
+
+    def eventos():
+        action = {'type': 'none'}
+        try:
+            # 1. Primeira Chamada (Decisão): o botResponse sai enquanto o modelo escreve
+            ai_data = cache_intencao.get(chave)
+            if ai_data is not None:
+                if ai_data.get('botResponse'):
+                    yield evento_sse('token', {'fase': 'decisao', 'texto': ai_data['botResponse']})
+            else:
+                extrator = ExtratorBotResponse()
+                for pedaco in gerar_conteudo_stream(model, gemini_history):
+                    texto = extrator.alimentar(pedaco)
+                    if texto: yield evento_sse('token', {'fase': 'decisao', 'texto': texto})
+                ai_data = ler_json_modelo(extrator.bruto)
+                guardar_intencao(chave, ai_data)
+            action = ai_data.get('actionRequired') or {'type': 'none'}
+            bot_text = ai_data.get('botResponse', '')
+            yield evento_sse('acao', {'botResponse': bot_text, 'actionRequired': action})
+
+            def fim(resposta, modo):
+                latencias_chat.observar(action['type'], modo, (time.perf_counter() - inicio) * 1000)
+                return evento_sse('fim', {'response': resposta, 'action_taken': action['type']})
+
+            # 2. Execução de Ferramentas
+            if action['type'] == 'none':
+                yield fim(bot_text, 'sem_ferramenta')
+                return
+            yield evento_sse('ferramenta', {'type': action['type'], 'status': 'executando'})
+            tool_result = executar_ferramenta(action, client_id)
+            yield evento_sse('ferramenta', {'type': action['type'], 'status': 'concluida'})
+            if not tool_result:
+                yield fim(bot_text, 'sem_ferramenta')
+                return
+
+            # 3. Resposta final: template no servidor ou Segunda Chamada, token a token
+            renderizado = renderizar_resultado(action, tool_result)
+            if renderizado is not None:
+                yield evento_sse('token', {'fase': 'final', 'texto': renderizado})
+                yield fim(f"{bot_text}\n\n{renderizado}" if bot_text else renderizado, 'template')
+                return
+            final = ExtratorBotResponse()
+            try:
+                for pedaco in gerar_conteudo_stream(model, contents_segunda_chamada(gemini_history, ai_data, tool_result), etapa="resposta"):
+                    texto = final.alimentar(pedaco)
+                    if texto: yield evento_sse('token', {'fase': 'final', 'texto': texto})
+            except (ChatOcupado, ChatTimeout):
+                if not final.texto:
+                    # A ferramenta já rodou (ex.: link gerado): entrega os dados crus em vez de perdê-los
+                    yield evento_sse('token', {'fase': 'final', 'texto': tool_result})
+                    yield fim(f"{bot_text}\n\n{tool_result}", 'dados_crus')
+                    return
+            try:
+                resposta = ler_json_modelo(final.bruto).get('botResponse', 'Aqui estão os dados.')
+            except ValueError:
+                resposta = final.texto or 'Aqui estão os dados.'
+            yield fim(resposta, 'llm')
+
+        except ChatOcupado:
+            yield evento_sse('erro', {'response': MSG_CHAT_OCUPADO, 'action_taken': 'busy', 'retry_after': CHAT_RETRY_AFTER})
+        except ChatTimeout:
+            print(f"⚠️ [Bot] Gemini não respondeu em {get_chat_executor().timeout}s")
+            yield evento_sse('erro', {'response': MSG_CHAT_TIMEOUT, 'action_taken': 'timeout'})
+        except Exception as e:
+            print(f"🔴 Erro Chatbot: {e}")
+            yield evento_sse('erro', {'response': MSG_CHAT_ERRO, 'action_taken': 'error'})
+
+    resp = Response(eventos(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx/proxy do Render: não segurar os eventos
+    return resp
+
+
+# ======================================================================
+# 6. SERVIDOR DE PRODUÇÃO (GANCHOS DO GUNICORN)
+# ======================================================================
+# Chamados pelo gunicorn.conf.py. Importar este módulo não abre conexão nem
+# thread (pool, listener, executores e caches nascem sob demanda, por PID),
+# então o master pode carregar o código uma vez (preload_app) e os workers
+# herdam as páginas por copy-on-write. Cada worker se aquece antes do
+# primeiro accept() e, ao sair num reload, fecha os streams SSE para o front
+# reconectar num worker novo em vez de segurar o reload até o graceful_timeout.
+AQUECER_WORKER = os.environ.get("AQUECER_WORKER", "1") != "0"
+AQUECER_ESPERA_LISTENER = float(os.environ.get("AQUECER_ESPERA_LISTENER", 5))
+_estado_worker = {"aquecido": False, "aquecimento_ms": None, "encerrando": False}
+_herdados_do_master = []  # objetos com sockets do master: nunca coletados no filho (ver apos_fork)
+
+
+def antes_do_fork():
+    """No master: fecha conexões abertas durante o preload, para nenhum socket ir parar em dois processos."""
+    reset_db_pool()
+
+
+def apos_fork():
+    """
+    No worker recém-criado: solta o pool e o listener herdados do master (os
+    getters já recriariam pelo PID). As referências ficam guardadas: coletar
+    uma conexão herdada mandaria o Terminate pelo socket que ainda é do master.
+    """
+    global _db_pool, _pg_listener
+    with _db_pool_lock:
+        _herdados_do_master.extend(o for o in (_db_pool, _pg_listener) if o is not None)
+        _db_pool = _pg_listener = None
+
+
+def aquecer_worker():
+    """
+    Deixa o worker pronto antes do primeiro cliente: conexões do pool, segredo
+    dos tokens de cliente, LISTEN de todos os caches (num único connect),
+    catálogo em cache, teste do índice trigram e handle do modelo do chat. Falha numa etapa só é registrada: o
+    worker sobe e a etapa acontece na primeira requisição, como antes.
+    """
+    inicio = time.perf_counter()
+    etapas = {}
+
+    def etapa(nome, passo):
+        t = time.perf_counter()
+        try:
+            passo()
+            etapas[nome] = round((time.perf_counter() - t) * 1000, 1)
+        except Exception as e:
+            etapas[nome] = f"erro: {e}"
+
+    def listener():
+        for registrar in (sessoes._garantir_processo, revogacao_clientes._garantir_listener,
+                          catalog_cache._garantir_listener, eventos_pedidos._garantir_listener,
+                          cache_ferramenta_produtos._garantir_listener):
+            registrar()
+        ouvinte, limite = get_pg_listener(), time.monotonic() + AQUECER_ESPERA_LISTENER
+        while not (ouvinte.online and not ouvinte._reiniciar) and time.monotonic() < limite:
+            time.sleep(0.01)
+        if not ouvinte.online: raise RuntimeError("listener ainda offline")
+
+    def catalogo():
+        catalog_cache.get()
+        if not catalog_cache.stats()["em_cache"]:  # invalidado pelo ao_reconectar no meio da carga
+            catalog_cache.get()
+
+    def busca():
+        with db_connection() as conn:
+            busca_trgm_disponivel(conn.cursor())
+
+    etapa("pool", get_db_pool)
+    etapa("token_cliente", chave_cliente)
+    etapa("listener", listener)
+    etapa("catalogo", catalogo)
+    etapa("busca", busca)
+    etapa("modelo", lambda: (modelo_chat(), get_chat_executor()))
+    _estado_worker["aquecido"] = True
+    _estado_worker["aquecimento_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    print(f"✅ [WORKER {os.getpid()}] Aquecido em {_estado_worker['aquecimento_ms']} ms: {etapas}")
+    return etapas
+
+
+def encerrar_worker():
+    """SIGTERM no worker (reload, deploy, scale down): para de aceitar streams e fecha os abertos."""
+    _estado_worker["encerrando"] = True
+    eventos_pedidos.encerrar()
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """ Health check do balanceador: 503 enquanto o worker está saindo. """
+    return jsonify(dict(_estado_worker, pid=os.getpid())), 503 if _estado_worker["encerrando"] else 200
 
 
 if __name__ == '__main__':
-    setup_database()
+    # Só para desenvolvimento; em produção: gunicorn -c gunicorn.conf.py app:app
+    # Migrações rodam no deploy (`flask --app app migrar`); aqui só avisamos.
+    try:
+        pendentes = migracoes_pendentes()
+        if pendentes:
+            print(f"⚠️  [DB] {len(pendentes)} migração(ões) pendente(s). Rode: flask --app app migrar")
+    except Exception as e:
+        print(f"🔴 ERRO AO CONECTAR NO DB: {e}")
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
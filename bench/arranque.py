@@ -0,0 +1,226 @@
+"""
+Arranque e reload do gunicorn (gunicorn.conf.py): tempo até atender, primeiras requisições e memória.
+
+Sobe `gunicorn -c gunicorn.conf.py app:app` contra o banco de DATABASE_URL em
+cada perfil e mede:
+
+  pronto_s:   do exec até o primeiro 200 em /healthz;
+  primeiras:  latência das --primeiras requisições ao catálogo, disparadas juntas
+              logo depois de pronto (o custo de worker frio: conexões, LISTEN,
+              catálogo fora do cache);
+  pss_mb:     memória proporcional (PSS) de master + workers, depois das
+              primeiras requisições: com preload as páginas do código são divididas.
+
+Perfis:
+  padrao:       preload + aquecimento (o gunicorn.conf.py sem variáveis);
+  sem_aquecer:  preload, AQUECER_WORKER=0;
+  sem_preload:  GUNICORN_PRELOAD=0 e AQUECER_WORKER=0 (cada worker importa o app e
+                esquenta na primeira requisição, como antes).
+
+No perfil padrão também faz um reload (SIGHUP ao master) com requisições
+contínuas ao catálogo (uma conexão nova por requisição, como atrás do proxy)
+e um stream SSE de pedidos aberto:
+
+  reload_s:       até o último worker antigo sair;
+  falhas:         requisições sem 200/304 durante o reload (tem que ser 0);
+  sse_fechado_s:  quanto o worker antigo levou para fechar o stream (sem o
+                  encerramento dos streams seria o graceful_timeout).
+
+Uso:
+    DATABASE_URL=postgresql://... python bench/arranque.py --workers 2 --primeiras 16
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import app as portal  # noqa: E402
+
+PERFIS = {
+    "padrao": {},
+    "sem_aquecer": {"AQUECER_WORKER": "0"},
+    "sem_preload": {"GUNICORN_PRELOAD": "0", "AQUECER_WORKER": "0"},
+}
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def filhos(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def pss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                total += next(int(l.split()[1]) for l in f if l.startswith("Pss:"))
+        except (OSError, StopIteration):
+            pass
+    return round(total / 1024, 1)
+
+
+class Servidor:
+    """Um gunicorn com o gunicorn.conf.py do repositório, numa porta livre."""
+
+    def __init__(self, workers, env_extra, log):
+        self.porta = porta_livre()
+        self.url = f"http://127.0.0.1:{self.porta}"
+        env = dict(os.environ, PORT=str(self.porta), WEB_CONCURRENCY=str(workers), **env_extra)
+        self.inicio = time.perf_counter()
+        self.proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                                     cwd=RAIZ, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def esperar_pronto(self, limite=60):
+        while time.perf_counter() - self.inicio < limite:
+            if self.proc.poll() is not None:
+                raise RuntimeError("gunicorn saiu durante o arranque (veja o log)")
+            try:
+                if requests.get(f"{self.url}/healthz", timeout=1).status_code == 200:
+                    return time.perf_counter() - self.inicio
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("gunicorn não ficou pronto")
+
+    def parar(self):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout=40)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def disparar_juntas(url, headers, n):
+    """n GETs simultâneos (conexões novas); devolve as latências em ms."""
+    latencias, barreira = [None] * n, threading.Barrier(n)
+
+    def uma(i):
+        barreira.wait()
+        t = time.perf_counter()
+        r = requests.get(url, headers=headers, timeout=30)
+        latencias[i] = round((time.perf_counter() - t) * 1000, 1) if r.status_code == 200 else None
+
+    ts = [threading.Thread(target=uma, args=(i,)) for i in range(n)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    return [l for l in latencias if l is not None]
+
+
+def medir_reload(servidor, headers, duracao_carga):
+    antigos = set(filhos(servidor.proc.pid))
+    parar, resultado = threading.Event(), {"requisicoes": 0, "falhas": 0, "sse_fechado_s": None}
+
+    def carga():
+        while not parar.is_set():
+            try:
+                r = requests.get(f"{servidor.url}/api/cliente/produtos", headers=headers, timeout=30)
+                ok = r.status_code in (200, 304)
+            except requests.RequestException:
+                ok = False
+            resultado["requisicoes"] += 1
+            resultado["falhas"] += not ok
+
+    # Socket cru, como o navegador: lê até o servidor encerrar o stream e fecha na hora
+    sse = socket.create_connection(("127.0.0.1", servidor.porta))
+    sse.sendall(f"GET /api/cliente/pedidos/eventos HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                f"Authorization: {headers['Authorization']}\r\n\r\n".encode())
+    sse_aberto = threading.Event()
+    hup = [None]
+
+    def ler_sse():
+        try:
+            while sse.recv(65536):
+                sse_aberto.set()
+        except OSError:
+            pass
+        sse.close()
+        if hup[0] is not None:
+            resultado["sse_fechado_s"] = round(time.perf_counter() - hup[0], 2)
+
+    leitores = [threading.Thread(target=carga) for _ in range(4)] + [threading.Thread(target=ler_sse)]
+    for t in leitores: t.start()
+    sse_aberto.wait(5)
+    time.sleep(0.5)
+    hup[0] = time.perf_counter()
+    servidor.proc.send_signal(signal.SIGHUP)
+    while antigos & set(filhos(servidor.proc.pid)) and time.perf_counter() - hup[0] < 60:
+        time.sleep(0.01)
+    resultado["reload_s"] = round(time.perf_counter() - hup[0], 2)
+    time.sleep(duracao_carga)
+    parar.set()
+    for t in leitores: t.join()
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--primeiras", type=int, default=16, help="requisições simultâneas logo após o arranque")
+    parser.add_argument("--perfis", default=",".join(PERFIS), help="perfis a medir, separados por vírgula")
+    parser.add_argument("--carga-pos-reload", type=float, default=1.0, help="segundos de carga depois do reload")
+    parser.add_argument("--log", default="/tmp/bench_arranque.log", help="saída do gunicorn")
+    parser.add_argument("--json", help="grava o resultado neste arquivo")
+    args = parser.parse_args()
+
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM suagrafica_clientes WHERE status_acesso = 'Ativo' ORDER BY id LIMIT 1")
+        cliente_id = cur.fetchone()[0]
+    headers = {"Authorization": "Bearer " + portal.assinar_token_cliente(cliente_id, 'Ativo')}
+
+    resultado = {"parametros": vars(args), "perfis": {}}
+    print(f"ℹ️  {args.workers} workers, {args.primeiras} requisições simultâneas ao catálogo após o arranque\n")
+    print(f"{'perfil':<12} {'pronto':>8} {'1ªs p50':>9} {'1ªs máx':>9} {'PSS':>9}")
+    with open(args.log, "w") as log:
+        for nome in args.perfis.split(","):
+            servidor = Servidor(args.workers, PERFIS[nome], log)
+            try:
+                pronto = servidor.esperar_pronto()
+                latencias = disparar_juntas(f"{servidor.url}/api/cliente/produtos", headers, args.primeiras)
+                medida = {
+                    "pronto_s": round(pronto, 2),
+                    "primeiras_ok": len(latencias),
+                    "primeiras_p50_ms": round(statistics.median(latencias), 1) if latencias else None,
+                    "primeiras_max_ms": max(latencias) if latencias else None,
+                    "pss_mb": pss_mb([servidor.proc.pid] + filhos(servidor.proc.pid)),
+                }
+                print(f"{nome:<12} {medida['pronto_s']:>7}s {medida['primeiras_p50_ms']:>7}ms "
+                      f"{medida['primeiras_max_ms']:>7}ms {medida['pss_mb']:>7}MB")
+                if nome == "padrao":
+                    medida["reload"] = medir_reload(servidor, headers, args.carga_pos_reload)
+                resultado["perfis"][nome] = medida
+            finally:
+                servidor.parar()
+
+    if "padrao" in resultado["perfis"]:
+        r = resultado["perfis"]["padrao"]["reload"]
+        print(f"\nreload (HUP): {r['reload_s']}s, {r['requisicoes']} requisições, {r['falhas']} falha(s), "
+              f"stream SSE fechado em {r['sse_fechado_s']}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultado gravado em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark da busca de produtos: ILIKE antigo x buscar_produtos() (tsvector/pg_trgm).
+
+Semeia um catálogo sintético (padrão: 100 mil produtos com código 'BENCH-*'),
+roda as mesmas consultas nas duas estratégias e mostra p50/p95 por termo e
+quantos resultados cada uma encontrou. Os produtos BENCH-* são apagados no
+final (use --manter para reaproveitar em outra rodada).
+
+Uso (banco de desenvolvimento, com as migrações aplicadas):
+    DATABASE_URL=postgresql://... python bench/busca_produtos.py --produtos 100000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psycopg2.extras  # noqa: E402
+import app as portal  # noqa: E402
+
+NOMES = ['Caneta', 'Caderno', 'Agenda', 'Caneca', 'Camiseta', 'Powerbank', 'Chaveiro', 'Mochila',
+         'Squeeze', 'Bloco de Notas', 'Pendrive', 'Guarda-chuva', 'Boné', 'Ecobag', 'Calendário']
+MATERIAIS = ['Metal', 'Plástico', 'Bambu', 'Couro', 'Algodão', 'Alumínio', 'Ecológico', 'Térmico',
+             'Cortiça', 'Acrílico', 'Poliéster', 'Vidro']
+DETALHES = ['Premium', 'Promocional', 'Executivo', 'Colorido', 'Personalizado', 'Slim', 'Retrátil',
+            'com Gravação a Laser', '32GB', '10000mAh', 'Capa Dura', 'Espiral']
+
+TERMOS = ['caneta', 'cadernos', 'agenda couro', 'algodao', 'termico', 'bambu', 'pendrive 32',
+          'squeeze aluminio', 'calendario', 'gravação laser', 'cad', 'xyzinexistente']
+
+BASELINE_SQL = """
+    SELECT nome_produto, preco_minimo, multiplos_de, descricao
+    FROM suagrafica_produtos
+    WHERE esta_ativo = TRUE AND (nome_produto ILIKE %s OR descricao ILIKE %s)
+    LIMIT 5
+"""
+
+
+def semear(cur, quantidade):
+    print(f"ℹ️  Semeando {quantidade} produtos BENCH-*...")
+    inicio = time.perf_counter()
+    cur.execute("""
+        INSERT INTO suagrafica_produtos (codigo_produto, nome_produto, descricao, preco_minimo, multiplos_de)
+        SELECT 'BENCH-' || g,
+               (%(nomes)s)[1 + floor(random() * cardinality(%(nomes)s))::int] || ' ' ||
+               (%(materiais)s)[1 + floor(random() * cardinality(%(materiais)s))::int] || ' ' ||
+               (%(detalhes)s)[1 + floor(random() * cardinality(%(detalhes)s))::int],
+               'Brinde ' || lower((%(detalhes)s)[1 + floor(random() * cardinality(%(detalhes)s))::int]) ||
+               ' em ' || lower((%(materiais)s)[1 + floor(random() * cardinality(%(materiais)s))::int]) ||
+               ', ideal para eventos corporativos. Lote ' || g,
+               round((1 + random() * 200)::numeric, 2),
+               (ARRAY[1, 10, 50, 100])[1 + g %% 4]
+        FROM generate_series(1, %(qtd)s) g
+        ON CONFLICT (codigo_produto) DO NOTHING
+    """, {"nomes": NOMES, "materiais": MATERIAIS, "detalhes": DETALHES, "qtd": quantidade})
+    cur.execute("ANALYZE suagrafica_produtos")
+    print(f"✅ Semeados em {time.perf_counter() - inicio:.1f}s.")
+
+
+def medir(func, repeticoes):
+    tempos, resultados = [], 0
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultados = len(func())
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    tempos.sort()
+    return {
+        "p50_ms": round(statistics.median(tempos), 3),
+        "p95_ms": round(tempos[max(0, int(len(tempos) * 0.95) - 1)], 3),
+        "resultados": resultados,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--produtos", type=int, default=100_000)
+    parser.add_argument("--repeticoes", type=int, default=20)
+    parser.add_argument("--manter", action="store_true", help="não apaga os produtos BENCH-* no final")
+    parser.add_argument("--json", help="grava o resultado neste arquivo")
+    args = parser.parse_args()
+
+    portal.aplicar_migracoes()
+    conn = psycopg2.connect(portal.DATABASE_URL)
+    conn.autocommit = True
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        cur.execute("SELECT COUNT(*) AS n FROM suagrafica_produtos WHERE codigo_produto LIKE 'BENCH-%%'")
+        if cur.fetchone()['n'] < args.produtos:
+            semear(cur, args.produtos)
+
+        resultado = {"produtos": args.produtos, "trgm": portal.busca_trgm_disponivel(cur), "termos": {}}
+        print(f"\n{'termo':<20} {'ILIKE p50':>10} {'p95':>8} {'n':>4}   {'busca p50':>10} {'p95':>8} {'n':>4}")
+        for termo in TERMOS:
+            baseline = medir(lambda: cur.execute(BASELINE_SQL, (f'%{termo}%', f'%{termo}%')) or cur.fetchall(), args.repeticoes)
+            nova = medir(lambda: portal.buscar_produtos(cur, termo, limite=5), args.repeticoes)
+            resultado["termos"][termo] = {"ilike": baseline, "busca": nova}
+            print(f"{termo:<20} {baseline['p50_ms']:>10} {baseline['p95_ms']:>8} {baseline['resultados']:>4}   "
+                  f"{nova['p50_ms']:>10} {nova['p95_ms']:>8} {nova['resultados']:>4}")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(resultado, f, indent=2, ensure_ascii=False)
+            print(f"\n💾 Resultado gravado em {args.json}")
+    finally:
+        if not args.manter:
+            cur.execute("DELETE FROM suagrafica_produtos WHERE codigo_produto LIKE 'BENCH-%%'")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
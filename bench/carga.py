@@ -0,0 +1,583 @@
+"""
+Teste de carga do portal contra um Postgres local: latência, vazão, consultas e memória por endpoint.
+
+Subcomandos:
+
+  semear   popula o banco com dados sintéticos marcados com o prefixo CARGA-
+           (clientes, produtos e pedidos com itens), por generate_series e em
+           lotes. Os pedidos entram com os triggers desligados
+           (session_replication_role = replica: sem um NOTIFY por pedido) e no
+           fim as estatísticas do painel são reconstruídas e as versões de
+           pedidos/itens incrementadas (ETags e caches se atualizam).
+  limpar   apaga tudo o que tem o prefixo CARGA- (inclusive pedidos criados
+           durante as rodadas).
+  rodar    dispara uma mistura de vitrine (catálogo com ETag e busca),
+           histórico e criação de pedidos do cliente, listagem e painel do
+           admin e turnos do chat, com --usuarios threads por --segundos. O
+           Gemini é o ModeloStub com latência fixa (--gemini-ms). Antes da
+           mistura, cada endpoint roda sozinho por --isolado segundos para medir
+           o crescimento de memória (RSS) do worker que ele causa.
+  comparar compara dois JSON de `rodar` e sai com código 1 se algum endpoint
+           piorou além da tolerância (p95 ou vazão).
+
+Por padrão roda no próprio processo (test client do Flask, sem rede). Com
+--url, bate num servidor já no ar (subir com GEMINI_STUB=1 e a mesma
+DATABASE_URL, ou o mesmo CLIENTE_TOKEN_SEGREDO); a memória vem dos --pids
+informados e as consultas do /metrics (com um worker só os números fecham).
+
+Uso:
+    DATABASE_URL=postgresql://... python bench/carga.py semear --clientes 5000 --produtos 100000 --pedidos 1000000
+    DATABASE_URL=postgresql://... python bench/carga.py rodar --segundos 60 --usuarios 16 --json antes.json
+    python bench/carga.py comparar antes.json depois.json --tolerancia 10
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PREFIXO = "CARGA-"
+MISTURA_PADRAO = "catalogo=25,busca=20,meus_pedidos=15,criar_pedido=10,admin_pedidos=10,admin_painel=5,chat=15"
+TERMOS = ["caneta", "caderno", "caneca", "mochila", "ecobag", "squeeze", "chaveiro", "agenda", "camiseta",
+          "metal", "bambu", "premium", "ecologico", "executivo", "canet", "cadern"]
+PERGUNTAS = ["Quero ver {termo} para um evento", "Vocês têm {termo}?", "Qual o status do pedido {n}?",
+             "Pode gerar o link de pagamento do pedido {n}?", "Preciso de {termo} personalizado"]
+
+
+def carregar_portal(gemini_ms=None):
+    """Importa o app com o Gemini trocado pelo stub (latência fixa, determinística)."""
+    os.environ["GEMINI_STUB"] = "1"
+    if gemini_ms is not None:
+        os.environ["GEMINI_STUB_LATENCIA"] = str(gemini_ms / 1000)
+    import app as portal
+    return portal
+
+
+# ======================================================================
+# SEMEAR / LIMPAR
+# ======================================================================
+SQL_CLIENTES = """
+    INSERT INTO suagrafica_clientes (nome_cliente, email_contato, codigo_acesso, status_acesso)
+    SELECT 'Empresa Carga ' || g, 'carga' || g || '@bench.local', %(prefixo)s || g,
+           CASE WHEN g %% 50 = 0 THEN 'Inativo' ELSE 'Ativo' END
+    FROM generate_series(1, %(n)s) g
+"""
+SQL_PRODUTOS = """
+    INSERT INTO suagrafica_produtos (codigo_produto, nome_produto, descricao, preco_minimo, multiplos_de,
+                                     estoque_disponivel, esta_ativo)
+    SELECT %(prefixo)s || g,
+           (ARRAY['Caneta', 'Caderno', 'Caneca', 'Mochila', 'Ecobag', 'Squeeze', 'Chaveiro', 'Agenda',
+                  'Pen Drive', 'Camiseta'])[1 + g %% 10] || ' ' ||
+           (ARRAY['Metal', 'Bambu', 'Premium', 'Ecológico', 'Personalizado', 'Executivo', 'Color'])[1 + (g / 10) %% 7]
+               || ' ' || g,
+           'Brinde promocional para eventos corporativos, com gravação da marca. Lote ' || g,
+           round((1 + (g * 7919 %% 20000) / 100.0)::numeric, 2),
+           (ARRAY[1, 10, 50, 100])[1 + g %% 4], g %% 20 <> 0, g %% 25 <> 0
+    FROM generate_series(1, %(n)s) g
+"""
+# Mesmo padrão do INSERT de pedidos do app: ids reservados por nextval num CTE, itens e
+# cabeçalho (com o total já somado) gravados no mesmo comando. Poucos clientes concentram
+# a maior parte dos pedidos (random()^2.5), como contas B2B grandes.
+SQL_PEDIDOS = """
+    WITH p AS (
+        SELECT nextval('suagrafica_pedidos_id_seq') AS id,
+               (%(clientes)s::int[])[1 + floor(%(nc)s * power(random(), 2.5))::int] AS cliente_id,
+               CASE WHEN r < 0.60 THEN 'Concluído' WHEN r < 0.75 THEN 'Em Produção'
+                    WHEN r < 0.85 THEN 'Aguardando Pagamento' WHEN r < 0.95 THEN 'Aguardando Aprovação'
+                    ELSE 'Cancelado' END AS status_pedido,
+               now() - random() * interval '730 days' AS data_criacao,
+               1 + floor(random() * (2 * %(itens)s - 1))::int AS n_itens
+        FROM (SELECT random() AS r FROM generate_series(1, %(n)s)) g
+    ), i AS (
+        SELECT p.id AS pedido_id, (%(produtos)s::int[])[k] AS produto_id,
+               (%(multiplos)s::int[])[k] * (1 + floor(random() * 10)::int) AS quantidade,
+               (%(precos)s::numeric[])[k] AS preco
+        FROM p, LATERAL generate_series(1, p.n_itens) s,
+             LATERAL (SELECT 1 + floor(random() * %(np)s)::int + 0 * s AS k) e
+    ), itens AS (
+        INSERT INTO suagrafica_pedido_itens (pedido_id, produto_id, quantidade, preco_unitario_registrado)
+        SELECT pedido_id, produto_id, quantidade, preco FROM i
+    )
+    INSERT INTO suagrafica_pedidos (id, cliente_id, valor_total, status_pedido, data_criacao)
+    SELECT p.id, p.cliente_id, coalesce(t.total, 0), p.status_pedido, p.data_criacao
+    FROM p LEFT JOIN (SELECT pedido_id, sum(quantidade * preco) AS total FROM i GROUP BY pedido_id) t
+        ON t.pedido_id = p.id
+"""
+
+
+def sem_triggers(cur):
+    """Desliga triggers (NOTIFY, resumos, FKs) na transação; False se o usuário não for superusuário."""
+    try:
+        cur.execute("SAVEPOINT replica")
+        cur.execute("SET LOCAL session_replication_role = replica")
+        return True
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT replica")
+        print(f"⚠️  Sem permissão para desligar triggers ({str(e).strip()}); cada lote vai gerar NOTIFYs.")
+        return False
+
+
+def pos_carga(portal, cur, tabelas):
+    """Depois de gravar sem triggers: resumos do painel, versões (ETag/caches) e estatísticas do planner."""
+    portal.reconstruir_estatisticas(cur)
+    cur.execute("""
+        UPDATE suagrafica_versoes SET versao = versao + 1 WHERE tabela = ANY(%s)
+        RETURNING pg_notify(%s, tabela || ':' || versao)
+    """, (list(tabelas), portal.VERSOES_CANAL))
+
+
+def semear(args):
+    portal = carregar_portal()
+    portal.aplicar_migracoes()
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM suagrafica_clientes WHERE codigo_acesso LIKE %s", (PREFIXO + '%',))
+        if cur.fetchone()[0]:
+            print("🔴 O banco já tem dados de carga. Rode 'limpar' antes de semear de novo.")
+            sys.exit(1)
+        cur.execute("SELECT setseed(%s)", (args.semente,))
+
+        inicio = time.perf_counter()
+        cur.execute(SQL_CLIENTES, {"prefixo": PREFIXO, "n": args.clientes})
+        cur.execute(SQL_PRODUTOS, {"prefixo": PREFIXO, "n": args.produtos})
+        conn.commit()
+        print(f"✅ {args.clientes} clientes e {args.produtos} produtos em {time.perf_counter() - inicio:.1f}s")
+
+        cur.execute("SELECT array_agg(id ORDER BY id) FROM suagrafica_clientes WHERE codigo_acesso LIKE %s",
+                    (PREFIXO + '%',))
+        clientes = cur.fetchone()[0]
+        cur.execute("""
+            SELECT array_agg(id ORDER BY id), array_agg(coalesce(multiplos_de, 1) ORDER BY id),
+                   array_agg(preco_minimo ORDER BY id)
+            FROM suagrafica_produtos WHERE codigo_produto LIKE %s
+        """, (PREFIXO + '%',))
+        produtos, multiplos, precos = cur.fetchone()
+
+        inicio, feitos = time.perf_counter(), 0
+        while feitos < args.pedidos:
+            n = min(args.lote, args.pedidos - feitos)
+            sem_triggers(cur)
+            cur.execute(SQL_PEDIDOS, {"clientes": clientes, "nc": len(clientes), "produtos": produtos,
+                                      "multiplos": multiplos, "precos": precos, "np": len(produtos),
+                                      "itens": args.itens_por_pedido, "n": n})
+            conn.commit()
+            feitos += n
+            print(f"ℹ️  {feitos}/{args.pedidos} pedidos ({feitos / (time.perf_counter() - inicio):.0f}/s)")
+
+        pos_carga(portal, cur, ('suagrafica_pedidos', 'suagrafica_pedido_itens'))
+        conn.commit()
+        conn.autocommit = True
+        cur.execute("ANALYZE suagrafica_clientes, suagrafica_produtos, suagrafica_pedidos, suagrafica_pedido_itens")
+        conn.autocommit = False
+    print(f"✅ Carga pronta em {time.perf_counter() - inicio:.1f}s")
+
+
+def limpar(args):
+    portal = carregar_portal()
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        inicio = time.perf_counter()
+        sem_triggers(cur)
+        # Com os triggers desligados o CASCADE também não roda: itens antes dos pedidos
+        cur.execute("""
+            DELETE FROM suagrafica_pedido_itens pi USING suagrafica_pedidos p, suagrafica_clientes c
+            WHERE pi.pedido_id = p.id AND p.cliente_id = c.id AND c.codigo_acesso LIKE %s
+        """, (PREFIXO + '%',))
+        itens = cur.rowcount
+        cur.execute("""
+            DELETE FROM suagrafica_idempotencia i USING suagrafica_clientes c
+            WHERE i.escopo = 'cliente:' || c.id AND c.codigo_acesso LIKE %s
+        """, (PREFIXO + '%',))
+        cur.execute("""
+            DELETE FROM suagrafica_pedidos p USING suagrafica_clientes c
+            WHERE p.cliente_id = c.id AND c.codigo_acesso LIKE %s
+        """, (PREFIXO + '%',))
+        pedidos = cur.rowcount
+        cur.execute("RELEASE SAVEPOINT replica")
+        cur.execute("SET LOCAL session_replication_role = DEFAULT")
+        # Clientes e produtos com triggers ligados (FK SET NULL em itens de outros pedidos, versões)
+        cur.execute("DELETE FROM suagrafica_clientes WHERE codigo_acesso LIKE %s", (PREFIXO + '%',))
+        clientes = cur.rowcount
+        cur.execute("DELETE FROM suagrafica_produtos WHERE codigo_produto LIKE %s", (PREFIXO + '%',))
+        produtos = cur.rowcount
+        pos_carga(portal, cur, ('suagrafica_pedidos', 'suagrafica_pedido_itens'))
+        conn.commit()
+    print(f"✅ Removidos {clientes} clientes, {produtos} produtos, {pedidos} pedidos e {itens} itens "
+          f"em {time.perf_counter() - inicio:.1f}s")
+
+
+# ======================================================================
+# CLIENTES HTTP (test client do Flask ou servidor real)
+# ======================================================================
+class ClienteFlask:
+    def __init__(self, portal):
+        self.client = portal.app.test_client()
+
+    def pedir(self, metodo, caminho, corpo=None, headers=None):
+        r = self.client.open(caminho, method=metodo, json=corpo, headers=headers or {})
+        dados = r.get_data()  # consome o corpo inteiro (streaming incluso) antes de fechar
+        r.close()
+        return r.status_code, dados, r.headers
+
+
+class ClienteHttp:
+    """Uma conexão keep-alive por usuário virtual."""
+
+    def __init__(self, url):
+        partes = urlsplit(url)
+        classe = http.client.HTTPSConnection if partes.scheme == "https" else http.client.HTTPConnection
+        self.conexao = lambda: classe(partes.hostname, partes.port, timeout=60)
+        self.conn = self.conexao()
+
+    def pedir(self, metodo, caminho, corpo=None, headers=None):
+        headers = dict(headers or {})
+        dados = None
+        if corpo is not None:
+            dados = json.dumps(corpo).encode()
+            headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(metodo, caminho, body=dados, headers=headers)
+            r = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = self.conexao()
+            raise
+        return r.status, r.read(), r.headers
+
+
+# ======================================================================
+# ENDPOINTS DA MISTURA
+# ======================================================================
+# nome -> (rota no /metrics, método, função(usuário) -> (status, corpo, headers))
+class Usuario:
+    """Estado de um usuário virtual: cliente, token, ETag do catálogo e cursor do admin."""
+
+    def __init__(self, cliente, ctx, rnd):
+        self.cliente = cliente
+        self.ctx = ctx
+        self.rnd = rnd
+        self.auth = {"Authorization": "Bearer " + ctx["portal"].assinar_token_cliente(cliente, 'Ativo')}
+        self.admin = {"Authorization": "Bearer " + ctx["admin_token"]}
+        self.etag_catalogo = None
+        self.cursor_admin = None
+
+
+def catalogo(u):
+    headers = dict(u.auth, **({"If-None-Match": u.etag_catalogo} if u.etag_catalogo else {}))
+    status, corpo, h = u.http.pedir("GET", "/api/cliente/produtos", headers=headers)
+    u.etag_catalogo = h.get("ETag") or u.etag_catalogo
+    return status, corpo, h
+
+
+def busca(u):
+    termo = u.rnd.choice(TERMOS)
+    return u.http.pedir("GET", f"/api/cliente/produtos/search?q={termo}&limit=20", headers=u.auth)
+
+
+def meus_pedidos(u):
+    return u.http.pedir("GET", "/api/cliente/pedidos", headers=u.auth)
+
+
+def criar_pedido(u):
+    itens = [{"produto_id": pid, "quantidade": multiplo * u.rnd.randint(1, 10)}
+             for pid, multiplo in u.rnd.sample(u.ctx["produtos"], u.rnd.randint(1, 5))]
+    return u.http.pedir("POST", "/api/cliente/pedidos", {"itens": itens}, headers=u.auth)
+
+
+def admin_pedidos(u):
+    # Metade das vezes segue para a próxima página (keyset), como quem rola a lista
+    caminho = "/api/admin/pedidos?limit=50"
+    if u.cursor_admin and u.rnd.random() < 0.5:
+        caminho += "&cursor=" + u.cursor_admin
+    status, corpo, h = u.http.pedir("GET", caminho, headers=u.admin)
+    u.cursor_admin = json.loads(corpo).get("proximo_cursor") if status == 200 else None
+    return status, corpo, h
+
+
+def admin_painel(u):
+    return u.http.pedir("GET", "/api/admin/dashboard_stats", headers=u.admin)
+
+
+def chat(u):
+    mensagem = u.rnd.choice(PERGUNTAS).format(termo=u.rnd.choice(TERMOS), n=u.rnd.randint(1, 1_000_000))
+    return u.http.pedir("POST", "/api/chat_vendas", {"message": mensagem, "history": []}, headers=u.auth)
+
+
+ENDPOINTS = {
+    "catalogo": ("/api/cliente/produtos", "GET", catalogo),
+    "busca": ("/api/cliente/produtos/search", "GET", busca),
+    "meus_pedidos": ("/api/cliente/pedidos", "GET", meus_pedidos),
+    "criar_pedido": ("/api/cliente/pedidos", "POST", criar_pedido),
+    "admin_pedidos": ("/api/admin/pedidos", "GET", admin_pedidos),
+    "admin_painel": ("/api/admin/dashboard_stats", "GET", admin_painel),
+    "chat": ("/api/chat_vendas", "POST", chat),
+}
+
+
+# ======================================================================
+# MEDIÇÃO
+# ======================================================================
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class AmostradorMemoria(threading.Thread):
+    """Soma o RSS dos workers a cada `intervalo` segundos e guarda o pico."""
+
+    def __init__(self, pids, intervalo=0.2):
+        super().__init__(daemon=True)
+        self.pids, self.intervalo = pids, intervalo
+        self.parar = threading.Event()
+        self.inicio = self.pico = self.medir()
+
+    def medir(self):
+        valores = [rss_bytes(pid) for pid in self.pids]
+        return sum(v for v in valores if v) if any(valores) else None
+
+    def run(self):
+        while not self.parar.wait(self.intervalo):
+            atual = self.medir()
+            if atual is not None:
+                self.pico = max(self.pico or 0, atual)
+
+    def resultado(self):
+        self.parar.set()
+        self.join()
+        fim = self.medir()
+        if self.inicio is None: return None
+        mb = lambda b: round(b / 1024 / 1024, 1)
+        return {"inicio_mb": mb(self.inicio), "fim_mb": mb(fim), "pico_mb": mb(max(self.pico, fim)),
+                "crescimento_mb": mb(max(self.pico, fim) - self.inicio)}
+
+
+ROTULOS = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+SERIES = ("suagrafica_http_requisicoes_total", "suagrafica_http_consultas_total",
+          "suagrafica_http_linhas_total", "suagrafica_http_db_segundos_sum")
+
+
+def contadores_http(ctx):
+    """{(serie, rota, metodo): valor} das métricas por rota (somando os status)."""
+    if ctx["url"]:
+        status, corpo, _ = ctx["cliente_http"]().pedir("GET", "/metrics", headers={
+            "Authorization": "Bearer " + (os.environ.get("METRICS_TOKEN") or ctx["admin_token"])})
+        texto = corpo.decode() if status == 200 else ""
+    else:
+        texto = ctx["portal"].metricas.renderizar()
+    valores = {}
+    for linha in texto.splitlines():
+        nome, _, resto = linha.partition("{")
+        if nome not in SERIES: continue
+        rotulos, _, valor = resto.rpartition("} ")
+        r = dict(ROTULOS.findall(rotulos))
+        chave = (nome, r.get("rota"), r.get("metodo"))
+        valores[chave] = valores.get(chave, 0) + float(valor)
+    return valores
+
+
+def percentis(latencias):
+    if not latencias: return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    if len(latencias) == 1: return {f"p{q}_ms": round(latencias[0], 1) for q in (50, 95, 99)}
+    q = statistics.quantiles(latencias, n=100, method="inclusive")
+    return {"p50_ms": round(q[49], 1), "p95_ms": round(q[94], 1), "p99_ms": round(q[98], 1)}
+
+
+def executar_fase(ctx, pesos, segundos, usuarios):
+    """Roda a mistura `pesos` com `usuarios` threads por `segundos`; devolve as medidas por endpoint."""
+    nomes, cumulativos = list(pesos), []
+    total = 0
+    for nome in nomes:
+        total += pesos[nome]
+        cumulativos.append(total)
+    lat = {nome: [] for nome in nomes}
+    erros = {nome: {} for nome in nomes}
+    lock = threading.Lock()
+    antes = contadores_http(ctx)
+    memoria = AmostradorMemoria(ctx["pids"])
+    memoria.start()
+    fim = time.monotonic() + segundos
+
+    def trabalhador(i):
+        rnd = random.Random(ctx["semente"] * 1000 + i)
+        u = Usuario(rnd.choice(ctx["clientes"]), ctx, rnd)
+        u.http = ctx["cliente_http"]()
+        while time.monotonic() < fim:
+            sorteio = rnd.random() * total
+            nome = nomes[next(k for k, c in enumerate(cumulativos) if sorteio < c)]
+            inicio = time.perf_counter()
+            try:
+                status = ENDPOINTS[nome][2](u)[0]
+            except Exception as e:
+                status = type(e).__name__
+            ms = (time.perf_counter() - inicio) * 1000
+            with lock:
+                if isinstance(status, int) and status < 400:
+                    lat[nome].append(ms)
+                else:
+                    erros[nome][str(status)] = erros[nome].get(str(status), 0) + 1
+
+    inicio = time.perf_counter()
+    ts = [threading.Thread(target=trabalhador, args=(i,)) for i in range(usuarios)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    duracao = time.perf_counter() - inicio
+    mem = memoria.resultado()
+    depois = contadores_http(ctx)
+
+    resultado = {}
+    for nome in nomes:
+        rota, metodo, _ = ENDPOINTS[nome]
+        delta = {serie: depois.get((serie, rota, metodo), 0) - antes.get((serie, rota, metodo), 0) for serie in SERIES}
+        reqs = delta["suagrafica_http_requisicoes_total"]
+        resultado[nome] = {
+            "requisicoes": len(lat[nome]), "erros": erros[nome],
+            "rps": round(len(lat[nome]) / duracao, 1),
+            **percentis(lat[nome]),
+            "media_ms": round(statistics.mean(lat[nome]), 1) if lat[nome] else None,
+            "consultas_por_req": round(delta["suagrafica_http_consultas_total"] / reqs, 2) if reqs else None,
+            "linhas_por_req": round(delta["suagrafica_http_linhas_total"] / reqs, 1) if reqs else None,
+            "db_ms_por_req": round(delta["suagrafica_http_db_segundos_sum"] * 1000 / reqs, 2) if reqs else None,
+        }
+    total_ok = sum(len(v) for v in lat.values())
+    return {"segundos": round(duracao, 1), "rps": round(total_ok / duracao, 1),
+            "erros": sum(sum(e.values()) for e in erros.values()), "memoria": mem, "endpoints": resultado}
+
+
+def rodar(args):
+    portal = carregar_portal(args.gemini_ms)
+    pesos = {}
+    for parte in args.mistura.split(","):
+        nome, _, peso = parte.partition("=")
+        if nome.strip() not in ENDPOINTS:
+            sys.exit(f"🔴 Endpoint desconhecido na mistura: {nome} (opções: {', '.join(ENDPOINTS)})")
+        if float(peso) > 0: pesos[nome.strip()] = float(peso)
+
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM suagrafica_clientes WHERE codigo_acesso LIKE %s AND status_acesso = 'Ativo'",
+                    (PREFIXO + '%',))
+        clientes = [r[0] for r in cur.fetchall()]
+        cur.execute("""
+            SELECT id, coalesce(multiplos_de, 1) FROM suagrafica_produtos
+            WHERE codigo_produto LIKE %s AND esta_ativo AND estoque_disponivel
+        """, (PREFIXO + '%',))
+        produtos = cur.fetchall()
+    if not clientes or len(produtos) < 5:
+        sys.exit("🔴 Sem dados de carga: rode 'semear' antes.")
+
+    ctx = {"portal": portal, "clientes": clientes, "produtos": produtos, "admin_token": args.admin_token,
+           "semente": args.semente, "url": args.url,
+           "pids": args.pids if args.url else [os.getpid()],
+           "cliente_http": (lambda: ClienteHttp(args.url)) if args.url else (lambda: ClienteFlask(portal))}
+    resultado = {
+        "parametros": {k: v for k, v in vars(args).items() if k != "func"},
+        "ambiente": {"orjson": portal.orjson is not None, "db_pool_max": portal.DB_POOL_MAX,
+                     "chat_max_concorrentes": portal.CHAT_MAX_CONCORRENTES,
+                     "clientes": len(clientes), "produtos": len(produtos)},
+        "isolado": {},
+    }
+
+    if args.isolado > 0:
+        print(f"ℹ️  Endpoints isolados ({args.isolado}s cada, {args.usuarios} usuários):")
+        for nome in pesos:
+            fase = executar_fase(ctx, {nome: 1}, args.isolado, args.usuarios)
+            m, mem = fase["endpoints"][nome], fase["memoria"]
+            resultado["isolado"][nome] = dict(m, memoria=mem)
+            print(f"   {nome:<14} {m['rps']:>8} req/s  p95={m['p95_ms']}ms  "
+                  f"RSS +{mem['crescimento_mb'] if mem else '?'}MB")
+
+    gemini = "o do servidor" if args.url else f"stub de {args.gemini_ms}ms"
+    print(f"\nℹ️  Mistura {args.mistura}: {args.usuarios} usuários por {args.segundos}s, Gemini {gemini}")
+    resultado["mistura"] = executar_fase(ctx, pesos, args.segundos, args.usuarios)
+    m = resultado["mistura"]
+    print(f"\n{'endpoint':<14} {'req':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'consultas':>9} "
+          f"{'db ms':>7}  erros")
+    for nome, e in m["endpoints"].items():
+        print(f"{nome:<14} {e['requisicoes']:>7} {e['rps']:>8} {e['p50_ms'] or '-':>8} {e['p95_ms'] or '-':>8} "
+              f"{e['p99_ms'] or '-':>8} {e['consultas_por_req'] if e['consultas_por_req'] is not None else '-':>9} "
+              f"{e['db_ms_por_req'] if e['db_ms_por_req'] is not None else '-':>7}  {e['erros'] or ''}")
+    print(f"\nTotal: {m['rps']} req/s, {m['erros']} erros; memória {m['memoria']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultado gravado em {args.json}")
+
+
+def comparar(args):
+    with open(args.base) as f:
+        base = json.load(f)["mistura"]["endpoints"]
+    with open(args.novo) as f:
+        novo = json.load(f)["mistura"]["endpoints"]
+    piorou = []
+    print(f"{'endpoint':<14} {'p95 base':>9} {'p95 novo':>9} {'Δ%':>7}   {'req/s base':>10} {'req/s novo':>10} {'Δ%':>7}")
+    for nome in sorted(set(base) & set(novo)):
+        b, n = base[nome], novo[nome]
+        if not b["p95_ms"] or not n["p95_ms"] or not b["rps"]: continue
+        dp95 = (n["p95_ms"] - b["p95_ms"]) / b["p95_ms"] * 100
+        drps = (n["rps"] - b["rps"]) / b["rps"] * 100
+        marca = ""
+        if dp95 > args.tolerancia or drps < -args.tolerancia:
+            piorou.append(nome)
+            marca = "  ⚠️"
+        print(f"{nome:<14} {b['p95_ms']:>9} {n['p95_ms']:>9} {dp95:>+7.1f}   {b['rps']:>10} {n['rps']:>10} {drps:>+7.1f}{marca}")
+    if piorou:
+        print(f"\n🔴 Pioraram além de {args.tolerancia}%: {', '.join(piorou)}")
+        sys.exit(1)
+    print(f"\n✅ Nenhum endpoint piorou além de {args.tolerancia}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("semear", help="popula o banco com dados sintéticos")
+    p.add_argument("--clientes", type=int, default=5000)
+    p.add_argument("--produtos", type=int, default=100_000)
+    p.add_argument("--pedidos", type=int, default=1_000_000)
+    p.add_argument("--itens-por-pedido", type=int, default=3, help="média de itens por pedido")
+    p.add_argument("--lote", type=int, default=100_000, help="pedidos por transação")
+    p.add_argument("--semente", type=float, default=0.42, help="setseed() do Postgres (-1 a 1)")
+    p.set_defaults(func=semear)
+
+    p = sub.add_parser("limpar", help="remove os dados com o prefixo CARGA-")
+    p.set_defaults(func=limpar)
+
+    p = sub.add_parser("rodar", help="dispara a mistura de requisições")
+    p.add_argument("--segundos", type=float, default=30)
+    p.add_argument("--usuarios", type=int, default=16, help="threads (usuários virtuais)")
+    p.add_argument("--mistura", default=MISTURA_PADRAO, help="pesos por endpoint, ex.: catalogo=50,chat=10")
+    p.add_argument("--isolado", type=float, default=5, help="segundos de cada endpoint sozinho (0 = pular)")
+    p.add_argument("--gemini-ms", type=float, default=200, help="latência fixa do ModeloStub")
+    p.add_argument("--url", help="servidor já no ar (ex.: http://127.0.0.1:8000); sem ele, roda no processo")
+    p.add_argument("--pids", type=int, nargs="*", default=[], help="pids dos workers (memória no modo --url)")
+    p.add_argument("--admin-token", default="FORCED_TESTE_TOKEN")
+    p.add_argument("--semente", type=int, default=42)
+    p.add_argument("--json", help="grava o resultado neste arquivo")
+    p.set_defaults(func=rodar)
+
+    p = sub.add_parser("comparar", help="compara dois resultados de 'rodar'")
+    p.add_argument("base")
+    p.add_argument("novo")
+    p.add_argument("--tolerancia", type=float, default=10, help="piora máxima aceita, em %%")
+    p.set_defaults(func=comparar)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Replay de conversas longas do EloBot contra o ModeloStub: tamanho do prompt e latência por turno.
+
+Para cada conversa, cada mensagem do cliente é reenviada a /api/chat_vendas
+com o histórico anterior (como o portal faz). Compara:
+
+  bruto:   histórico inteiro, como era antes (sem limpeza nem resumo);
+  gerido:  compactar_historico() (orçamento de tokens, resumo, sem dumps).
+
+O stub mede o prompt (system instruction + contents, em tokens estimados) e
+simula a latência do modelo como base + custo por token de entrada. As
+ferramentas respondem com dumps fixos (o banco não é usado) e os caches do
+chat ficam desligados.
+
+Conversas gravadas podem vir de um JSONL (--arquivo), uma por linha:
+    {"mensagens": [{"role": "user"|"bot", "content": "..."}, ...]}
+Sem arquivo, gera conversas sintéticas com dumps de ferramenta no meio.
+
+Uso:
+    GEMINI_STUB=1 python bench/chat_historico.py --turnos 40
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault("GEMINI_STUB", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as portal  # noqa: E402
+
+DUMP_PRODUTOS = json.dumps([{"nome_produto": f"Caneta Metal {i}", "preco_minimo": 2.5 + i, "multiplos_de": 50,
+                             "descricao": "Caneta de metal com gravação a laser, ideal para eventos corporativos."}
+                            for i in range(5)], ensure_ascii=False)
+DUMP_PEDIDO = json.dumps({"id": 123, "valor_total": 1520.0, "status_pedido": "Aguardando Pagamento",
+                          "link_pagamento": None}, ensure_ascii=False)
+PERGUNTAS = ["Quero ver canetas de metal para um evento", "Tem caderno com capa dura?",
+             "Qual o status do pedido {n}?", "Pode gerar o link de pagamento do pedido {n}?",
+             "E se eu pedir 500 unidades, fica mais barato?", "Vocês fazem gravação a laser na caneca?",
+             "Preciso de ecobags para uma feira em março", "Quais mochilas vocês têm?"]
+
+
+class ModeloMedido(portal.ModeloStub):
+    """Stub que registra o tamanho de cada prompt e demora proporcionalmente a ele."""
+
+    def __init__(self, base_ms, ms_por_token):
+        super().__init__(latencia=0)
+        self.base_ms = base_ms
+        self.ms_por_token = ms_por_token
+        self.prompts = []
+
+    def generate_content(self, contents, generation_config=None, request_options=None, stream=False, **kwargs):
+        tokens = portal.estimar_tokens(portal.SYSTEM_PROMPT) + sum(
+            portal.estimar_tokens(p) for c in contents for p in c['parts'])
+        self.prompts.append(tokens)
+        time.sleep((self.base_ms + tokens * self.ms_por_token) / 1000)
+        return super().generate_content(contents, generation_config, request_options, stream, **kwargs)
+
+
+def conversa_sintetica(turnos, semente):
+    rnd = random.Random(semente)
+    mensagens = [{"role": "bot", "content": "Olá, **Cliente**! Eu sou o ELO Bot. Como posso te ajudar hoje?"}]
+    for _ in range(turnos):
+        mensagens.append({"role": "user", "content": rnd.choice(PERGUNTAS).format(n=rnd.randint(100, 999))})
+        # Respostas longas de vendas, às vezes com os dados crus da ferramenta colados (fallback do chat)
+        resposta = "Excelente escolha! " + "Temos opções premium e promocionais, com desconto por volume. " * rnd.randint(1, 4)
+        if rnd.random() < 0.4:
+            resposta += "\n\n" + rnd.choice([DUMP_PRODUTOS, DUMP_PEDIDO])
+        mensagens.append({"role": "bot", "content": resposta})
+    return mensagens
+
+
+def replay(mensagens, modelo):
+    client = portal.app.test_client()
+    por_turno, historico = [], []
+    for m in mensagens:
+        if m["role"] == "user":
+            modelo.prompts.clear()
+            inicio = time.perf_counter()
+            r = client.post('/api/chat_vendas', json={"message": m["content"], "history": historico, "client_id": 1})
+            por_turno.append({"prompt_tokens": modelo.prompts[0] if modelo.prompts else 0,
+                              "latencia_ms": round((time.perf_counter() - inicio) * 1000, 1),
+                              "status": r.status_code})
+        historico.append(m)
+    return por_turno
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--arquivo", help="JSONL com conversas gravadas")
+    parser.add_argument("--conversas", type=int, default=3)
+    parser.add_argument("--turnos", type=int, default=40)
+    parser.add_argument("--base-ms", type=float, default=5, help="latência fixa simulada por chamada")
+    parser.add_argument("--ms-por-token", type=float, default=0.02, help="latência simulada por token de entrada")
+    parser.add_argument("--json", help="grava o resultado neste arquivo")
+    args = parser.parse_args()
+
+    if args.arquivo:
+        with open(args.arquivo) as f:
+            conversas = [json.loads(linha)["mensagens"] for linha in f if linha.strip()]
+    else:
+        conversas = [conversa_sintetica(args.turnos, semente) for semente in range(args.conversas)]
+
+    modelo = ModeloMedido(args.base_ms, args.ms_por_token)
+    portal.modelo_chat = lambda: modelo
+    portal.cache_intencao.get = lambda chave: None
+    portal.executar_ferramenta = lambda action, client_id: (
+        DUMP_PRODUTOS if action['type'] == 'search_product' else DUMP_PEDIDO if action['type'] != 'none' else None)
+    compactar = portal.compactar_historico
+    modos = {
+        "bruto": lambda history: ([h for h in history if h.get('content')], None),
+        "gerido": compactar,
+    }
+
+    resultado = {"conversas": len(conversas), "modos": {}}
+    for nome, func in modos.items():
+        portal.compactar_historico = func
+        turnos = [t for c in conversas for t in replay(c, modelo)]
+        tokens = [t["prompt_tokens"] for t in turnos]
+        latencias = [t["latencia_ms"] for t in turnos]
+        resultado["modos"][nome] = {
+            "turnos": len(turnos),
+            "prompt_tokens_medio": round(statistics.mean(tokens)),
+            "prompt_tokens_max": max(tokens),
+            "prompt_tokens_total": sum(tokens),
+            "latencia_p50_ms": statistics.median(latencias),
+            "latencia_max_ms": max(latencias),
+            "por_turno": turnos,
+        }
+    portal.compactar_historico = compactar
+
+    bruto, gerido = resultado["modos"]["bruto"]["por_turno"], resultado["modos"]["gerido"]["por_turno"]
+    print(f"{'turno':>5}   {'bruto tok':>9} {'ms':>7}   {'gerido tok':>10} {'ms':>7}")
+    passo = max(1, len(bruto) // 20)
+    for i in range(0, len(bruto), passo):
+        print(f"{i + 1:>5}   {bruto[i]['prompt_tokens']:>9} {bruto[i]['latencia_ms']:>7}   "
+              f"{gerido[i]['prompt_tokens']:>10} {gerido[i]['latencia_ms']:>7}")
+    print()
+    for nome, m in resultado["modos"].items():
+        print(f"{nome:<7} tokens médio={m['prompt_tokens_medio']} máx={m['prompt_tokens_max']} "
+              f"total={m['prompt_tokens_total']}  latência p50={m['latencia_p50_ms']}ms máx={m['latencia_max_ms']}ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultado gravado em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Carga na criação de pedidos: pedidos/s no caminho antigo x o novo (preço no servidor, CTE, lote).
+
+Usa um cliente ativo e produtos disponíveis do banco apontado por
+DATABASE_URL e dispara pedidos de --itens itens, em --threads threads, pelo
+test client do Flask (sem rede). Compara:
+
+  antigo:    o POST de antes (preço vindo do corpo, INSERT do cabeçalho e
+             execute_values dos itens: 2 comandos por pedido), registrado
+             numa rota só do benchmark para passar pela mesma pilha do Flask;
+  novo:      POST /api/cliente/pedidos com um pedido, sem Idempotency-Key
+             (1 consulta de preços, 1 INSERT com CTE);
+  novo+chave: o mesmo com Idempotency-Key (reserva e gravação da resposta);
+  lote:   POST /api/cliente/pedidos com --lote pedidos por requisição.
+
+Os pedidos criados são apagados no final (use --manter para deixá-los).
+
+Uso:
+    DATABASE_URL=postgresql://... python bench/pedidos.py --pedidos 2000 --threads 8 --lote 50
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psycopg2.extras  # noqa: E402
+import app as portal  # noqa: E402
+
+
+def caminho_antigo(cliente_id, itens):
+    """Cópia do POST anterior (o preço vem do corpo), para comparação."""
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        valor_total = sum(float(i['preco_unitario_registrado']) * i['quantidade'] for i in itens)
+        cur.execute("""
+            INSERT INTO suagrafica_pedidos (cliente_id, valor_total, status_pedido)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (cliente_id, valor_total, 'Aguardando Aprovação'))
+        pedido_id = cur.fetchone()[0]
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO suagrafica_pedido_itens (pedido_id, produto_id, quantidade, preco_unitario_registrado)
+            VALUES %s
+        """, [(pedido_id, i['produto_id'], i['quantidade'], i['preco_unitario_registrado']) for i in itens],
+            template="(%s, %s, %s, %s)", page_size=100)
+        conn.commit()
+        return [pedido_id]
+
+
+def rota_antiga():
+    cliente = portal.check_client_auth(portal.request)
+    if not cliente: return portal.jsonify({"erro": "Não autorizado"}), 403
+    data = portal.request.json or {}
+    return portal.jsonify({"pedido_id": caminho_antigo(cliente['cliente_id'], data['itens'])[0]}), 201
+
+
+portal.app.add_url_rule('/bench/pedido_antigo', 'bench_pedido_antigo', rota_antiga, methods=['POST'])
+
+
+def rodar(nome, total, threads, enviar):
+    """Chama enviar() até criar `total` pedidos, repartidos entre as threads."""
+    criados, erros, lock = [], [0], threading.Lock()
+    por_thread = [total // threads + (1 if i < total % threads else 0) for i in range(threads)]
+
+    def trabalhador(n):
+        while n > 0:
+            try:
+                ids = enviar(min(n, enviar.por_chamada))
+            except Exception:
+                ids = None
+            with lock:
+                if ids: criados.extend(ids)
+                else: erros[0] += 1
+            n -= enviar.por_chamada
+
+    inicio = time.perf_counter()
+    ts = [threading.Thread(target=trabalhador, args=(n,)) for n in por_thread]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    duracao = time.perf_counter() - inicio
+    return {"modo": nome, "pedidos": len(criados), "erros": erros[0], "segundos": round(duracao, 2),
+            "pedidos_por_s": round(len(criados) / duracao, 1)}, criados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pedidos", type=int, default=2000)
+    parser.add_argument("--itens", type=int, default=5, help="itens por pedido")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--lote", type=int, default=50, help="pedidos por requisição no modo lote")
+    parser.add_argument("--manter", action="store_true", help="não apaga os pedidos criados")
+    parser.add_argument("--json", help="grava o resultado neste arquivo")
+    args = parser.parse_args()
+
+    with portal.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM suagrafica_clientes WHERE status_acesso = 'Ativo' ORDER BY id LIMIT 1")
+        cliente_id = cur.fetchone()[0]
+        cur.execute("""
+            SELECT id, preco_minimo, COALESCE(multiplos_de, 1) FROM suagrafica_produtos
+            WHERE esta_ativo AND estoque_disponivel ORDER BY id LIMIT %s
+        """, (args.itens,))
+        itens = [{"produto_id": id, "quantidade": max(multiplo, 1) * 2, "preco_unitario_registrado": preco}
+                 for id, preco, multiplo in cur.fetchall()]
+    headers = {"Authorization": "Bearer " + portal.assinar_token_cliente(cliente_id, 'Ativo')}
+    client = portal.app.test_client()
+
+    def antigo(n):
+        r = client.post('/bench/pedido_antigo', json={"itens": itens}, headers=headers)
+        return [r.json["pedido_id"]] if r.status_code == 201 else None
+    antigo.por_chamada = 1
+
+    def novo(n):
+        r = client.post('/api/cliente/pedidos', json={"itens": itens}, headers=headers)
+        return [r.json["pedido_id"]] if r.status_code == 201 else None
+    novo.por_chamada = 1
+
+    def novo_chave(n):
+        r = client.post('/api/cliente/pedidos', json={"itens": itens},
+                        headers=dict(headers, **{"Idempotency-Key": f"bench-{uuid.uuid4()}"}))
+        return [r.json["pedido_id"]] if r.status_code == 201 else None
+    novo_chave.por_chamada = 1
+
+    def lote(n):
+        r = client.post('/api/cliente/pedidos', json={"pedidos": [{"itens": itens}] * n},
+                        headers=dict(headers, **{"Idempotency-Key": f"bench-{uuid.uuid4()}"}))
+        return [p["pedido_id"] for p in r.json["pedidos"]] if r.status_code == 201 else None
+    lote.por_chamada = args.lote
+
+    print(f"ℹ️  {args.pedidos} pedidos de {len(itens)} itens, {args.threads} threads, lote de {args.lote}\n")
+    resultado, todos = {"parametros": vars(args), "modos": []}, []
+    for nome, enviar in (("antigo", antigo), ("novo", novo), ("novo+chave", novo_chave), ("lote", lote)):
+        medida, criados = rodar(nome, args.pedidos, args.threads, enviar)
+        resultado["modos"].append(medida)
+        todos.extend(criados)
+        print(f"{nome:<10} {medida['pedidos']:>6} pedidos em {medida['segundos']:>6}s  "
+              f"{medida['pedidos_por_s']:>8} pedidos/s  erros={medida['erros']}")
+
+    if not args.manter:
+        with portal.db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM suagrafica_pedidos WHERE id = ANY(%s)", (todos,))
+            cur.execute("DELETE FROM suagrafica_idempotencia WHERE escopo = %s AND chave LIKE %s",
+                        (f"cliente:{cliente_id}", "bench-%"))
+            conn.commit()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultado gravado em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
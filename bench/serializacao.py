@@ -0,0 +1,125 @@
+"""
+Benchmark da serialização das listagens: caminho antigo x json_bytes()/linhas_json().
+
+Gera listas sintéticas de produtos e de pedidos direto no Postgres
+(generate_series, nenhuma tabela é tocada) com 10 mil e 100 mil linhas e
+compara, para cada uma:
+
+  antigo: RealDictCursor com Decimal, laço "float()" por linha e jsonify()
+          com o provider padrão do Flask (json da stdlib);
+  novo:   cursor de tuplas com NUMERIC -> float (NUMERIC_FLOAT) e
+          linhas_json() gerando os bytes em lotes, como em resposta_json_stream().
+
+Mostra CPU (time.process_time, mediana das repetições) e pico de memória
+Python (tracemalloc, rodada separada). O buffer do libpq fica fora do
+tracemalloc e é o mesmo nos dois caminhos.
+
+Uso:
+    DATABASE_URL=postgresql://... python bench/serializacao.py --linhas 10000 100000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psycopg2  # noqa: E402
+import psycopg2.extras  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+import app as portal  # noqa: E402
+
+CONSULTAS = {
+    "produtos": ("""
+        SELECT g AS id, 'PROD-' || g AS codigo_produto, 'Caneta Metal Premium ' || g AS nome_produto,
+               'Brinde promocional em metal, ideal para eventos corporativos. Lote ' || g AS descricao,
+               round((1 + random() * 200)::numeric, 2) AS preco_minimo, (ARRAY[1, 10, 50, 100])[1 + g %% 4] AS multiplos_de,
+               TRUE AS estoque_disponivel, NULL::text AS imagem_url, TRUE AS esta_ativo
+        FROM generate_series(1, %s) g
+    """, ["preco_minimo"]),
+    "pedidos": ("""
+        SELECT g AS id, 'Cliente ' || (g %% 500) AS nome_cliente, g %% 500 AS cliente_id,
+               round((10 + random() * 5000)::numeric, 2) AS valor_total,
+               (ARRAY['Aguardando Aprovação', 'Aguardando Pagamento', 'Em Produção', 'Concluído'])[1 + g %% 4] AS status_pedido,
+               now() - g * interval '1 minute' AS data_criacao
+        FROM generate_series(1, %s) g
+    """, ["valor_total"]),
+}
+
+
+def caminho_antigo(conn, sql, linhas, campos_decimal):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(sql, (linhas,))
+    registros = cur.fetchall()
+    for r in registros:
+        for campo in campos_decimal:
+            r[campo] = float(r[campo])
+    with portal.app.app_context():
+        corpo = DefaultJSONProvider(portal.app).response(registros).get_data()
+    cur.close()
+    return len(corpo)
+
+
+def caminho_novo(conn, sql, linhas, campos_decimal):
+    cur = conn.cursor()
+    cur.execute(sql, (linhas,))
+    # Como no streaming: cada pedaço vai para o socket e é descartado
+    tamanho = sum(len(pedaco) for pedaco in portal.linhas_json(cur))
+    cur.close()
+    return tamanho
+
+
+def medir(func, conn, sql, linhas, campos, repeticoes):
+    cpu, total = [], []
+    for _ in range(repeticoes):
+        inicio_cpu, inicio = time.process_time(), time.perf_counter()
+        func(conn, sql, linhas, campos)
+        cpu.append((time.process_time() - inicio_cpu) * 1000)
+        total.append((time.perf_counter() - inicio) * 1000)
+    tracemalloc.start()
+    tamanho = func(conn, sql, linhas, campos)
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "cpu_ms": round(statistics.median(cpu), 1),
+        "total_ms": round(statistics.median(total), 1),
+        "pico_mb": round(pico / 1024 / 1024, 2),
+        "bytes": tamanho,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--linhas", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--json", help="grava o resultado neste arquivo")
+    args = parser.parse_args()
+
+    antigo = psycopg2.connect(portal.DATABASE_URL)  # sem o typecaster: NUMERIC vira Decimal
+    novo = psycopg2.connect(portal.DATABASE_URL)
+    psycopg2.extensions.register_type(portal.NUMERIC_FLOAT, novo)
+    resultado = {"orjson": portal.orjson is not None, "casos": {}}
+    print(f"ℹ️  Encoder: {'orjson' if portal.orjson is not None else 'json (stdlib)'}")
+    print(f"\n{'lista':<10} {'linhas':>8}   {'antigo cpu':>10} {'pico MB':>8}   {'novo cpu':>10} {'pico MB':>8}   {'cpu':>6} {'mem':>6}")
+    try:
+        for nome, (sql, campos) in CONSULTAS.items():
+            for linhas in args.linhas:
+                a = medir(caminho_antigo, antigo, sql, linhas, campos, args.repeticoes)
+                n = medir(caminho_novo, novo, sql, linhas, campos, args.repeticoes)
+                resultado["casos"][f"{nome}-{linhas}"] = {"antigo": a, "novo": n}
+                print(f"{nome:<10} {linhas:>8}   {a['cpu_ms']:>10} {a['pico_mb']:>8}   {n['cpu_ms']:>10} {n['pico_mb']:>8}"
+                      f"   {a['cpu_ms'] / max(n['cpu_ms'], 0.1):>5.1f}x {a['pico_mb'] / max(n['pico_mb'], 0.01):>5.1f}x")
+    finally:
+        antigo.close()
+        novo.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultado gravado em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
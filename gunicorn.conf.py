@@ -0,0 +1,152 @@
+"""
+Perfil de produção do gunicorn:  gunicorn -c gunicorn.conf.py app:app
+
+- preload_app: o master importa o app uma vez e os workers herdam o código
+  por copy-on-write (a importação não abre conexão nem thread; ver a seção 6
+  do app.py). Antes de cada fork o master fecha o que tiver aberto; depois do
+  fork o worker descarta pool e listener herdados e cria os seus.
+- Worker: gthread por padrão. Chat (espera o Gemini) e SSE (conexão longa)
+  seguram uma thread cada, então a concorrência vem de GUNICORN_THREADS e
+  não do número de processos. O pool do chat não devolve a thread enquanto
+  o Gemini responde, só limita quantas o chat ocupa: até
+  CHAT_MAX_CONCORRENTES + CHAT_FILA_MAXIMA por worker (o resto leva 429).
+  Cada stream SSE também segura uma thread enquanto está aberto. No gthread
+  o limite de streams por worker (EVENTOS_MAX_ASSINANTES, se não vier
+  definido) sai do que sobra: GUNICORN_THREADS - chat - GUNICORN_RESERVA_CRUD,
+  e o stream a mais leva 503 com Retry-After. No padrão, 32 - (4 + 4) - 8 =
+  16 streams por worker, e catálogo, login e pedidos sempre têm 8 threads. Com gevent + psycogreen instalados, `auto`
+  usa gevent (milhares de conexões por worker, psycopg2 cooperativo).
+- Aquecimento: cada worker conecta pool e LISTEN, carrega o catálogo e o
+  handle do modelo antes do primeiro accept() (AQUECER_WORKER=0 desliga).
+- Reload sem perder requisição: `kill -HUP <master>` sobe workers novos e
+  encerra os antigos com SIGTERM; eles param de aceitar, terminam o que está
+  em andamento e fecham os streams SSE na hora (o front reconecta). Com
+  preload o HUP não relê o código: para deploy no mesmo host use
+  `kill -USR2 <master>` (novo master com o código novo) e depois
+  `kill -TERM <master antigo>`.
+
+Variáveis: PORT, WEB_CONCURRENCY, GUNICORN_WORKER_CLASS (auto|gthread|gevent|sync),
+GUNICORN_THREADS, GUNICORN_PRELOAD, GUNICORN_TIMEOUT, GUNICORN_GRACEFUL_TIMEOUT,
+GUNICORN_MAX_REQUESTS, GUNICORN_RESERVA_CRUD, AQUECER_WORKER.
+"""
+import importlib.util
+import multiprocessing
+import os
+import signal
+import sys
+
+
+def _escolher_worker(pedido):
+    if pedido != "auto":
+        return pedido
+    # gevent sem psycogreen bloquearia o hub inteiro em cada consulta
+    if importlib.util.find_spec("gevent") and importlib.util.find_spec("psycogreen"):
+        return "gevent"
+    return "gthread"
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = _escolher_worker(os.environ.get("GUNICORN_WORKER_CLASS", "auto"))
+# Um processo por CPU: a espera (banco, Gemini, SSE) fica nas threads/greenlets.
+# Cada worker abre até DB_POOL_MAX conexões + 1 do LISTEN.
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, multiprocessing.cpu_count())))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))  # gevent
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+# gthread/gevent: o heartbeat do worker não depende da requisição, então SSE
+# e chat longos não disparam o timeout; ele só pega worker travado.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5  # atrás do proxy do Render
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# Orçamento de threads por worker: chat e SSE seguram uma thread cada pela
+# duração inteira; o que sobra fica reservado para as rotas curtas (CRUD).
+_chat_threads = (int(os.environ.get("CHAT_MAX_CONCORRENTES", 4))
+                + int(os.environ.get("CHAT_FILA_MAXIMA", 4)))
+_reserva_crud = int(os.environ.get("GUNICORN_RESERVA_CRUD", 8))
+_sse_threads = threads - _chat_threads - _reserva_crud
+if worker_class == "gthread" and "EVENTOS_MAX_ASSINANTES" not in os.environ:
+    # Lido pelo app na importação (no master com preload, no worker sem ele)
+    os.environ["EVENTOS_MAX_ASSINANTES"] = str(max(_sse_threads, 0))
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG")  # ex.: "-"; a métrica por rota já está no /metrics
+errorlog = "-"
+
+if worker_class == "gevent":
+    # Antes do preload do app: locks, sockets e threads criados na importação já nascem cooperativos
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    try:
+        import grpc.experimental.gevent as grpc_gevent  # cliente do Gemini
+        grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+
+
+def _portal():
+    """O módulo do app, se já carregado (com preload o master o tem; sem preload, só o worker)."""
+    return sys.modules.get("app")
+
+
+def when_ready(server):
+    server.log.info(f"Portal: {workers} worker(s) {worker_class}"
+                    f"{f' x {threads} threads' if worker_class == 'gthread' else ''}, preload={preload_app}")
+    if worker_class != "gthread":
+        return
+    sse = int(os.environ["EVENTOS_MAX_ASSINANTES"])
+    server.log.info(f"Portal: por worker, até {_chat_threads} threads de chat e {sse} streams SSE "
+                    f"de {threads} threads")
+    if _chat_threads + sse + _reserva_crud > threads or sse == 0:
+        server.log.warning(f"Portal: chat ({_chat_threads}) + SSE ({sse}) + reserva do CRUD ({_reserva_crud}) "
+                           f"contra {threads} threads por worker: sobe GUNICORN_THREADS ou reduz "
+                           f"CHAT_MAX_CONCORRENTES/CHAT_FILA_MAXIMA/EVENTOS_MAX_ASSINANTES")
+
+
+def pre_fork(server, worker):
+    portal = _portal()
+    if portal is not None:
+        portal.antes_do_fork()
+
+
+def post_fork(server, worker):
+    portal = _portal()
+    if portal is not None:
+        portal.apos_fork()
+
+
+def post_worker_init(worker):
+    # Roda no worker depois de carregar o app e antes do loop de accept()
+    import app as portal
+    sair = worker.handle_exit
+
+    def handle_exit(sig, frame):
+        portal.encerrar_worker()
+        sair(sig, frame)
+        # gthread: na saída graciosa o loop só fecha keep-alive vencido quando o
+        # select acorda; sem tráfego, uma conexão ociosa do proxy segura o worker
+        # pelo graceful_timeout inteiro. A fila de métodos acorda o loop (put é
+        # seguro dentro do handler de sinal) e fecha as ociosas no thread principal.
+        if hasattr(worker, "method_queue") and hasattr(worker, "keepalived_conns"):
+            worker.method_queue.defer(_fechar_ociosas, worker)
+
+    signal.signal(signal.SIGTERM, handle_exit)
+    if portal.AQUECER_WORKER:
+        portal.aquecer_worker()
+
+
+def _fechar_ociosas(worker):
+    """Fecha as conexões keep-alive paradas do worker gthread (o proxy reabre em outro)."""
+    for conn in worker.keepalived_conns:
+        conn.timeout = 0
+    worker.murder_keepalived()
+
+
+def worker_exit(server, worker):
+    portal = _portal()
+    if portal is not None:
+        portal.reset_db_pool()  # fecha as conexões com Terminate, sem deixar o Postgres esperando o timeout